@@ -4,4 +4,5 @@
 from setuptools import find_packages, setup
 
 setup(name="timefly", author="Vladimir Feinberg",
-      packages=find_packages())
+      packages=find_packages(),
+      entry_points={"console_scripts": ["timefly=timefly.cli:main"]})
@@ -0,0 +1,70 @@
+"""
+Tests for timefly.hierarchy: bracket tags such as [work/coding] are
+paths, but event summaries containing a slash stay single leaves.
+"""
+
+import pandas as pd
+
+from timefly.context import ContextTree, select_breakdown
+from timefly.hierarchy import summary_leaves
+from timefly.slots import SlotIndex, build_slot_index
+from timefly.tags import df_filter, explode
+
+
+def _events(rows):
+    """The events df of (start hour, hours, tags, summary) rows."""
+    origin = pd.Timestamp("2019-01-07", tz="UTC")
+    starts = [origin + pd.Timedelta(hours=start) for start, _, _, _ in rows]
+    hours = [hrs for _, hrs, _, _ in rows]
+    df = pd.DataFrame(
+        {
+            "start": starts,
+            "end": [s + pd.Timedelta(hours=h) for s, h in zip(starts, hours)],
+            "duration_hours": hours,
+            "tags": pd.Series(
+                [frozenset(tags) for _, _, tags, _ in rows], dtype=object
+            ),
+            "summary": [summary for _, _, _, summary in rows],
+        }
+    )
+    df.index = ["e{}".format(i) for i in range(len(rows))]
+    return df
+
+
+def test_summary_with_slash_is_a_leaf():
+    df = _events(
+        [
+            (0, 1.0, [], "lunch w/ bob"),
+            (24, 2.0, [], "lunch w/ alice"),
+            (48, 4.0, ["work/coding"], ""),
+        ]
+    )
+    assert summary_leaves(df) == {"lunch w/ bob", "lunch w/ alice"}
+
+    tree = ContextTree(df, explode(df))
+    tags, _ = select_breakdown(tree.summary([]), [], 0, 10, tree.leaves)
+    assert set(tags) == {"lunch w/ bob", "lunch w/ alice", "work"}
+    assert tree.summary(["lunch w"]) is None
+    assert tree.summary(["lunch w/ bob"]).hours == 1.0
+
+    kept, _ = df_filter(df, explode(df), "lunch w", quiet=True)
+    assert not len(kept)
+
+    index = SlotIndex(build_slot_index(df))
+    begin, end = df.start.min(), df.end.max()
+    assert index.hours("lunch w", begin, end) == 0.0
+    assert index.hours("lunch w/ alice", begin, end) == 2.0
+    assert index.hours("work", begin, end) == 4.0
+
+
+def test_summary_carried_as_tag_is_a_path():
+    df = _events(
+        [
+            (0, 1.0, [], "work/review"),
+            (24, 2.0, ["work/review"], "code review"),
+        ]
+    )
+    assert summary_leaves(df) == frozenset()
+
+    kept, _ = df_filter(df, explode(df), "work", quiet=True)
+    assert list(kept.index) == ["e0", "e1"]
@@ -0,0 +1,145 @@
+"""
+Tests for timefly.tag_filter: parsing filter expressions, evaluating
+them over an exploded tag matrix, and how df_filter applies them.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timefly.tag_filter import compile_filter, evaluate, is_valid, parse
+from timefly.tags import df_filter, explode
+
+# the tags of each event, in every combination of a, b and c
+_TAGS = [
+    [],
+    ["a"],
+    ["b"],
+    ["c"],
+    ["a", "b"],
+    ["a", "c"],
+    ["b", "c"],
+    ["a", "b", "c"],
+]
+
+
+def _events(tag_lists):
+    """The events df, an hour each, with the given lists of tags."""
+    origin = pd.Timestamp("2019-01-07", tz="UTC")
+    starts = [origin + pd.Timedelta(days=i) for i in range(len(tag_lists))]
+    df = pd.DataFrame(
+        {
+            "start": starts,
+            "end": [start + pd.Timedelta(hours=1) for start in starts],
+            "duration_hours": 1.0,
+            "tags": pd.Series(
+                [frozenset(tags) for tags in tag_lists], dtype=object
+            ),
+            "summary": "",
+        }
+    )
+    df.index = ["e{}".format(i) for i in range(len(tag_lists))]
+    return df
+
+
+def _matches(expr, tag_lists=_TAGS):
+    """The positions of the events with tag_lists which expr matches."""
+    df = _events(tag_lists)
+    ef = explode(df)
+    return list(np.flatnonzero(evaluate(compile_filter(expr, ef.columns), ef)))
+
+
+def test_and_binds_tighter_than_or():
+    assert parse("a OR b AND NOT c") == (
+        "or",
+        [("tag", "a"), ("and", [("tag", "b"), ("not", ("tag", "c"))])],
+    )
+    # a, or b without c
+    assert _matches("a OR b AND NOT c") == [1, 2, 4, 5, 7]
+    assert _matches("NOT a AND b") == [2, 6]
+
+
+def test_parentheses():
+    assert parse("(a OR b) AND NOT c") == (
+        "and",
+        [("or", [("tag", "a"), ("tag", "b")]), ("not", ("tag", "c"))],
+    )
+    assert _matches("(a OR b) AND NOT c") == [1, 2, 4]
+    assert _matches("NOT (a OR b)") == [0, 3]
+    assert _matches("((a))") == _matches("a")
+
+
+def test_words_and_quotes():
+    assert parse("deep work AND fun") == (
+        "and",
+        [("tag", "deep work"), ("tag", "fun")],
+    )
+    assert parse('"x (y)" OR "say \\"hi\\""') == (
+        "or",
+        [("tag", "x (y)"), ("tag", 'say "hi"')],
+    )
+    # a tag spelled like a filter is just that tag
+    assert compile_filter("a AND b", ["a AND b"]) == ("tag", "a AND b")
+
+
+@pytest.mark.parametrize(
+    "expr",
+    [
+        "",
+        "   ",
+        "a AND",
+        "OR a",
+        "NOT",
+        "(a OR b",
+        "a OR b)",
+        "a (b)",
+        "()",
+        'a AND "b',
+    ],
+)
+def test_syntax_errors(expr):
+    assert not is_valid(expr)
+    with pytest.raises(ValueError):
+        parse(expr)
+
+
+def test_valid():
+    assert is_valid(None)
+    assert is_valid("a")
+    assert is_valid("NOT NOT (a OR b) AND c")
+
+
+def test_missing_tags_match_nothing():
+    assert _matches("zzz") == []
+    assert _matches("NOT zzz") == list(range(len(_TAGS)))
+    assert _matches("a OR zzz") == _matches("a")
+    assert _matches("a AND zzz") == []
+
+
+def test_hierarchical_tags():
+    tag_lists = [["work/coding"], ["work/review"], ["fun"]]
+    assert _matches("work", tag_lists) == [0, 1]
+    assert _matches("work AND NOT work/review", tag_lists) == [0]
+
+
+def test_df_filter_strips_constant_mentioned_tags():
+    df = _events(_TAGS)
+    ef = explode(df)
+
+    kept, kef = df_filter(df, ef, "a AND NOT c", quiet=True)
+    assert list(kept.index) == ["e1", "e4"]
+    # every kept event has a, and none has c, so both are dropped;
+    # b still tells the kept events apart
+    assert list(kef.columns) == ["b"]
+    assert list(kept.tags) == [frozenset(), frozenset(["b"])]
+
+    kept, kef = df_filter(df, ef, "a OR b", quiet=True)
+    assert list(kept.index) == ["e1", "e2", "e4", "e5", "e6", "e7"]
+    # neither a nor b is on all the kept events
+    assert sorted(kef.columns) == ["a", "b", "c"]
+    assert kept.tags["e4"] == frozenset(["a", "b"])
+
+    # filtering to nothing leaves no columns of the mentioned tags
+    kept, kef = df_filter(df, ef, "a AND zzz", quiet=True)
+    assert not len(kept)
+    assert "a" not in kef.columns
@@ -0,0 +1,131 @@
+"""
+Tests for timefly.watch: merging shards from a source keeps the daily
+aggregates and the slot index the same as building them from scratch.
+"""
+
+import os
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+from absl import flags
+from absl.testing import flagsaver
+
+from timefly.aggregates import build_aggregates
+from timefly.slots import SlotIndex, build_slot_index, load_slot_index
+from timefly.synthetic import synthetic_calendar
+from timefly.watch import Watcher
+
+
+class FakeSource:
+    """
+    A watch source handing out the next of a list of batches on every
+    poll: a batch is a list of event dataframes, written as shards into
+    directory, or an exception, which the poll raises.
+    """
+
+    def __init__(self, directory, batches):
+        self.directory = directory
+        self.batches = list(batches)
+        self.merged = []
+
+    def poll(self):
+        if not self.batches:
+            return []
+        batch = self.batches.pop(0)
+        if isinstance(batch, Exception):
+            raise batch
+        paths = []
+        for shard in batch:
+            name = "shard-{:04d}.pkl".format(len(self.merged) + len(paths))
+            paths.append(os.path.join(self.directory, name))
+            shard.to_pickle(paths[-1])
+        return paths
+
+    def done(self, path):
+        self.merged.append(path)
+
+
+@pytest.fixture(autouse=True)
+def _flags():
+    if not flags.FLAGS.is_parsed():
+        flags.FLAGS(["pytest"])
+    with flagsaver.flagsaver(results_cache=""):
+        yield
+
+
+def _monthly_batches(df, seed=0):
+    """
+    The events of df in batches of a few months, in shuffled order,
+    where each batch also repeats some events of the others.
+    """
+    months = df.start.dt.strftime("%Y-%m").values
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(sorted(set(months)))
+    batches = []
+    for i in range(0, len(order), 3):
+        batch = [df[months == month] for month in order[i : i + 3]]
+        batch.append(df.sample(10, random_state=i))
+        batches.append(batch)
+    return batches
+
+
+def _watcher(tmp_path, batches):
+    source = FakeSource(str(tmp_path), batches)
+    return Watcher(
+        source,
+        str(tmp_path / "running.pkl"),
+        str(tmp_path / "aggregates.pkl"),
+        cube=str(tmp_path / "cube.pkl"),
+        slot_index=str(tmp_path / "slots.pkl"),
+    )
+
+
+def test_sync_matches_rebuild(tmp_path):
+    df = synthetic_calendar(nevents=2000)
+    watcher = _watcher(tmp_path, _monthly_batches(df))
+    now = df.end.max()
+    while watcher.source.batches:
+        assert watcher.sync(now)
+    assert watcher.sync(now) == 0
+
+    store = pd.read_pickle(tmp_path / "running.pkl")
+    assert store.index.sort_values().equals(df.index.sort_values())
+    expected = build_aggregates(store)
+    for name in ["daily", "tags"]:
+        actual = watcher.aggregates[name].sort_index(axis=1)
+        wanted = expected[name].sort_index(axis=1)
+        assert actual.index.equals(wanted.index)
+        assert list(actual.columns) == list(wanted.columns)
+        np.testing.assert_allclose(actual.values, wanted.values, atol=1e-9)
+
+    index = load_slot_index(
+        str(tmp_path / "slots.pkl"), str(tmp_path / "running.pkl")
+    )
+    assert index is not None
+    updated, rebuilt = SlotIndex(index), SlotIndex(build_slot_index(store))
+    begin = df.start.min()
+    ranges = [
+        (begin, now),
+        (begin + pd.Timedelta(days=40), begin + pd.Timedelta(days=90)),
+        (begin + pd.Timedelta(hours=7.3), begin + pd.Timedelta(days=200.1)),
+    ]
+    for tag in ["tag0", "tag1", "tag7", "tag40", "summary 3"]:
+        for from_time, to_time in ranges:
+            np.testing.assert_allclose(
+                updated.hours(tag, from_time, to_time),
+                rebuilt.hours(tag, from_time, to_time),
+                atol=1e-6,
+            )
+
+
+def test_failed_poll_is_retried(tmp_path, capsys):
+    df = synthetic_calendar(nevents=200)
+    failure = subprocess.CalledProcessError(1, "timefly.main.ingest")
+    watcher = _watcher(tmp_path, [[df.iloc[:100]], failure, [df.iloc[100:]]])
+    assert watcher.sync() == 100
+    assert watcher.sync() == 0
+    assert "polling for shards failed" in capsys.readouterr().err
+    assert watcher.sync() == 100
+    assert len(pd.read_pickle(tmp_path / "running.pkl")) == 200
@@ -0,0 +1,5 @@
+"""Allows running the timefly command line as python -m timefly."""
+
+from .cli import main
+
+main()
@@ -0,0 +1,236 @@
+"""
+Daily aggregates of a store, materialized so that the latest numbers are
+read rather than computed. For every UTC day with events, they hold the
+number of events intersecting the day, their hours within it, the hours
+of the day covered by some event, and the hours within it of every tag
+(including summaries and the ancestors of hierarchical tags, as in the
+slot index).
+
+Each of these adds up over days, so the totals of a range of whole days
+are a sum of rows, and a day's aggregates only change when new events
+touch it: watch (see timefly.watch) recomputes just those days as it
+merges events in (see update_aggregates). Each time, it also stores the
+totals of the last few days (see latest), which readers such as watch
+--show print without touching the store at all.
+
+Like a cube, the aggregates remember which version of the store they
+were computed from (see load_aggregates).
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .cube import store_fingerprint
+from .hierarchy import event_tags
+from .interval import epoch_ns, filter_range, split_by_buckets
+from .recurrence import is_series, materialize
+
+AGGREGATES_VERSION = 1
+
+DAY_NS = 24 * 3600 * 10 ** 9
+
+
+def build_aggregates(df, fingerprint=None):
+    """
+    Computes the aggregates (a plain dict, see update_aggregates) of
+    the store df. fingerprint identifies the store file, see
+    cube.store_fingerprint.
+    """
+    days = pd.DatetimeIndex([], tz="UTC", name="day")
+    aggregates = {
+        "version": AGGREGATES_VERSION,
+        "fingerprint": fingerprint,
+        "daily": pd.DataFrame(
+            {
+                "events": np.zeros(0, dtype=np.int64),
+                "hours": np.zeros(0),
+                "covered_hours": np.zeros(0),
+            },
+            index=days,
+        ),
+        "tags": pd.DataFrame(index=days),
+        "latest": [],
+    }
+    if len(df):
+        update_aggregates(aggregates, df, *touched_days(df))
+    return aggregates
+
+
+def touched_days(df):
+    """
+    Returns the first and last (exclusive) UTC day boundaries, in ns,
+    of the days touched by the rows df of a store: those of the events
+    themselves, and every day up to the recurrence_end of a series.
+    """
+    ends = epoch_ns(df.end)
+    series = is_series(df)
+    if series.any():
+        ends[series] = epoch_ns(df.recurrence_end[series])
+    lo = int(epoch_ns(df.start).min()) // DAY_NS * DAY_NS
+    hi = -(-int(ends.max()) // DAY_NS) * DAY_NS
+    return lo, max(hi, lo + DAY_NS)
+
+
+def update_aggregates(aggregates, df, lo, hi):
+    """
+    Recomputes, in place, the aggregates of the UTC days from lo to hi
+    (day boundaries in ns) from the store df, in which some events on
+    those days were added or changed.
+
+    The daily dataframe of aggregates has a row of events, hours and
+    covered_hours per day with events, and the tags dataframe the hours
+    of every tag (as columns) on those days.
+    """
+    from_time = pd.Timestamp(lo, tz="UTC")
+    to_time = pd.Timestamp(hi, tz="UTC")
+    df = filter_range(materialize(df, from_time, to_time), from_time, to_time)
+    daily, tags = _days(df, lo, hi)
+    aggregates["daily"] = _replace_days(aggregates["daily"], daily, lo, hi)
+    aggregates["tags"] = _replace_days(aggregates["tags"], tags, lo, hi)
+
+
+def _replace_days(frame, days, lo, hi):
+    """
+    Returns the dataframe frame, indexed by day, with its rows from lo
+    to hi replaced by the dataframe days (missing columns are zeros).
+    """
+    index = epoch_ns(frame.index)
+    frame = frame[(index < lo) | (index >= hi)]
+    if not len(frame):
+        return days
+    return pd.concat([frame, days]).fillna(0).sort_index()
+
+
+def _days(df, lo, hi):
+    """
+    Returns the daily and tags dataframes of update_aggregates for the
+    days from lo to hi, over the events df of those days.
+    """
+    ndays = (hi - lo) // DAY_NS
+    edges = lo + DAY_NS * np.arange(ndays + 1, dtype=np.int64)
+    starts, ends = epoch_ns(df.start), epoch_ns(df.end)
+    rows, days, hours = split_by_buckets(starts, ends, edges)
+    daily = pd.DataFrame(
+        {
+            "events": np.bincount(days, minlength=ndays),
+            "hours": np.bincount(days, weights=hours, minlength=ndays),
+            "covered_hours": _covered_hours(starts, ends, edges),
+        },
+        index=pd.DatetimeIndex(
+            edges[:-1].astype("datetime64[ns]"), name="day"
+        ).tz_localize("UTC"),
+    )
+
+    # hours per distinct tag set and day, then spread to the tags of
+    # each set; tag sets are interned, so there are few of them
+    codes, tagsets = pd.factorize(
+        pd.Series(list(zip(df.tags, df.summary)), dtype=object)
+    )
+    keys, inverse = np.unique(
+        codes[rows].astype(np.int64) * ndays + days, return_inverse=True
+    )
+    sums = np.bincount(inverse, weights=hours)
+    bounds = np.searchsorted(keys // ndays, np.arange(len(tagsets) + 1))
+    tag_hours = {}
+    for code, key in enumerate(tagsets):
+        lo_key, hi_key = bounds[code], bounds[code + 1]
+        for tag in event_tags(*key):
+            column = tag_hours.setdefault(tag, np.zeros(ndays))
+            column[keys[lo_key:hi_key] % ndays] += sums[lo_key:hi_key]
+    tags = pd.DataFrame(tag_hours, index=daily.index)
+    tags = tags[sorted(tags.columns)]
+
+    busy = daily.events.values > 0
+    return daily[busy], tags[busy]
+
+
+def _covered_hours(starts, ends, edges):
+    """
+    Returns the float array of the hours of each bucket between edges
+    covered by the union of the intervals starts - ends (int arrays).
+    """
+    covered = np.zeros(len(edges) - 1)
+    if not len(starts):
+        return covered
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    # merge the intervals into disjoint blocks: a block starts wherever
+    # an interval starts after all earlier ones have ended
+    latest = np.maximum.accumulate(ends)
+    first = np.flatnonzero(np.append(True, starts[1:] > latest[:-1]))
+    last = np.append(first[1:] - 1, len(starts) - 1)
+    _, buckets, hours = split_by_buckets(starts[first], latest[last], edges)
+    covered += np.bincount(buckets, weights=hours, minlength=len(covered))
+    return covered
+
+
+def latest(aggregates, now, windows=(1, 7, 30), top=10):
+    """
+    Returns the list of the totals of the last few UTC days up to now,
+    one dict per number of days in windows, with the range (begin, end),
+    events, hours, covered, uncovered and range hours, and the hours
+    of the top tags, as a list of pairs in decreasing order.
+
+    Events and hours count the events of each day separately, so an
+    event straddling days counts once per day. As with
+    interval.find_intervals, a range without events has no uncovered
+    hours.
+    """
+    daily, tags = aggregates["daily"], aggregates["tags"]
+    today = pd.Timestamp(now).tz_convert("UTC").floor("D")
+    end = today + pd.Timedelta(days=1)
+    reports = []
+    for ndays in windows:
+        begin = end - pd.Timedelta(days=ndays)
+        lo, hi = daily.index.searchsorted([begin, end])
+        days = daily.iloc[lo:hi]
+        tag_hours = tags.iloc[lo:hi].sum()
+        tag_hours = tag_hours[tag_hours > 0]
+        ranked = tag_hours.sort_values(ascending=False, kind="stable")
+        range_hours = ndays * 24.0
+        covered = float(days.covered_hours.sum())
+        reports.append(
+            {
+                "days": ndays,
+                "begin": begin.to_pydatetime(),
+                "end": end.to_pydatetime(),
+                "events": int(days.events.sum()),
+                "hours": float(days.hours.sum()),
+                "covered_hours": covered,
+                "uncovered_hours": range_hours - covered if len(days) else 0.0,
+                "range_hours": range_hours,
+                "tags": list(ranked.iloc[:top].items()),
+            }
+        )
+    return reports
+
+
+def save_aggregates(aggregates, path):
+    """
+    Writes the aggregates dict to path, atomically, so that readers
+    never see a partly written file.
+    """
+    tmp = path + ".tmp"
+    pd.to_pickle(aggregates, tmp)
+    os.replace(tmp, path)
+
+
+def load_aggregates(path, running_events=None):
+    """
+    Loads the aggregates dict at path, returning None if it does not
+    exist, or if running_events is specified and the aggregates were
+    computed from a different version of that store.
+    """
+    if not os.path.exists(path):
+        return None
+    aggregates = pd.read_pickle(path)
+    if aggregates.get("version") != AGGREGATES_VERSION:
+        return None
+    if running_events is not None:
+        if not os.path.exists(running_events):
+            return None
+        if aggregates["fingerprint"] != store_fingerprint(running_events):
+            return None
+    return aggregates
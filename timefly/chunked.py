@@ -0,0 +1,387 @@
+"""
+Out-of-core reports, for histories too large to load at once (say, the
+stores of a whole team): digest breakdowns and coverage, and versus
+deltas, computed in a single pass over the events in start-time order,
+a fixed-size chunk at a time.
+
+A chunked store is a directory of pickled event dataframes of at most
+chunk_size events each, holding the events of one or more stores in
+start-time order, along with an index of the time span of each chunk,
+so that a range only reads the chunks overlapping it (see write_chunks
+and timefly.main.chunk).
+
+Only the state of two sweeps is carried across chunks, so peak memory
+is bounded by the chunk size rather than by the size of the history:
+
+    * CoverageSweep carries the latest end of the events seen so far
+      (all that's left of the open intervals of interval.find_intervals
+      when events come in start order) and the running uncovered time.
+    * TagSetTotals carries the running hours and event count of each
+      distinct tag set (tags and summary). Breakdowns, kept fractions
+      and greedy deltas only depend on the events through those, so the
+      reports are computed from a df with one row per tag set and an
+      events column (see tags.popular_tag_hours), whose length is
+      bounded by the combinations of tags in use, not by the history.
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import log, tag_filter
+from .compare import greedy_deltas
+from .hierarchy import summary_leaves
+from .interval import epoch_ns, filter_range, hrs_bw
+from .recurrence import materialize
+from .schema import compact
+from .tags import df_filter, explode
+
+INDEX_FILE = "index.pkl"
+
+ChunkedDigest = namedtuple(
+    "ChunkedDigest",
+    ["uncovered_hours", "range_hours", "kept_fraction", "df", "ef"],
+)
+ChunkedDigest.__doc__ = """
+The coverage of a digest range, the fraction of its events kept by the
+filter (None without one), and the df, ef pair of the kept events, with
+one row per tag set (see TagSetTotals.frame).
+"""
+
+ChunkedVersus = namedtuple(
+    "ChunkedVersus",
+    [
+        "kept_fraction",
+        "events",
+        "hours",
+        "uncovered_hours",
+        "range_hours",
+        "deltas",
+    ],
+)
+ChunkedVersus.__doc__ = """
+The fraction of the events of a versus span kept by the filter (None
+without one), the lists of the event counts and hours of both ranges,
+the total uncovered and range hours of both, and the generator of
+compare.greedy_deltas records from the first range to the second.
+"""
+
+
+def write_chunks(paths, directory, chunk_size):
+    """
+    Writes the events of the stores at paths, merged in start-time
+    order, as a chunked store in directory, with at most chunk_size
+    events per chunk. Returns the number of chunks.
+
+    Only one store is in memory at a time: each is sorted and written
+    as a run of chunks, and the runs are then merged a chunk of each at
+    a time. Recurring events are written as their instances.
+    """
+    os.makedirs(directory, exist_ok=True)
+    runs = []
+    for i, path in enumerate(paths):
+        with log.stage("load"):
+            df = materialize(pd.read_pickle(path))
+        with log.stage("sort"):
+            df = df.sort_values("start", kind="stable")
+        run = []
+        for j, lo in enumerate(range(0, len(df), chunk_size)):
+            name = "run-{:04d}-{:06d}.pkl".format(i, j)
+            name = os.path.join(directory, name)
+            df.iloc[lo : lo + chunk_size].to_pickle(name)
+            run.append(name)
+        if run:
+            runs.append(run)
+        del df
+
+    writer = _ChunkWriter(directory, chunk_size)
+    heads = [_next_run_chunk(run) for run in runs]
+    while heads:
+        # every event starting by the earliest last start of the heads
+        # precedes all those still in the runs
+        bound = epoch_ns([min(head.start.iloc[-1] for head in heads)])[0]
+        taken = []
+        for i, head in enumerate(heads):
+            n = np.searchsorted(epoch_ns(head.start), bound, side="right")
+            taken.append(head.iloc[:n])
+            heads[i] = head.iloc[n:]
+            if not len(heads[i]):
+                heads[i] = _next_run_chunk(runs[i])
+        runs = [run for run, head in zip(runs, heads) if head is not None]
+        heads = [head for head in heads if head is not None]
+        merged = pd.concat(taken) if len(taken) > 1 else taken[0]
+        writer.write(merged.sort_values("start", kind="stable"))
+    return writer.close()
+
+
+def _next_run_chunk(run):
+    """Reads and deletes the next chunk file of run, or returns None."""
+    if not run:
+        return None
+    name = run.pop(0)
+    chunk = pd.read_pickle(name)
+    os.remove(name)
+    return chunk
+
+
+class _ChunkWriter:
+    """
+    Buffers events, given in start-time order, into the chunk files and
+    index of a chunked store.
+    """
+
+    def __init__(self, directory, chunk_size):
+        self._directory = directory
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+        self._chunks = []
+        self._tags = set()
+
+    def write(self, df):
+        self._buffer.append(df)
+        self._buffered += len(df)
+        while self._buffered >= self._chunk_size:
+            self._flush(self._chunk_size)
+
+    def close(self):
+        """Writes the remaining events and the index."""
+        while self._buffered:
+            self._flush(min(self._buffered, self._chunk_size))
+        index = pd.DataFrame(
+            self._chunks, columns=["file", "first_start", "max_end", "events"]
+        )
+        pd.to_pickle(
+            {"chunks": index, "tags": sorted(self._tags)},
+            os.path.join(self._directory, INDEX_FILE),
+        )
+        return len(self._chunks)
+
+    def _flush(self, size):
+        buffered = pd.concat(self._buffer)
+        chunk, rest = buffered.iloc[:size], buffered.iloc[size:]
+        self._buffer, self._buffered = [rest], len(rest)
+        # categories differ between the stores merged into a chunk
+        chunk = compact(chunk)
+        name = "chunk-{:06d}.pkl".format(len(self._chunks))
+        chunk.to_pickle(os.path.join(self._directory, name))
+        self._chunks.append(
+            (name, chunk.start.iloc[0], chunk.end.max(), len(chunk))
+        )
+        for tags, summary in set(zip(chunk.tags, chunk.summary)):
+            self._tags.update(tags)
+            if isinstance(summary, str) and summary:
+                self._tags.add(summary)
+
+
+def read_index(directory):
+    """
+    Returns the index of the chunked store in directory, a dict of the
+    dataframe of chunks (file, first_start, max_end and events) and the
+    sorted list of all tags and summaries of the store.
+    """
+    return pd.read_pickle(os.path.join(directory, INDEX_FILE))
+
+
+def iter_chunks(directory, from_time, to_time):
+    """
+    Generates the events of the chunked store in directory which
+    intersect the range from_time to to_time (as filter_range does), in
+    start-time order, a chunk at a time.
+    """
+    chunks = read_index(directory)["chunks"]
+    for chunk in chunks.itertuples():
+        if chunk.first_start >= to_time:
+            break
+        if chunk.max_end <= from_time:
+            continue
+        with log.stage("load chunk"):
+            df = pd.read_pickle(os.path.join(directory, chunk.file))
+        yield filter_range(df, from_time, to_time)
+
+
+class CoverageSweep:
+    """
+    The uncovered hours of a range, as interval.find_intervals finds
+    them, from events intersecting it fed in start-time order, in any
+    number of batches.
+    """
+
+    def __init__(self, from_time, to_time):
+        self._from, self._to = epoch_ns([from_time, to_time])
+        self.range_hours = hrs_bw(from_time, to_time)
+        # the latest end of any event so far: a gap before an event's
+        # start is uncovered, since all earlier events start before it
+        self._latest = self._from
+        self._seen = False
+        self._uncovered = 0
+
+    def add(self, df):
+        """Sweeps over the events df, which follow all those added."""
+        if not len(df):
+            return
+        starts, ends = epoch_ns(df.start), epoch_ns(df.end)
+        latest = np.maximum.accumulate(np.append(self._latest, ends))
+        gaps = np.minimum(starts, self._to) - latest[:-1]
+        self._uncovered += int(gaps[gaps > 0].sum())
+        self._latest = int(latest[-1])
+        self._seen = True
+
+    @property
+    def uncovered_hours(self):
+        # find_intervals finds no uncovered time at all without events
+        tail = max(self._to - self._latest, 0) if self._seen else 0
+        return (self._uncovered + tail) / 3.6e12
+
+
+class TagSetTotals:
+    """
+    The running hours and event counts of each distinct tag set, that
+    is, pair of tags and summary, of the events added.
+    """
+
+    def __init__(self):
+        self._totals = {}
+
+    def add(self, df):
+        """Adds the hours and counts of the events df."""
+        if not len(df):
+            return
+        keys = pd.Series(list(zip(df.tags, df.summary)), dtype=object)
+        codes, uniques = pd.factorize(keys)
+        hours = np.bincount(
+            codes,
+            weights=df.duration_hours.values.astype(float),
+            minlength=len(uniques),
+        )
+        events = np.bincount(codes, minlength=len(uniques))
+        for key, key_hours, key_events in zip(uniques, hours, events):
+            totals = self._totals.setdefault(key, [0.0, 0])
+            totals[0] += key_hours
+            totals[1] += int(key_events)
+
+    @property
+    def events(self):
+        return sum(events for _, events in self._totals.values())
+
+    @property
+    def totals(self):
+        """The dict from each tag set to its [hours, events]."""
+        return {key: list(value) for key, value in self._totals.items()}
+
+    def frame(self):
+        """
+        Returns the df, ef pair of the tag sets: df has one row per tag
+        set, with its tags, summary, duration_hours (the total hours)
+        and events (the event count) columns, and ef is its explode.
+        """
+        keys = list(self._totals)
+        totals = list(self._totals.values())
+        df = pd.DataFrame(
+            {
+                "tags": pd.Series([tags for tags, _ in keys], dtype=object),
+                "summary": [summary for _, summary in keys],
+                "duration_hours": [hours for hours, _ in totals],
+                "events": [events for _, events in totals],
+            }
+        )
+        if not len(df):
+            return df, pd.DataFrame(index=df.index)
+        return df, explode(df)
+
+
+def matches(df, node):
+    """
+    Returns the boolean array of the events df matched by the parse tree
+    node of a tag filter, evaluated once per distinct tag set.
+    """
+    if not len(df):
+        return np.zeros(0, dtype=bool)
+    keys = pd.Series(list(zip(df.tags, df.summary)), dtype=object)
+    codes, uniques = pd.factorize(keys)
+    tagsets = pd.DataFrame(
+        {
+            "tags": pd.Series([tags for tags, _ in uniques], dtype=object),
+            "summary": [summary for _, summary in uniques],
+        }
+    )
+    return tag_filter.evaluate(
+        node, explode(tagsets), summary_leaves(tagsets)
+    )[codes]
+
+
+def digest(directory, from_time, to_time, filter_expr=None):
+    """
+    Returns the ChunkedDigest of the range of the chunked store in
+    directory, filtered to filter_expr, in one pass over its chunks.
+    """
+    sweep = CoverageSweep(from_time, to_time)
+    totals = TagSetTotals()
+    for df in iter_chunks(directory, from_time, to_time):
+        sweep.add(df)
+        totals.add(df)
+
+    df, ef = totals.frame()
+    keep_frac = None
+    if filter_expr:
+        df, ef = df_filter(df, ef, filter_expr, quiet=True)
+        if totals.events:
+            keep_frac = df.events.sum() / totals.events
+    return ChunkedDigest(
+        sweep.uncovered_hours, sweep.range_hours, keep_frac, df, ef
+    )
+
+
+def versus(
+    directory, start1, end1, start2, end2, filter_expr=None, min_support=0.025
+):
+    """
+    Returns the ChunkedVersus from the range start1 - end1 to the range
+    start2 - end2 of the chunked store in directory, among the events of
+    the whole span filtered to filter_expr, in one pass over its chunks.
+    """
+    node = None
+    if filter_expr:
+        node = tag_filter.compile_filter(
+            filter_expr, read_index(directory)["tags"]
+        )
+    ranges = [(start1, end1), (start2, end2)]
+    sweeps = [CoverageSweep(*r) for r in ranges]
+    totals = [TagSetTotals() for _ in ranges]
+    kept, span_events = TagSetTotals(), 0
+    for df in iter_chunks(directory, start1, end2):
+        span_events += len(df)
+        if node is not None:
+            df = df[matches(df, node)]
+        kept.add(df)
+        for sweep, range_totals, r in zip(sweeps, totals, ranges):
+            range_df = filter_range(df, *r)
+            sweep.add(range_df)
+            range_totals.add(range_df)
+
+    # the columns of the filtered span, as tags.df_filter leaves them
+    kdf, kef = kept.frame()
+    if filter_expr:
+        kdf, kef = df_filter(kdf, kef, filter_expr, quiet=True)
+    mats, hours = [], []
+    for range_totals in totals:
+        df, ef = range_totals.frame()
+        mats.append(ef.reindex(columns=kef.columns, fill_value=False).values)
+        hours.append(df.duration_hours.values)
+    return ChunkedVersus(
+        kept.events / span_events if filter_expr and span_events else None,
+        [range_totals.events for range_totals in totals],
+        [h.sum() for h in hours],
+        sum(sweep.uncovered_hours for sweep in sweeps),
+        sum(sweep.range_hours for sweep in sweeps),
+        greedy_deltas(
+            kef.columns.values,
+            mats[0],
+            hours[0],
+            mats[1],
+            hours[1],
+            min_support,
+        ),
+    )
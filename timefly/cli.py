@@ -0,0 +1,70 @@
+"""
+The timefly command line, installed as the `timefly` console script
+(or run as python -m timefly):
+
+    timefly <command> [flags]
+
+runs the mainfile timefly.main.<command>. Only the chosen command's
+module is imported, and only once the command is known, so each command
+pays just for its own flags and dependencies, and listing the commands
+imports nothing at all.
+
+Mainfiles parse their flags with absl, which is only imported to run
+them; one which doesn't use absl (the thin client, query) instead
+defines main(argv), which is called with the command line as is.
+"""
+
+import importlib
+import sys
+
+# command name -> one-line description, for the usage message
+COMMANDS = {
+    "ingest": "fetch events from Google calendar into a new store",
+    "merge": "merge newly ingested events into the running store",
+    "digest": "print the popular-tag breakdown of a period",
+    "drill": "interactively drill down into the tags of a period",
+    "versus": "compare the time spent per tag between periods",
+    "cube": "precompute breakdowns for digest and drill --cube",
+    "serve": "keep the store loaded and answer query requests",
+    "query": "ask a running server for a report (thin client)",
+    "batch": "generate many reports in parallel from a spec file",
+    "chunk": "write stores as a chunked store for out-of-core reports",
+    "watch": "keep the store and its aggregates up to date as events arrive",
+    "bench": "benchmark the pipeline on synthetic calendars",
+}
+
+
+def usage():
+    """Returns the usage message listing all commands."""
+    width = max(map(len, COMMANDS))
+    lines = ["usage: timefly <command> [flags]", "", "commands:"]
+    lines += [
+        "  {:<{}}  {}".format(name, width, description)
+        for name, description in COMMANDS.items()
+    ]
+    lines += ["", "run timefly <command> --help for the flags of a command"]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Entry point of the timefly console script."""
+    argv = sys.argv if argv is None else argv
+    if len(argv) < 2 or argv[1] in ["-h", "--help", "help"]:
+        print(usage())
+        return
+    command = argv[1]
+    if command not in COMMANDS:
+        print("unknown command {}\n".format(command), file=sys.stderr)
+        print(usage(), file=sys.stderr)
+        sys.exit(2)
+
+    module = importlib.import_module("timefly.main." + command)
+    if hasattr(module, "main"):
+        module.main(["timefly " + command] + argv[2:])
+        return
+
+    from absl import app
+
+    # absl's --help shows the docstring of __main__
+    sys.modules["__main__"].__doc__ = module.__doc__
+    app.run(module._main, argv=["timefly " + command] + argv[2:])
@@ -0,0 +1,155 @@
+"""
+Greedy comparison of the time spent per tag between periods.
+"""
+
+import multiprocessing
+
+import numpy as np
+
+
+def period_hours(mat, weights):
+    """
+    Given a boolean (events x tags) matrix and the hours of each event,
+    returns the float array of hours per tag.
+    """
+    return np.asarray(weights, dtype=float) @ mat
+
+
+def period_tag_hours(mat, weights, period_rows):
+    """
+    Given a boolean (events x tags) matrix, the hours of each event, and
+    a list of arrays of the event rows in each period, returns the float
+    (tags x periods) matrix of hours per tag in each period.
+    """
+    weights = np.asarray(weights, dtype=float)
+    columns = [
+        period_hours(mat[rows], weights[rows]) for rows in period_rows
+    ]
+    return np.stack(columns, axis=1) if columns else np.zeros((0, 0))
+
+
+def greedy_deltas(tags, prev_mat, prev_hours, next_mat, next_hours,
+                  min_support, tag_hours=None):
+    """
+    Greedily explains the change in the fraction of time spent per tag
+    between a previous and a next period: repeatedly picks the tag whose
+    fraction of its period's total hours changed the most, and then
+    removes all events with that tag. Fractions stay relative to the
+    original totals, so all the picked changes are mutually exclusive.
+
+    tags names the columns of the boolean (events x tags) matrices
+    prev_mat and next_mat, whose rows are the events of each period,
+    lasting prev_hours and next_hours respectively.
+
+    Generates a "delta" record for each picked tag, as soon as it's
+    picked, until the largest change is below min_support, followed by a
+    final "other" record with that remaining change. Fractions are
+    undefined if either period has no hours, so then the only record is
+    an "empty" one with the hours of both.
+
+    If already known, the (tags x 2) hours of each tag in each period
+    may be passed as tag_hours, which is not modified.
+
+    The tag x period hours matrix is computed once, and each removal
+    subtracts only the removed events' contributions, so the whole pass
+    touches each event once (plus a scan over tags per pick).
+    """
+    periods = [
+        (np.asarray(prev_mat, dtype=bool), np.asarray(prev_hours, float)),
+        (np.asarray(next_mat, dtype=bool), np.asarray(next_hours, float)),
+    ]
+    totals = np.array([hours.sum() for _, hours in periods])
+    if not totals.all():
+        yield {
+            "type": "empty",
+            "prev_hours": totals[0],
+            "next_hours": totals[1],
+        }
+        return
+    if tag_hours is None:
+        hours = np.stack([period_hours(m, w) for m, w in periods], axis=1)
+    else:
+        hours = np.array(tag_hours, dtype=float)
+    counts = sum(m.sum(axis=0) for m, _ in periods)
+    alive = [np.ones(len(m), dtype=bool) for m, _ in periods]
+
+    change = 0.0
+    while counts.any():
+        fractions = hours / totals
+        changes = fractions[:, 1] - fractions[:, 0]
+        # tags without any remaining events are no longer candidates
+        magnitude = np.where(counts > 0, np.abs(changes), -1)
+        best = int(magnitude.argmax())
+        change = changes[best]
+
+        if abs(change) < min_support:
+            break
+
+        yield {
+            "type": "delta",
+            "tag": tags[best],
+            "change": change,
+            "prev_hours": hours[best, 0],
+            "next_hours": hours[best, 1],
+        }
+
+        for i, (mat, weights) in enumerate(periods):
+            removed = np.flatnonzero(alive[i] & mat[:, best])
+            alive[i][removed] = False
+            removed_mat = mat[removed]
+            hours[:, i] -= period_hours(removed_mat, weights[removed])
+            counts -= removed_mat.sum(axis=0)
+
+    yield {"type": "other", "change": change}
+
+
+# arguments of rolling_deltas, set in each worker process
+_ROLLING = None
+
+
+def _init_rolling(*args):
+    global _ROLLING
+    _ROLLING = args
+
+
+def _pair_deltas(k):
+    """greedy_deltas records from period k - 1 to period k"""
+    tags, mat, weights, tag_hours, period_rows, min_support = _ROLLING
+    prev_rows, next_rows = period_rows[k - 1], period_rows[k]
+    return list(
+        greedy_deltas(
+            tags,
+            mat[prev_rows],
+            weights[prev_rows],
+            mat[next_rows],
+            weights[next_rows],
+            min_support,
+            tag_hours[:, k - 1 : k + 1],
+        )
+    )
+
+
+def rolling_deltas(tags, mat, weights, period_rows, min_support, jobs=None):
+    """
+    Compares each of a sequence of periods against the previous one.
+
+    All periods share the one boolean (events x tags) matrix mat, with
+    event hours weights; period_rows is the list of arrays of the rows
+    of mat in each period. The (tags x periods) hours matrix is computed
+    once, and each adjacent pair is then handed to greedy_deltas on a
+    pool of jobs processes (all cores if None, in-process if 1).
+
+    Generates a (k, records) pair comparing period k - 1 to period k, for
+    each k from 1, in order, as soon as that comparison is done.
+    """
+    weights = np.asarray(weights, dtype=float)
+    tag_hours = period_tag_hours(mat, weights, period_rows)
+    args = (tags, mat, weights, tag_hours, period_rows, min_support)
+    pairs = range(1, len(period_rows))
+    if jobs == 1:
+        _init_rolling(*args)
+        for k in pairs:
+            yield k, _pair_deltas(k)
+        return
+    with multiprocessing.Pool(jobs, _init_rolling, args) as pool:
+        yield from zip(pairs, pool.imap(_pair_deltas, pairs))
@@ -0,0 +1,319 @@
+"""
+Tag contexts: a context is a sequence of tags, and the events in a
+context are those carrying every one of its tags.
+"""
+
+import math
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+from . import log
+from .cooccur import cooccurrence
+from .hierarchy import rollup, subtree_columns, summary_leaves
+from .interval import RangeSlicer
+from .tags import explode, popular_tag_hours, select_popular
+
+ContextSummary = namedtuple(
+    "ContextSummary", ["hours", "events", "ntags", "tags", "tag_hours"]
+)
+ContextSummary.__doc__ = """
+Everything digest and drill display about a context: its total hours,
+event count and tag count, and its popular-tag breakdown as returned
+by tags.popular_tag_hours.
+"""
+
+
+def summarize(df, ef):
+    """
+    Returns the ContextSummary of a context's df, ef pair, whose rows
+    may each stand for several events (see tags.popular_tag_hours).
+    """
+    tags, tag_hours = popular_tag_hours(df, ef)
+    return ContextSummary(
+        float(df.duration_hours.values.astype(float).sum()),
+        int(df["events"].sum()) if "events" in df.columns else len(df),
+        len(ef.columns),
+        tags,
+        tag_hours,
+    )
+
+
+def narrow(df, ef, tag, leaves=frozenset()):
+    """
+    Given the events df and exploded tags ef of some context,
+    returns the df, ef pair of that context extended by tag, i.e., of
+    the events carrying tag or one of its descendants (see hierarchy,
+    and summary_leaves for leaves).
+
+    The tag column is dropped from ef, as are the columns of any tags
+    which no longer appear. Returns None, None if neither tag nor its
+    descendants are columns of ef (e.g., it's the catch-all "<unk>").
+    """
+    if df is None:
+        return None, None
+    columns = subtree_columns(ef.columns, tag, leaves)
+    if not columns:
+        return None, None
+    if columns == [tag]:
+        chosen = ef[tag].values.astype(bool)
+    else:
+        chosen = ef[columns].values.any(axis=1)
+    ef = ef.loc[chosen]
+    if tag in ef.columns:
+        ef = ef.drop(columns=tag)
+    return df.loc[chosen], prune(ef)
+
+
+def select_breakdown(
+    summary, context, min_support, max_values, leaves=frozenset()
+):
+    """
+    Returns the tags and fractions of hours of the popular-tag breakdown
+    of the ContextSummary of context, as tags.select_popular does, after
+    rolling the tags up as hierarchy.rollup does (with the leaves).
+    """
+    tags, hours = rollup(summary.tags, summary.tag_hours, context, leaves)
+    return select_popular(tags, hours, min_support, max_values)
+
+
+def prune(ef):
+    """Drops the tag columns of ef which are never set."""
+    sef = ef.sum(axis=0)
+    return ef.drop(columns=sef[sef == 0].index)
+
+
+def iter_breakdowns(contexts, context, frac, min_support):
+    """
+    Generates the popular-tag breakdowns shown by the digest, in
+    pre-order, as (context, frac, tags, percentages) tuples, where frac is
+    the fraction of all hours in the context.
+
+    Summaries are looked up in contexts (a ContextTree or
+    cube.CubeContexts, whose leaves are passed on to select_breakdown);
+    sub-contexts with at least min_support of all hours are recursed
+    into.
+    """
+    summary = contexts.summary(context)
+    if summary is None:
+        # base case
+        return
+
+    context_support = min_support / frac
+    max_values = math.ceil(1 / context_support)
+    ranked_tags, percentages = select_breakdown(
+        summary, context, context_support, max_values, contexts.leaves
+    )
+
+    if list(ranked_tags) == ["<unk>"] or not len(percentages):
+        return
+
+    yield context, frac, ranked_tags, percentages
+
+    for percent, tag in zip(percentages, ranked_tags):
+        if percent >= min_support:
+            yield from iter_breakdowns(
+                contexts, context + [tag], frac * percent, min_support
+            )
+
+
+class ContextTree:
+    """
+    Memoized tree of contexts over a fixed df, ef pair.
+
+    Each child context is computed from its parent's already-narrowed
+    subset, so looking up a context of depth d only scans the rows of
+    its d ancestors (once each, across all lookups), rather than
+    re-filtering the full frames by every tag in the context.
+
+    If maxsize is set, at most that many contexts (besides the root)
+    are kept, evicting the least recently used ones; an evicted context
+    is recomputed from its closest cached ancestor when needed again.
+
+    Lookups are thread-safe, so contexts can be computed ahead of time
+    by a Prefetcher; a context asked for while another thread computes
+    it waits for that thread's result rather than computing it again.
+    """
+
+    def __init__(self, df, ef, maxsize=None):
+        self._root = (df, prune(ef))
+        # the summaries which aren't paths (see hierarchy)
+        self.leaves = summary_leaves(df)
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._nodes = OrderedDict()
+        self._summaries = OrderedDict()
+        self._cooccurrences = OrderedDict()
+        # Futures of the values being computed, by (cache name, context)
+        self._computing = {}
+
+    def get(self, context):
+        """
+        Returns the df, ef pair for the events in context, an iterable
+        of tags, or None, None if the context is not narrowable.
+        """
+        context = tuple(context)
+        if not context:
+            return self._root
+
+        def _narrow():
+            parent_df, parent_ef = self.get(context[:-1])
+            return narrow(parent_df, parent_ef, context[-1], self.leaves)
+
+        return self._memoized("nodes", context, _narrow)
+
+    def summary(self, context):
+        """
+        Returns the memoized ContextSummary for context, or None if the
+        context is not narrowable.
+        """
+        context = tuple(context)
+
+        def _summarize():
+            cdf, cef = self.get(context)
+            # not narrowable contexts are memoized as False
+            return False if cdf is None else summarize(cdf, cef)
+
+        return self._memoized("summaries", context, _summarize) or None
+
+    def cooccurrence(self, context):
+        """
+        Returns the memoized cooccur.Cooccurrence of the events in
+        context, or None if the context is not narrowable.
+        """
+        context = tuple(context)
+
+        def _cooccurrence():
+            cdf, _ = self.get(context)
+            # not narrowable contexts are memoized as False
+            return False if cdf is None else cooccurrence(cdf)
+
+        matrix = self._memoized("cooccurrences", context, _cooccurrence)
+        return None if matrix is False else matrix
+
+    def _memoized(self, name, context, compute):
+        """
+        Returns the value of context in the cache self._<name>, calling
+        compute for it if it's missing, unless another thread already
+        is, in which case its value (or exception) is awaited.
+        """
+        cache = getattr(self, "_" + name)
+        key = (name, context)
+        with self._lock:
+            value = cache.get(context)
+            if value is not None:
+                cache.move_to_end(context)
+                return value
+            future = self._computing.get(key)
+            if future is None:
+                future = self._computing[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._computing[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            cache[context] = value
+            cache.move_to_end(context)
+            while self._maxsize is not None and len(cache) > self._maxsize:
+                cache.popitem(last=False)
+            del self._computing[key]
+        future.set_result(value)
+        return value
+
+    def __len__(self):
+        return len(self._nodes) + 1
+
+
+class RangeContexts:
+    """
+    ContextTrees over the events of any range of a fixed store df,
+    found with an interval.RangeSlicer.
+
+    All ranges share one exploded tag matrix, to which only the events
+    not in any previous range are added, so switching to a range which
+    was (mostly) seen before costs a row selection, not an explode.
+    maxsize is passed on to each ContextTree.
+    """
+
+    def __init__(self, df, maxsize=None):
+        self._df = df
+        self._maxsize = maxsize
+        self._slicer = RangeSlicer(df)
+        # tag rows by position in df, for the positions exploded so far
+        self._ef = pd.DataFrame(index=pd.Index([], dtype=np.int64))
+        self._exploded = np.zeros(len(df), dtype=bool)
+
+    def contexts(self, from_time, to_time):
+        """
+        Returns a ContextTree over the events intersecting the range
+        from_time to to_time, as filter_range and explode would.
+        """
+        rows = self._slicer.rows(from_time, to_time)
+        missing = rows[~self._exploded[rows]]
+        if len(missing):
+            ef = explode(self._df.iloc[missing])
+            ef.index = missing
+            self._ef = pd.concat([self._ef, ef]).fillna(False).astype(bool)
+            self._exploded[missing] = True
+        df = self._df.iloc[rows]
+        ef = self._ef.loc[rows]
+        ef.index = df.index
+        return ContextTree(df, ef, self._maxsize)
+
+    def extend(self, df):
+        """Adds the events df to the store, as if it had them all along."""
+        self._df = pd.concat([self._df, df])
+        self._slicer = RangeSlicer(self._df)
+        self._exploded = np.append(
+            self._exploded, np.zeros(len(df), dtype=bool)
+        )
+
+
+class Prefetcher:
+    """
+    Computes context summaries on a background daemon thread, so they're
+    already cached by the time they are asked for.
+
+    Each call to prefetch replaces whatever was still pending from the
+    previous one, so only the latest requests are worked on.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def prefetch(self, contexts, keys):
+        """
+        Asynchronously computes the summary in contexts (e.g., a
+        ContextTree) of each context in the iterable keys, in order.
+        """
+        with self._cond:
+            self._pending = [(contexts, list(key)) for key in keys]
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                contexts, key = self._pending.pop(0)
+            try:
+                contexts.summary(key)
+            except Exception as e:  # pylint: disable=broad-except
+                # the context is computed again, and the error raised,
+                # if it's ever asked for in the foreground
+                log.debug("prefetching context {} failed: {!r}", key, e)
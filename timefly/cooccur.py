@@ -0,0 +1,120 @@
+"""
+Tag co-occurrence: how many hours each pair of tags share, i.e., the
+total duration of the events carrying both.
+
+This is the product E^T W E of the event-by-tag incidence matrix E and
+the diagonal matrix W of event durations, which is very sparse: only
+tags appearing on the same event are ever paired. Rather than multiply
+a dense exploded tag matrix, events are first grouped by their distinct
+tag sets (as tag sets are interned, there are few of those), and the
+product is accumulated in coordinate form over each set's tag pairs,
+then kept in compressed sparse rows.
+
+Tags are counted as in hierarchy.event_tags, so summaries and the ancestors
+of hierarchical tags have rows of their own.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .hierarchy import event_tags, lineage, summary_leaves
+
+
+class Cooccurrence:
+    """
+    The symmetric tag-by-tag matrix of shared hours of some events, in
+    compressed sparse rows: the tags sharing hours with names[i] are
+    names[indices[indptr[i]:indptr[i + 1]]], with the corresponding
+    hours; the diagonal holds each tag's own hours. The summaries
+    leaves aren't paths (see hierarchy.summary_leaves).
+    """
+
+    def __init__(self, names, indptr, indices, hours, leaves=frozenset()):
+        self.names = names
+        self.indptr = indptr
+        self.indices = indices
+        self.hours = hours
+        self.leaves = leaves
+        self._codes = {name: i for i, name in enumerate(names)}
+
+    def __contains__(self, tag):
+        return tag in self._codes
+
+    def __len__(self):
+        return len(self.names)
+
+    def tag_hours(self, tag):
+        """Returns the total hours of the events tagged tag."""
+        if tag not in self._codes:
+            return 0.0
+        i = self._codes[tag]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return float(self.hours[lo:hi][self.indices[lo:hi] == i].sum())
+
+    def related(self, tag):
+        """
+        Returns the tags co-occurring with tag (other than tag, its
+        ancestors and its descendants), as an index, and the hours each
+        shares with tag, both in decreasing order of hours.
+        """
+        if tag not in self._codes:
+            return pd.Index([]), np.zeros(0)
+        i = self._codes[tag]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        ancestors = set(lineage(tag, self.leaves))
+        keep = np.array(
+            [
+                name not in ancestors
+                and tag not in lineage(name, self.leaves)
+                for name in self.names[self.indices[lo:hi]]
+            ],
+            dtype=bool,
+        )
+        codes, hours = self.indices[lo:hi][keep], self.hours[lo:hi][keep]
+        order = np.argsort(-hours, kind="stable")
+        return pd.Index(self.names[codes[order]]), hours[order]
+
+
+def cooccurrence(df):
+    """Returns the Cooccurrence of the tags of the events df."""
+    keys = pd.Series(list(zip(df.tags, df.summary)), dtype=object)
+    key_codes, distinct = pd.factorize(keys)
+    set_hours = np.bincount(
+        key_codes,
+        weights=df.duration_hours.values.astype(float),
+        minlength=len(distinct),
+    )
+
+    # the tag codes of each distinct set, as a ragged array: those of
+    # set k are codes[offsets[k]:offsets[k] + counts[k]]
+    names = {}
+    codes = []
+    counts = np.empty(len(distinct), dtype=np.int64)
+    for k, key in enumerate(distinct):
+        tags = sorted(event_tags(*key))
+        counts[k] = len(tags)
+        codes.extend(names.setdefault(tag, len(names)) for tag in tags)
+    codes = np.array(codes, dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+
+    # every ordered pair of tags of each set, weighted by its hours
+    npairs = counts**2
+    pair_sets = np.repeat(np.arange(len(distinct)), npairs)
+    within = np.arange(npairs.sum()) - np.repeat(
+        np.cumsum(npairs) - npairs, npairs
+    )
+    sizes = counts[pair_sets]
+    rows = codes[offsets[pair_sets] + within // sizes]
+    cols = codes[offsets[pair_sets] + within % sizes]
+    ntags = max(len(names), 1)
+    pairs, inverse = np.unique(rows * ntags + cols, return_inverse=True)
+    hours = np.bincount(inverse, weights=set_hours[pair_sets])
+
+    indptr = np.searchsorted(pairs // ntags, np.arange(len(names) + 1))
+    return Cooccurrence(
+        np.array(list(names), dtype=object),
+        indptr,
+        pairs % ntags,
+        hours,
+        summary_leaves(df),
+    )
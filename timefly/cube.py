@@ -0,0 +1,500 @@
+"""
+A precomputed "cube" of popular-tag breakdowns.
+
+digest and drill both repeatedly ask for the popular-tag breakdown
+(see tags.rank_by_popular_tag) of a context, a set of tags. For a fixed
+range and filter, the breakdown of a context doesn't depend on the
+order in which its tags were chosen, so we can mine every context whose
+weighted support (fraction of all event hours carrying all of its tags)
+is at least some minimum, and save their summaries to a compact file.
+
+Weighted support is anti-monotone (adding a tag can only remove hours),
+so an Apriori-style depth-first pass that only extends frequent
+contexts, with tags in a canonical order, visits each frequent context
+exactly once.
+
+Every breakdown only depends on the events through the hours and event
+counts of each distinct tag set (see chunked.TagSetTotals), so the cube
+mines those totals rather than the events. This also makes it cheap to
+keep up to date (see update_cube): when events change, only the
+contexts whose tag sets' totals changed are summarized again, and the
+coverage of the range is only swept again over the time span the
+changes touch. A cube whose range ends "now" is moved forward in the
+same way, by the events of the time since it was last computed: in
+memory as it is loaded, and on disk as it is refreshed.
+
+The tag co-occurrence of the whole range (see cooccur), which drill's
+"related" command looks up, is likewise computed from the tag-set
+totals, and stored in the cube next to the breakdowns.
+
+The cube remembers which store it was computed from, so readers can
+tell when it is stale; merge and watch refresh it as they change the
+store (see refresh_cube).
+"""
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .chunked import CoverageSweep, TagSetTotals
+from .context import ContextSummary, ContextTree, narrow, prune, summarize
+from .cooccur import Cooccurrence, cooccurrence
+from .hierarchy import lineage, subtree_columns, summary_leaves
+from .interval import filter_range, hrs_bw
+from .recurrence import materialize, touched_range
+from .tags import df_filter
+from .utils import parse_date
+
+CUBE_VERSION = 4
+
+# widens the span of changed events, so that events of no duration at
+# its ends are within it
+_MARGIN = pd.Timedelta(microseconds=1)
+
+
+def cube_spec(begin, end, tag_filter, min_support):
+    """
+    The parameters a cube is computed for, as a dict. begin, end are
+    YYYY-MM-DD (or "now") strings as accepted by utils.parse_date.
+    """
+    return {
+        "begin": begin,
+        "end": end,
+        "filter": tag_filter or None,
+        "min_support": min_support,
+    }
+
+
+def _events(df, from_time, to_time):
+    """The events of the store df intersecting the range."""
+    if from_time >= to_time:
+        return df.iloc[:0]
+    df = materialize(df, from_time, to_time)
+    return filter_range(df, from_time, to_time)
+
+
+def _uncovered_hours(events, from_time, to_time):
+    """
+    The hours of the range not covered by any of the events, which are
+    those intersecting it (the whole range if there are none).
+    """
+    if from_time >= to_time:
+        return 0.0
+    if not len(events):
+        return hrs_bw(from_time, to_time)
+    sweep = CoverageSweep(from_time, to_time)
+    sweep.add(events.sort_values("start", kind="stable"))
+    return sweep.uncovered_hours
+
+
+def mine(df, ef, min_support, known=None, leaves=frozenset()):
+    """
+    Weighted frequent-itemset pass over the tag matrix ef.
+
+    Returns a dict from every context (as a tuple of tags in ef's column
+    order) whose hours are at least min_support of df's total hours to
+    that context's ContextSummary. The summaries of the contexts (as
+    frozensets of tags) in the dict known are taken from it rather than
+    recomputed. leaves are the summaries of df which aren't paths (see
+    hierarchy.summary_leaves).
+    """
+    ef = prune(ef)
+    rank = {tag: i for i, tag in enumerate(ef.columns)}
+    threshold = min_support * df.duration_hours.values.astype(float).sum()
+    nodes = {}
+    stack = [((), df, ef)]
+    while stack:
+        context, cdf, cef = stack.pop()
+        summary = known.get(frozenset(context)) if known else None
+        nodes[context] = summary or summarize(cdf, cef)
+        # hours of every one-tag extension at once
+        weights = cdf.duration_hours.values.astype(float) @ cef.values
+        last = rank[context[-1]] if context else -1
+        for tag, weight in zip(cef.columns, weights):
+            if rank[tag] > last and weight >= threshold:
+                cdf_ext, cef_ext = narrow(cdf, cef, tag, leaves)
+                stack.append((context + (tag,), cdf_ext, cef_ext))
+    return nodes
+
+
+def build_cube(df, spec, fingerprint=None):
+    """
+    Computes the cube (a plain dict, see save_cube) for the store df
+    under the given spec. fingerprint identifies the store file,
+    see store_fingerprint.
+    """
+    from_time = parse_date(spec["begin"], start_of_day=True)
+    to_time = parse_date(spec["end"], start_of_day=False)
+    events = _events(df, from_time, to_time)
+    totals = TagSetTotals()
+    totals.add(events)
+    header = {
+        "from_time": from_time,
+        "to_time": to_time,
+        # as with interval.find_intervals, a range without events has
+        # no uncovered hours
+        "uncovered_hrs": (
+            _uncovered_hours(events, from_time, to_time)
+            if len(events)
+            else 0.0
+        ),
+        "range_hrs": hrs_bw(from_time, to_time),
+    }
+    df, ef, header, stripped = _frame(spec, totals, header)
+    leaves = summary_leaves(df)
+    nodes = mine(df, ef, spec["min_support"], leaves=leaves)
+    return _encode(
+        spec, fingerprint, header, df, ef, nodes, totals, stripped, leaves
+    )
+
+
+def _frame(spec, totals, header, quiet=False):
+    """
+    Returns the df, ef pair of the tag sets of the TagSetTotals totals
+    which the filter of spec keeps (see tags.df_filter, to which quiet
+    is passed on), the header dict completed with the kept fraction of
+    events and number of tags, and the sorted list of the tags which the
+    filter removed from ef.
+    """
+    df, ef = totals.frame()
+    columns = ef.columns
+    if spec["filter"] and len(df):
+        df, ef = df_filter(df, ef, spec["filter"], quiet=quiet)
+    header = dict(
+        header,
+        keep_frac=(
+            df.events.sum() / totals.events
+            if spec["filter"] and totals.events
+            else None
+        ),
+        ntags=len(ef.columns),
+    )
+    return df, ef, header, sorted(columns.difference(ef.columns))
+
+
+def _encode(
+    spec, fingerprint, header, df, ef, nodes, totals, stripped, leaves
+):
+    """
+    Returns the cube of the given spec, fingerprint and header, for the
+    mined nodes over the df, ef pair of the TagSetTotals totals, from
+    which the filter removed the tags stripped, and whose summaries
+    leaves aren't paths.
+    """
+    vocab = list(prune(ef).columns) + ["<unk>"]
+    codes = {tag: i for i, tag in enumerate(vocab)}
+    matrix = cooccurrence(df)
+    encoded = {}
+    for context, summary in nodes.items():
+        encoded[tuple(codes[tag] for tag in context)] = (
+            summary.hours,
+            summary.events,
+            summary.ntags,
+            np.array([codes[tag] for tag in summary.tags], dtype=np.int32),
+            summary.tag_hours,
+        )
+    return {
+        "version": CUBE_VERSION,
+        "spec": spec,
+        "fingerprint": fingerprint,
+        "header": header,
+        "vocab": vocab,
+        "nodes": encoded,
+        "totals": totals.totals,
+        "stripped": stripped,
+        "leaves": sorted(leaves),
+        # the arrays of the cooccur.Cooccurrence of the range
+        "cooccurrence": (
+            matrix.names,
+            matrix.indptr,
+            matrix.indices,
+            matrix.hours,
+        ),
+    }
+
+
+def _decode(cube):
+    """
+    Returns the dict from each context of the cube, as a frozenset of
+    tags, to its ContextSummary.
+    """
+    vocab = np.array(cube["vocab"], dtype=object)
+    return {
+        frozenset(vocab[list(key)]): ContextSummary(
+            hours, events, ntags, pd.Index(vocab[codes]), tag_hours
+        )
+        for key, (hours, events, ntags, codes, tag_hours) in cube[
+            "nodes"
+        ].items()
+    }
+
+
+def update_cube(cube, previous, df, changed, to_time, fingerprint=None):
+    """
+    Returns the cube computed from the store previous brought up to date
+    with the store df, in which the events of the index changed were
+    added or changed (see store.merge_events), and with its range ending
+    at to_time, along with the number of contexts summarized anew.
+
+    The tag-set totals are recounted, which is a single vectorized pass
+    over the events of the range (and keeps the order of the tag sets,
+    which breaks ties in popularity, that of a fresh build). Only the
+    contexts some of whose tag sets changed are summarized again, and
+    the uncovered hours are updated from the events intersecting the
+    span touched by the changes (and the time between the old and new
+    ends of the range). The co-occurrence is recomputed from the totals,
+    whose distinct tag sets are few.
+    """
+    header = cube["header"]
+    from_time, old_to = header["from_time"], header["to_time"]
+    spans = [touched_range(previous, changed), touched_range(df, changed)]
+    spans = [span for span in spans if span is not None]
+    if to_time != old_to:
+        spans.append((min(old_to, to_time), max(old_to, to_time)))
+    if not spans:
+        return dict(cube, fingerprint=fingerprint), 0
+    lo = max(min(span[0] for span in spans) - _MARGIN, from_time)
+    hi = min(max(span[1] for span in spans) + _MARGIN, max(old_to, to_time))
+    if lo >= hi:
+        return dict(cube, fingerprint=fingerprint), 0
+
+    totals = TagSetTotals()
+    totals.add(_events(df, from_time, to_time))
+    # coverage is additive over the parts of the range outside and
+    # within the span, and only the latter changed
+    if not totals.events:
+        uncovered = 0.0
+    elif not cube["totals"]:
+        events = _events(df, from_time, to_time)
+        uncovered = _uncovered_hours(events, from_time, to_time)
+    else:
+        uncovered = (
+            header["uncovered_hrs"]
+            - _uncovered_hours(
+                _events(previous, lo, min(hi, old_to)), lo, min(hi, old_to)
+            )
+            + _uncovered_hours(
+                _events(df, lo, min(hi, to_time)), lo, min(hi, to_time)
+            )
+        )
+    header = {
+        "from_time": from_time,
+        "to_time": to_time,
+        "uncovered_hrs": uncovered,
+        "range_hrs": hrs_bw(from_time, to_time),
+    }
+
+    before, after = cube["totals"], totals.totals
+    changed_sets = [
+        {tag for tag in tags.union([summary]) if tag}
+        for (tags, summary) in set(before) | set(after)
+        if before.get((tags, summary)) != after.get((tags, summary))
+    ]
+    spec = cube["spec"]
+    df, ef, header, stripped = _frame(spec, totals, header, quiet=True)
+    known = {}
+    # the other contexts are unchanged, unless the filter now removes
+    # other tags, a summary became or stopped being a path, or the tags
+    # were reordered, which may break ties in popularity differently
+    leaves = summary_leaves(df)
+    old_order, new_order = cube["vocab"][:-1], list(prune(ef).columns)
+    if (
+        stripped == cube["stripped"]
+        and cube["leaves"] == sorted(leaves)
+        and [tag for tag in old_order if tag in set(new_order)]
+        == [tag for tag in new_order if tag in set(old_order)]
+    ):
+        known = {
+            context: summary
+            for context, summary in _decode(cube).items()
+            if not any(
+                all(subtree_columns(tags, tag, leaves) for tag in context)
+                for tags in changed_sets
+            )
+        }
+    nodes = mine(df, ef, spec["min_support"], known, leaves)
+    recomputed = sum(frozenset(context) not in known for context in nodes)
+    cube = _encode(
+        spec, fingerprint, header, df, ef, nodes, totals, stripped, leaves
+    )
+    return cube, recomputed
+
+
+def store_fingerprint(path):
+    """Identifies the current version of the store file at path."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def save_cube(cube, path):
+    """
+    Writes the cube dict to path, atomically, so that readers never see
+    a partly written file.
+    """
+    tmp = path + ".tmp"
+    pd.to_pickle(cube, tmp)
+    os.replace(tmp, path)
+
+
+def load_cube(path, running_events=None, spec=None, to_time=None):
+    """
+    Loads the cube at path, returning None if it does not exist.
+
+    If running_events is specified, also returns None if the cube was
+    computed from a different version of that store; if spec is,
+    returns None unless the cube covers the same range and filter.
+
+    If to_time is specified, also returns None unless the cube's range
+    ends at to_time, except that a cube whose range ends "now" is moved
+    to end at to_time instead, from the events of running_events (see
+    update_cube). The cube is only moved in memory: loading never writes
+    the file, which only main/cube.py and refresh_cube do.
+    """
+    if not os.path.exists(path):
+        return None
+    cube = pd.read_pickle(path)
+    if cube.get("version") != CUBE_VERSION:
+        return None
+    if running_events is not None:
+        if not os.path.exists(running_events):
+            return None
+        if cube["fingerprint"] != store_fingerprint(running_events):
+            return None
+    if spec is not None:
+        for key in ["begin", "end", "filter"]:
+            if cube["spec"][key] != spec[key]:
+                return None
+    if to_time is not None and cube["header"]["to_time"] != to_time:
+        if cube["spec"]["end"] != "now" or running_events is None:
+            return None
+        df = pd.read_pickle(running_events)
+        cube, _ = update_cube(
+            cube, df, df, df.index[:0], to_time, cube["fingerprint"]
+        )
+    return cube
+
+
+class CubeContexts:
+    """
+    Serves ContextSummary lookups (with the same interface as
+    context.ContextTree.summary) out of a cube.
+
+    Contexts which weren't frequent enough to be mined are computed
+    by a ContextTree built on first use by the zero-argument callable
+    fallback, if provided. So are the co-occurrences of any context
+    but that of the whole range, which is stored in the cube.
+    """
+
+    def __init__(self, cube, fallback=None):
+        self._vocab = np.array(cube["vocab"], dtype=object)
+        self._codes = {tag: i for i, tag in enumerate(cube["vocab"][:-1])}
+        self._nodes = cube["nodes"]
+        self._fallback = fallback
+        self._tree = None
+        self._lock = threading.Lock()
+        # contexts of ancestors of hierarchical tags aren't mined
+        self.leaves = frozenset(cube["leaves"])
+        self._ancestors = {
+            name
+            for tag in self._codes
+            for name in lineage(tag, self.leaves)[:-1]
+        }
+        self._cooccurrence = Cooccurrence(*cube["cooccurrence"], self.leaves)
+
+    def summary(self, context):
+        """
+        Returns the ContextSummary for context, or None if the context
+        is not narrowable.
+        """
+        if any(tag not in self._codes for tag in context):
+            if all(
+                tag in self._codes or tag in self._ancestors
+                for tag in context
+            ):
+                return self._fallback_summary(context)
+            return None
+        key = tuple(sorted(self._codes[tag] for tag in context))
+        if key in self._nodes:
+            hours, events, ntags, codes, tag_hours = self._nodes[key]
+            return ContextSummary(
+                hours,
+                events,
+                ntags,
+                pd.Index(self._vocab[codes]),
+                tag_hours,
+            )
+        return self._fallback_summary(context)
+
+    def cooccurrence(self, context):
+        """
+        Returns the cooccur.Cooccurrence of the events in context, or
+        None if the context is not narrowable (or there's no fallback).
+        """
+        if not context:
+            return self._cooccurrence
+        tree = self._fallback_tree()
+        if tree is None:
+            return None
+        return tree.cooccurrence(context)
+
+    def get(self, context):
+        """
+        Returns the df, ef pair of the events in context from the
+        fallback ContextTree, or None, None if there's no fallback.
+        """
+        tree = self._fallback_tree()
+        if tree is None:
+            return None, None
+        return tree.get(context)
+
+    def _fallback_summary(self, context):
+        tree = self._fallback_tree()
+        if tree is None:
+            return None
+        return tree.summary(context)
+
+    def _fallback_tree(self):
+        if self._fallback is None:
+            return None
+        with self._lock:
+            if self._tree is None:
+                self._tree = self._fallback()
+        return self._tree
+
+
+def refresh_cube(
+    path, running_events, df, changed, previous=None, previous_fingerprint=None
+):
+    """
+    Brings the cube at path up to date after the store at running_events
+    was rewritten with the events df, in which the events of the index
+    changed were added or changed, moving the end of its range to the
+    current time if it ends "now".
+
+    previous is the store before the changes, and previous_fingerprint
+    the store_fingerprint of its file: if given, and the cube was
+    computed from that version of the store, it is updated (see
+    update_cube); otherwise, it is rebuilt.
+
+    Returns the number of contexts summarized anew, or None if there is
+    no cube.
+    """
+    cube = load_cube(path)
+    if cube is None:
+        return None
+    spec = cube["spec"]
+    fingerprint = store_fingerprint(running_events)
+    if previous is None or cube["fingerprint"] != previous_fingerprint:
+        cube = build_cube(df, spec, fingerprint)
+        recomputed = len(cube["nodes"])
+    else:
+        to_time = cube["header"]["to_time"]
+        if spec["end"] == "now":
+            to_time = parse_date("now", start_of_day=False)
+        cube, recomputed = update_cube(
+            cube, previous, df, changed, to_time, fingerprint
+        )
+    save_cube(cube, path)
+    return recomputed
@@ -0,0 +1,178 @@
+"""
+Hierarchical, path-style tags.
+
+A tag such as [work/coding] is a child of the tag work, whether or not
+any event is tagged work itself, so events need only carry their most
+specific tags: everything about an ancestor is derived from its
+descendants. In particular:
+
+    * A context or filter naming an ancestor matches the events carrying
+      any tag in its subtree (see subtree_columns).
+    * Breakdowns show each tag rolled up to its shallowest ancestor not
+      already in the context (see rollup): the top level of a digest
+      shows work, and drilling into work shows work/coding and
+      work/review.
+
+Tags are split on "/"; a tag with an empty path component (such as
+"1/" or "a//b") is not treated as a path. Neither is an event summary
+(which tags.explode makes a tag of its own), such as "lunch w/ bob" or
+"3/14 sync", unless some event also carries it as a [tag]: the
+functions below take the set of such names, the leaves of the data
+(see summary_leaves), and keep each of them a single leaf.
+"""
+
+import numpy as np
+import pandas as pd
+
+SEP = "/"
+
+
+def summary_leaves(df):
+    """
+    Returns the frozenset of the summaries of the events df (with tags
+    and summary columns) which contain SEP but aren't any event's tag,
+    so are not paths.
+    """
+    summaries = {
+        summary
+        for summary in pd.unique(np.asarray(df.summary, dtype=object))
+        if isinstance(summary, str) and SEP in summary
+    }
+    if not summaries:
+        return frozenset()
+    return frozenset(summaries.difference(*set(df.tags)))
+
+
+def path(tag, leaves=frozenset()):
+    """
+    Returns the list of path components of tag, which is just tag if it
+    is one of the set leaves.
+    """
+    if tag in leaves:
+        return [tag]
+    parts = tag.split(SEP)
+    if not all(parts):
+        return [tag]
+    return parts
+
+
+def lineage(tag, leaves=frozenset()):
+    """Returns the ancestors of tag, from the root, followed by tag."""
+    parts = path(tag, leaves)
+    return [SEP.join(parts[: i + 1]) for i in range(len(parts))]
+
+
+def event_tags(tags, summary):
+    """
+    Returns the set of tags an event with the given tags and summary
+    counts towards: those of tags.explode, and all the ancestors of its
+    tags. The summary is never taken for a path.
+    """
+    names = set()
+    for tag in tags:
+        if tag:
+            names.update(lineage(tag))
+    if isinstance(summary, str) and summary:
+        names.add(summary)
+    return names
+
+
+class TagTree:
+    """
+    The forest of the tags given and all their ancestors, as a parent
+    index: names[i] is the i-th node, parent[i] the position of its
+    parent (-1 for roots), and position[j] the node of the j-th tag
+    given. The tags in the set leaves have no ancestors.
+    """
+
+    def __init__(self, tags, leaves=frozenset()):
+        self.index = {}
+        self.position = np.empty(len(tags), dtype=np.int64)
+        for j, tag in enumerate(tags):
+            for name in lineage(tag, leaves):
+                self.index.setdefault(name, len(self.index))
+            self.position[j] = self.index[tag]
+        names = list(self.index)
+        self.names = np.array(names, dtype=object)
+        self.parent = np.array(
+            [
+                self.index[lineage(name, leaves)[-2]]
+                if len(path(name, leaves)) > 1
+                else -1
+                for name in names
+            ],
+            dtype=np.int64,
+        )
+        self.depth = np.array(
+            [len(path(name, leaves)) - 1 for name in names]
+        )
+
+    def rollup(self, values):
+        """
+        Given a value for each tag the tree was built from, returns the
+        total of every node: its own value plus its children's totals,
+        accumulated bottom-up one level at a time.
+        """
+        totals = np.zeros(len(self.names))
+        np.add.at(totals, self.position, values)
+        for depth in range(self.depth.max(initial=0), 0, -1):
+            nodes = np.flatnonzero(self.depth == depth)
+            np.add.at(totals, self.parent[nodes], totals[nodes])
+        return totals
+
+
+def is_hierarchical(tags, leaves=frozenset()):
+    """Whether any of the tags is a path."""
+    return any(len(path(tag, leaves)) > 1 for tag in tags)
+
+
+def rollup(tags, hours, context=(), leaves=frozenset()):
+    """
+    Given the tags (an index) and hours of a popular-tag breakdown (see
+    tags.popular_tag_hours), rolls each tag's hours up to its shallowest
+    ancestor (or itself) which isn't in the list of tags context.
+
+    Returns the resulting tags, as an index in order of first appearance,
+    and their hours; tags and hours are returned as-is if no tag is
+    a path.
+    """
+    if not is_hierarchical(tags, leaves):
+        return tags, hours
+    tree = TagTree(tags, leaves)
+    totals = tree.rollup(hours)
+    context = set(context)
+    targets = []
+    for tag in tags:
+        names = lineage(tag, leaves)
+        target = next((name for name in names if name not in context), tag)
+        targets.append(tree.index[target])
+    targets = list(dict.fromkeys(targets))
+    return pd.Index(tree.names[targets]), totals[targets]
+
+
+def rollup_codes(names, codes, leaves=frozenset()):
+    """
+    Given the names and codes returned by tags.popular_tag_codes, maps
+    each tag to its root ancestor, returning the root names (in order
+    of first appearance) and each row's root code.
+    """
+    if not is_hierarchical(names, leaves):
+        return names, codes
+    root_codes, roots = pd.factorize(
+        np.array([path(name, leaves)[0] for name in names], dtype=object)
+    )
+    return np.asarray(roots, dtype=object), root_codes[codes]
+
+
+def subtree_columns(columns, tag, leaves=frozenset()):
+    """
+    Returns the list of the columns (tag names) which are tag or one of
+    its descendants.
+    """
+    prefix = tag + SEP
+    return [
+        column
+        for column in columns
+        if column == tag
+        or (column.startswith(prefix) and len(path(column, leaves)) > 1)
+    ]
@@ -7,9 +7,18 @@ import itertools
 import operator
 from types import SimpleNamespace
 
+import numpy as np
+import pandas as pd
+
+from . import log
 from .utils import splat
 
+# pandas offset aliases for the supported bucket sizes; weeks start
+# on Mondays and months on the first.
+BUCKET_FREQS = {"day": "D", "week": "W-MON", "month": "MS"}
+
 
+@log.stage("find_intervals")
 def find_intervals(df, from_time, to_time):
     """
     Given a dataframe with unique interval indices,
@@ -105,6 +114,7 @@ def find_intervals(df, from_time, to_time):
     return uncovered, overlaps
 
 
+@log.stage("filter_range")
 def filter_range(df, from_time, to_time):
     """
     Filter a dataframe of intervals with start and end members
@@ -124,3 +134,92 @@ def hrs_bw(begin, end):
     the beginning and the end events.
     """
     return (end - begin).total_seconds() / 3600
+
+
+def epoch_ns(times):
+    """
+    Converts a series, index, or list of tz-aware timestamps
+    to an int64 array of nanoseconds since the UTC epoch.
+    """
+    times = pd.to_datetime(pd.Series(times), utc=True)
+    return times.values.astype("datetime64[ns]").astype(np.int64)
+
+
+def bucket_edges(from_time, to_time, bucket):
+    """
+    Returns the sorted python datetimes splitting the range between
+    from_time and to_time into buckets of the given size (one of the keys
+    of BUCKET_FREQS), aligned to midnights in the current timezone.
+    The first and last edges are from_time and to_time.
+    """
+    tz = from_time.astimezone().tzinfo
+    start = pd.Timestamp(from_time).tz_convert(tz).normalize()
+    end = pd.Timestamp(to_time).tz_convert(tz)
+    inner = pd.date_range(start, end, freq=BUCKET_FREQS[bucket])
+    inner = [t.to_pydatetime() for t in inner if from_time < t < to_time]
+    return [from_time] + inner + [to_time]
+
+
+def split_by_buckets(starts, ends, edges):
+    """
+    Splits intervals across bucket boundaries without a python loop.
+
+    starts, ends, and the sorted bucket edges are int64 arrays (e.g., of
+    epoch_ns). Returns arrays rows, buckets, hours such that the i-th
+    piece is the part of interval rows[i] in the bucket between
+    edges[buckets[i]] and edges[buckets[i] + 1], hours[i] long.
+    Parts of intervals outside the edges are dropped.
+    """
+    starts = np.clip(starts, edges[0], edges[-1])
+    ends = np.clip(ends, edges[0], edges[-1])
+    first = np.searchsorted(edges, starts, side="right") - 1
+    last = np.searchsorted(edges, ends, side="left") - 1
+    counts = np.maximum(last - first + 1, 0)
+
+    rows = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(
+        np.cumsum(counts) - counts, counts
+    )
+    buckets = np.repeat(first, counts) + offsets
+    lo = np.maximum(starts[rows], edges[buckets])
+    hi = np.minimum(ends[rows], edges[buckets + 1])
+    return rows, buckets, (hi - lo) / 3.6e12
+
+
+class RangeSlicer:
+    """
+    Finds the events of a fixed dataframe overlapping any given range
+    (with the same semantics as filter_range) by binary search over
+    the event start times, sorted once up front, instead of a full
+    scan of the dataframe per range. The scan begins at the first event,
+    in order of start, by which some event has ended after the range
+    begins, so a query costs the events near the range rather than all
+    of those before it.
+    """
+
+    def __init__(self, df):
+        starts = epoch_ns(df.start)
+        self._order = np.argsort(starts, kind="stable")
+        self._starts = starts[self._order]
+        self._ends = epoch_ns(df.end)[self._order]
+        # the latest end of the events up to each, in order of start
+        self._reach = np.maximum.accumulate(self._ends)
+
+    def rows(self, from_time, to_time):
+        """
+        Returns the sorted int array of the positions (as for iloc) of
+        the events intersecting the interval from_time to to_time.
+        """
+        return self.rows_ns(*epoch_ns([from_time, to_time]))
+
+    def rows_ns(self, from_ns, to_ns):
+        """As rows, with the range in nanoseconds since the UTC epoch."""
+        # events starting before to_time, of which those ending after
+        # from_time intersect the range; none before the first whose
+        # reach passes from_time do
+        first = np.searchsorted(self._reach, from_ns, side="right")
+        before = max(np.searchsorted(self._starts, to_ns, side="left"), first)
+        overlapping = self._order[first:before][
+            self._ends[first:before] > from_ns
+        ]
+        return np.sort(overlapping)
@@ -23,14 +23,33 @@ And then from any other file, run something this:
     debug("Iteration {} of {}", 1, num_iters)
 """
 
-import inspect
+import atexit
+import contextlib
+import functools
+import json
 import logging
 import os
-from datetime import datetime
+import sys
+import threading
+import time
 
 from absl import flags
 
+from .format_utils import indented_list
+
 flags.DEFINE_boolean("verbose", True, "whether to activate logging")
+flags.DEFINE_boolean(
+    "profile",
+    False,
+    "record the wall time and peak memory of each stage (see log.stage) "
+    "and print a summary to stderr on exit",
+)
+flags.DEFINE_string(
+    "profile_out",
+    None,
+    "with --profile, also write cProfile stats to PREFIX.pstats and "
+    "a JSON trace of all stages (for chrome://tracing) to PREFIX.json",
+)
 
 
 class _StackCrawlingFormatter(logging.Formatter):
@@ -43,72 +62,232 @@ class _StackCrawlingFormatter(logging.Formatter):
     of the helper function, not the function which called the helper function.
 
     A _StackCrawlingFormatter is a hack to log a different pathname and line
-    number. Simply set the `pathname` and `lineno` attributes of the formatter
-    before you call `log.debug`. See `debug` below for an example.
+    number. Simply pass the `caller_path` and `caller_lineno` attributes in
+    the `extra` dict of the logging call. See `debug` below for an example.
+    All the work of formatting happens here, so only for records which are
+    actually emitted.
     """
 
-    def __init__(self, format_str):
-        super().__init__(format_str)
-        self.pathname = None
-        self.lineno = None
-
     def format(self, record):
         s = super().format(record)
-        if self.pathname is not None:
-            s = s.replace("{pathname}", self.pathname)
-        if self.lineno is not None:
-            s = s.replace("{lineno}", str(self.lineno))
+        pathname = getattr(record, "caller_path", None)
+        if pathname is not None:
+            s = s.replace("{pathname}", _clean_path(pathname, os.getcwd()))
+        lineno = getattr(record, "caller_lineno", None)
+        if lineno is not None:
+            s = s.replace("{lineno}", str(lineno))
         if "{fmttime}" in s:
-            tztime = datetime.now().astimezone()
-            fmttime = tztime.strftime("%Y-%m-%d %H:%M:%S %Z")
+            fmttime = self.formatTime(record, "%Y-%m-%d %H:%M:%S %Z")
             s = s.replace("{fmttime}", fmttime)
         return s
 
 
+class _Message:
+    """A debug message, only formatted if it is emitted."""
+
+    __slots__ = ["fmt", "args"]
+
+    def __init__(self, fmt, args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+
 _LOGGER = logging.getLogger(__package__)
 _FORMAT_STRING = "[{fmttime} {pathname}:{lineno}] %(message)s"
 _FORMATTER = _StackCrawlingFormatter(_FORMAT_STRING)
 
 
 def init():
-    """Initialize the logger."""
+    """Initialize the logger, and the profiler if --profile is set."""
     handler = logging.StreamHandler()
     handler.setFormatter(_FORMATTER)
     _LOGGER.propagate = False
     _LOGGER.addHandler(handler)
     if flags.FLAGS.verbose:
         _LOGGER.setLevel(logging.DEBUG)
+    if flags.FLAGS.profile:
+        global _PROFILE
+        _PROFILE = _Profile(flags.FLAGS.profile_out)
+        atexit.register(_PROFILE.finish)
 
 
 def debug(s, *args):
-    """debug(s, x1, ..., xn) logs s.format(x1, ..., xn)."""
-    # Get the path name and line number of the function which called us.
-    previous_frame = inspect.currentframe().f_back
-    try:
-        pathname, lineno, _, _, _ = inspect.getframeinfo(previous_frame)
-    except Exception:  # pylint: disable=broad-except
-        pathname = "<UNKNOWN-FILE>.py"
-        lineno = 0
-    _FORMATTER.pathname = _clean_path(pathname)
-    _FORMATTER.lineno = lineno
-    _LOGGER.debug(s.format(*args))
+    """
+    debug(s, x1, ..., xn) logs s.format(x1, ..., xn).
+
+    Nearly free if logging is off: the level is checked before anything
+    else, and the message is only formatted when it is emitted.
+    """
+    if not _LOGGER.isEnabledFor(logging.DEBUG):
+        return
+    # The frame of the function which called us; unlike inspect, this
+    # doesn't read its source file.
+    caller = sys._getframe(1)  # pylint: disable=protected-access
+    _LOGGER.debug(
+        _Message(s, args),
+        extra={
+            "caller_path": caller.f_code.co_filename,
+            "caller_lineno": caller.f_lineno,
+        },
+    )
 
 
-def _clean_path(path):
+@functools.lru_cache(maxsize=None)
+def _clean_path(path, cwd):
     """
-    Simplifies the path for readability.
+    Simplifies the path for readability, relative to the working
+    directory cwd.
     """
-    path = os.path.abspath(path)
+    path = os.path.abspath(os.path.join(cwd, path))
     home = os.path.expanduser("~")
     if os.path.commonpath([path, home]) == home:
         home_path = os.path.join("~", os.path.relpath(path, home))
         home_path = os.path.normpath(home_path)
     else:
         home_path = path
-    cwd = os.getcwd()
     if os.path.commonpath([cwd, path]):
         cwd_path = os.path.join(".", os.path.relpath(path, cwd))
         cwd_path = os.path.normpath(cwd_path)
     else:
         cwd_path = path
     return min(home_path, cwd_path, path, key=len)
+
+
+class _Profile:
+    """
+    The stages recorded under --profile: a list of the completed spans
+    (dicts of the stage name, start and seconds since init, peak traced
+    bytes and thread) in the order they finished, and, for each thread,
+    a stack of those still open on it, so that stages running on a
+    background thread (such as a context.Prefetcher's) nest on their own.
+
+    Traced memory is that of the whole process, so the peak of a stage
+    is the highest it got while the stage was open, on any thread.
+    """
+
+    def __init__(self, out):
+        # only imported when profiling, to keep startup fast
+        import cProfile
+        import tracemalloc
+
+        self.out = out
+        self.spans = []
+        self._local = threading.local()
+        # the open stacks of every thread
+        self._stacks = []
+        self._lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        tracemalloc.start()
+        self.cprofile = None
+        if out:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @property
+    def open(self):
+        """The stack of the stages open on the current thread."""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+            with self._lock:
+                self._stacks.append(stack)
+        return stack
+
+    def fold_peak(self):
+        """
+        Credits the peak traced memory since the last call to every open
+        stage, of every thread, then resets it, so nested stages each get
+        their own peak. Before Python 3.9, which can't reset the peak,
+        stages get the peak since profiling started.
+        """
+        import tracemalloc
+
+        with self._lock:
+            _, peak = tracemalloc.get_traced_memory()
+            for stack in self._stacks:
+                for span in stack:
+                    span["peak"] = max(span["peak"], peak)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+    def finish(self):
+        """Prints the summary table and writes the --profile_out files."""
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        totals = {}
+        for span in self.spans:
+            calls, seconds, peak = totals.get(span["name"], (0, 0, 0))
+            totals[span["name"]] = (
+                calls + 1,
+                seconds + span["seconds"],
+                max(peak, span["peak"]),
+            )
+        pairs = [
+            (
+                name,
+                "{:9.3f} s {:9.1f} MiB peak {:5d} calls".format(
+                    seconds, peak / 2 ** 20, calls
+                ),
+            )
+            for name, (calls, seconds, peak) in totals.items()
+        ]
+        pairs.append(
+            ("total", "{:9.3f} s".format(time.perf_counter() - self.t0))
+        )
+        print(indented_list(title="profile", pairs=pairs), file=sys.stderr)
+        if not self.out:
+            return
+        self.cprofile.dump_stats(self.out + ".pstats")
+        trace = [
+            {
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["seconds"] * 1e6,
+                "pid": os.getpid(),
+                "tid": span["tid"],
+                "args": {"peak_mib": span["peak"] / 2 ** 20},
+            }
+            for span in self.spans
+        ]
+        with open(self.out + ".json", "w") as f:
+            json.dump({"traceEvents": trace}, f)
+
+
+_PROFILE = None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records the wall time and peak memory of the enclosed code as the
+    stage name, if --profile is set (otherwise, does nothing). Works
+    both as a context manager,
+
+        with log.stage("load"):
+            df = pd.read_pickle(path)
+
+    and as a function decorator, @log.stage("explode"). Stages may nest.
+    """
+    if _PROFILE is None:
+        yield
+        return
+    _PROFILE.fold_peak()
+    start = time.perf_counter() - _PROFILE.t0
+    span = {
+        "name": name,
+        "peak": 0,
+        "start": start,
+        "tid": threading.get_ident(),
+    }
+    _PROFILE.open.append(span)
+    try:
+        yield
+    finally:
+        _PROFILE.fold_peak()
+        _PROFILE.open.pop()
+        span["seconds"] = time.perf_counter() - _PROFILE.t0 - span["start"]
+        _PROFILE.spans.append(span)
@@ -0,0 +1,172 @@
+"""
+Generate many reports at once: the store is loaded a single time and
+the jobs of a spec file are fanned out across a pool of processes,
+each writing its report's records to its own file.
+
+The spec file is a JSON list of jobs, such as
+
+    [
+      {"report": "digest", "out": "reports/sisu.jsonl",
+       "begin": "2019-09-01", "filter": "sisu"},
+      {"report": "versus", "out": "reports/monthly.csv",
+       "periods": "month", "begin": "2019-01-01"},
+      {"report": "context", "out": "reports/meetings.jsonl",
+       "begin": "2019-09-01", "tag": ["sisu", "meeting"]}
+    ]
+
+where report is one of the queries of timefly.main.serve, and the other
+keys are its parameters (as sent by timefly.main.query). Reports are
+written as records, in the format given by the job's "output" key, or
+else csv for .csv files and jsonl otherwise.
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from absl import app, flags
+
+from .. import log, output
+from ..format_utils import indented_list
+from ..server import QUERIES, RECORD_FIELDS, QueryError
+from ..store import TimeflyStore
+
+flags.DEFINE_string(
+    "running_events",
+    "./data/running.pkl",
+    "path pointing to the existing store of data",
+)
+flags.DEFINE_string("spec", None, "path to the JSON list of report jobs")
+flags.mark_flag_as_required("spec")
+flags.DEFINE_integer(
+    "jobs",
+    0,
+    "number of processes generating reports in parallel, 0 for all cores",
+    lower_bound=0,
+)
+
+# the store shared by the jobs of a worker process, see _init_worker
+_STORE = None
+
+
+def _main(_argv):
+    log.init()
+    with open(flags.FLAGS.spec) as f:
+        jobs = json.load(f)
+    for i, job in enumerate(jobs):
+        if job.get("report") not in QUERIES:
+            raise app.UsageError(
+                "job {} report must be one of {}".format(i, list(QUERIES))
+            )
+        if "out" not in job:
+            raise app.UsageError("job {} has no out path".format(i))
+
+    store = TimeflyStore.load(flags.FLAGS.running_events)
+    t = time.perf_counter()
+    failed = []
+    results = run_jobs(store, jobs, flags.FLAGS.jobs or None)
+    for job, (nrecords, seconds, error) in zip(jobs, results):
+        if error is None:
+            log.debug(
+                "wrote {} records to {} in {:.2f}s",
+                nrecords,
+                job["out"],
+                seconds,
+            )
+        else:
+            failed.append((job["out"], error))
+    print(
+        indented_list(
+            title="batch {}".format(flags.FLAGS.spec),
+            pairs=[
+                ("reports", len(jobs) - len(failed)),
+                ("failed", len(failed)),
+                ("seconds", "{:.2f}".format(time.perf_counter() - t)),
+            ],
+        )
+    )
+    if failed:
+        print(
+            indented_list(
+                title="failed jobs", indentation_level=1, pairs=failed
+            )
+        )
+        sys.exit(1)
+
+
+def run_jobs(store, jobs, processes=None):
+    """
+    Runs each job dict (see the module docstring) against the
+    TimeflyStore store, on a pool of processes (all cores if None,
+    in-process if 1).
+
+    The tags of the events in each job's range are exploded up front,
+    and worker processes are forked with the store where the platform
+    allows it, so it's shared copy-on-write rather than re-read and
+    re-exploded by every worker.
+
+    Generates a (records, seconds, error) triple for each job, in order,
+    where error is None, or the message of the error the job failed with
+    (such as a QueryError for invalid parameters), in which case its file
+    is not written and the other jobs still run.
+    """
+    for job in jobs:
+        begin = job.get("begin", job.get("start1"))
+        end = job.get("end", job.get("end2", "now"))
+        try:
+            store.events(begin, end)
+        except (TypeError, ValueError):
+            pass  # reported by the job itself
+    if processes == 1:
+        _init_worker(store)
+        yield from map(_run_job, jobs)
+        return
+    with multiprocessing.Pool(processes, _init_worker, (store,)) as pool:
+        yield from pool.imap(_run_job, jobs)
+
+
+def _init_worker(store):
+    global _STORE
+    _STORE = store
+
+
+def _run_job(job):
+    t = time.perf_counter()
+    params = {}
+    for name, value in job.items():
+        if name in ["report", "out", "output"]:
+            continue
+        values = value if isinstance(value, list) else [value]
+        params[name] = [str(v) for v in values]
+    fmt = job.get("output") or (
+        "csv" if job["out"].endswith(".csv") else "jsonl"
+    )
+
+    directory = os.path.dirname(job["out"])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # written under another name and renamed once complete, so that a
+    # failed job leaves no partial report behind
+    tmp = job["out"] + ".tmp"
+    nrecords = 0
+    try:
+        with open(tmp, "w") as out:
+            writer = output.RecordWriter(RECORD_FIELDS, out, fmt=fmt)
+            for record in QUERIES[job["report"]](_STORE, params):
+                writer.write(record)
+                nrecords += 1
+    except Exception as e:  # pylint: disable=broad-except
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        error = str(e)
+        if not isinstance(e, QueryError):
+            error = "{}: {}".format(type(e).__name__, error)
+        return nrecords, time.perf_counter() - t, error
+    os.replace(tmp, job["out"])
+    return nrecords, time.perf_counter() - t, None
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -0,0 +1,336 @@
+"""
+Benchmark every stage of the pipeline on synthetic calendars of
+increasing size, and save the timings and peak memory as JSON, to
+compare across commits (see --baseline).
+
+Calendars are generated by timefly.synthetic, so runs with the same
+flags benchmark exactly the same events.
+
+With --startup, also benchmark the startup time of each command of the
+timefly command line (pass --sizes= to only do that).
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from absl import app, flags
+
+from .. import log
+from ..cli import COMMANDS
+from ..compare import greedy_deltas
+from ..context import ContextTree, iter_breakdowns
+from ..format_utils import indented_list
+from ..interval import filter_range, find_intervals
+from ..schema import compact
+from ..synthetic import synthetic_calendar
+from ..tags import df_filter, explode
+
+flags.DEFINE_list(
+    "sizes",
+    ["1000", "10000", "100000"],
+    "numbers of events in the calendars to benchmark; add 1000000 for "
+    "a full, much slower run",
+)
+flags.DEFINE_integer("years", 4, "years spanned by each calendar")
+flags.DEFINE_integer("ntags", 200, "number of distinct tags")
+flags.DEFINE_float("zipf", 1.1, "Zipf exponent of tag popularity")
+flags.DEFINE_float(
+    "overlap", 0.05, "fraction of events overlapping the next one"
+)
+flags.DEFINE_integer("seed", 0, "random seed of the calendars")
+flags.DEFINE_list(
+    "stages", None, "stages to benchmark (all if unset), see STAGES"
+)
+flags.DEFINE_boolean(
+    "memory",
+    True,
+    "also measure each stage's peak traced memory, in a second "
+    "(untimed) run of the stage under tracemalloc",
+)
+flags.DEFINE_boolean(
+    "startup",
+    False,
+    "benchmark the time to run timefly --help and timefly <command> "
+    "--help for each command, in a fresh interpreter",
+)
+flags.DEFINE_integer(
+    "startup_repeat", 5, "startup times are the best of this many runs"
+)
+flags.DEFINE_string(
+    "out", "./data/bench.json", "path in which to save the results"
+)
+flags.DEFINE_string(
+    "baseline",
+    None,
+    "results of a previous run to compare against, e.g. on another commit",
+)
+
+
+# each stage maps the state dict of the previous stages' results to
+# a dict of new results, without modifying its inputs
+
+
+def _save(state):
+    path = os.path.join(state["tmpdir"], "running.pkl")
+    state["df"].to_pickle(path)
+    return {"path": path}
+
+
+def _load(state):
+    return {"df": pd.read_pickle(state["path"])}
+
+
+def _filter_range(state):
+    # the middle half of the calendar, as a report over some range would
+    df = state["df"]
+    begin, end = df.start.min(), df.end.max()
+    from_time = (begin + (end - begin) / 4).to_pydatetime()
+    to_time = (end - (end - begin) / 4).to_pydatetime()
+    return {
+        "range": (from_time, to_time),
+        "range_df": filter_range(df, from_time, to_time),
+    }
+
+
+def _find_intervals(state):
+    return {"intervals": find_intervals(state["range_df"], *state["range"])}
+
+
+def _explode(state):
+    return {"ef": explode(state["range_df"])}
+
+
+def _df_filter(state):
+    ef = state["ef"]
+    tag = ef.sum().idxmax()
+    df, ef = df_filter(state["range_df"], ef, tag, quiet=True)
+    return {"filtered": (df, ef)}
+
+
+def _breakdown(state):
+    # everything digest computes for its printout
+    contexts = ContextTree(state["range_df"], state["ef"])
+    return {"breakdowns": list(iter_breakdowns(contexts, [], 1.0, 0.025))}
+
+
+def _versus(state):
+    df, ef = state["range_df"], state["ef"]
+    from_time, to_time = state["range"]
+    middle = from_time + (to_time - from_time) / 2
+    prev_df = filter_range(df, from_time, middle)
+    next_df = filter_range(df, middle, to_time)
+    deltas = greedy_deltas(
+        ef.columns.values,
+        ef.loc[prev_df.index].values,
+        prev_df.duration_hours.values,
+        ef.loc[next_df.index].values,
+        next_df.duration_hours.values,
+        0.025,
+    )
+    return {"deltas": list(deltas)}
+
+
+def _merge(state):
+    # as timefly.main.merge does, with the first three quarters of the
+    # calendar as the running store and the last half as the new events
+    df = state["df"]
+    running = df.iloc[: len(df) * 3 // 4]
+    new = df.iloc[len(df) // 2 :]
+    newnew = new.index.difference(running.index)
+    return {"merged": compact(pd.concat([running, new.loc[newnew]]))}
+
+
+STAGES = [
+    ("save", _save),
+    ("load", _load),
+    ("filter_range", _filter_range),
+    ("find_intervals", _find_intervals),
+    ("explode", _explode),
+    ("df_filter", _df_filter),
+    ("breakdown", _breakdown),
+    ("versus", _versus),
+    ("merge", _merge),
+]
+
+
+def _main(_argv):
+    log.init()
+    stages = STAGES
+    if flags.FLAGS.stages:
+        unknown = set(flags.FLAGS.stages) - {name for name, _ in STAGES}
+        if unknown:
+            raise app.UsageError("unknown stages {}".format(sorted(unknown)))
+        # earlier stages are still run, since later ones need their results
+        last = max(
+            i
+            for i, (name, _) in enumerate(STAGES)
+            if name in flags.FLAGS.stages
+        )
+        stages = STAGES[: last + 1]
+
+    baseline = {}
+    if flags.FLAGS.baseline:
+        with open(flags.FLAGS.baseline) as f:
+            for result in json.load(f)["results"]:
+                baseline[result["events"], result["stage"]] = result
+
+    results = []
+    if flags.FLAGS.startup:
+        startup_results = run_startup(flags.FLAGS.startup_repeat)
+        print(format_results(None, startup_results, baseline))
+        results.extend(startup_results)
+
+    for size in map(int, flags.FLAGS.sizes):
+        log.debug("generating a calendar of {} events", size)
+        df = synthetic_calendar(
+            size,
+            years=flags.FLAGS.years,
+            ntags=flags.FLAGS.ntags,
+            zipf=flags.FLAGS.zipf,
+            overlap=flags.FLAGS.overlap,
+            seed=flags.FLAGS.seed,
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            size_results = run_stages(stages, {"df": df, "tmpdir": tmpdir})
+        size_results = [
+            dict(result, events=size)
+            for result in size_results
+            if not flags.FLAGS.stages or result["stage"] in flags.FLAGS.stages
+        ]
+        print(format_results(size, size_results, baseline))
+        results.extend(size_results)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "calendar": {
+            "years": flags.FLAGS.years,
+            "ntags": flags.FLAGS.ntags,
+            "zipf": flags.FLAGS.zipf,
+            "overlap": flags.FLAGS.overlap,
+            "seed": flags.FLAGS.seed,
+        },
+        "results": results,
+    }
+    log.debug("writing results to {}", flags.FLAGS.out)
+    with open(flags.FLAGS.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def run_stages(stages, state):
+    """
+    Runs each (name, stage) in order on the state dict, returning a list
+    of {"stage", "seconds", "peak_mib"} results, the latter None unless
+    --memory is set.
+    """
+    results = []
+    for name, stage in stages:
+        t = time.perf_counter()
+        with log.stage(name):
+            update = stage(state)
+        seconds = time.perf_counter() - t
+
+        peak_mib = None
+        # under --profile, tracemalloc is already busy profiling
+        if flags.FLAGS.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            stage(state)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peak_mib = peak / 2 ** 20
+
+        state.update(update)
+        results.append(
+            {"stage": name, "seconds": seconds, "peak_mib": peak_mib}
+        )
+    return results
+
+
+def run_startup(repeat):
+    """
+    Returns the best-of-repeat wall time of running each command of the
+    timefly command line with --help, and of a bare interpreter, as a
+    list of {"stage", "seconds", "peak_mib", "events"} results.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(root))
+    timefly = [sys.executable, "-m", "timefly"]
+    runs = [("python", [sys.executable, "-c", "pass"])]
+    runs += [("timefly --help", timefly + ["--help"])]
+    runs += [
+        ("timefly {} --help".format(command), timefly + [command, "--help"])
+        for command in COMMANDS
+    ]
+    results = []
+    for name, argv in runs:
+        seconds = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            # absl exits with status 1 after printing --help
+            subprocess.run(
+                argv,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            seconds.append(time.perf_counter() - t)
+        results.append(
+            {
+                "stage": name,
+                "seconds": min(seconds),
+                "peak_mib": None,
+                "events": None,
+            }
+        )
+    return results
+
+
+def format_results(size, results, baseline):
+    """
+    Returns an indented_list string of the results for one calendar size
+    (or for startup, if size is None), with the speedup over the baseline
+    results, where available.
+    """
+    pairs = []
+    for result in results:
+        line = "{:9.3f} s".format(result["seconds"])
+        if result["peak_mib"] is not None:
+            line += " {:9.1f} MiB peak".format(result["peak_mib"])
+        base = baseline.get((size, result["stage"]))
+        if base:
+            line += " {:6.2f}x baseline speed".format(
+                base["seconds"] / result["seconds"]
+            )
+        pairs.append((result["stage"], line))
+    title = "startup" if size is None else "{} events".format(size)
+    return indented_list(title=title, pairs=pairs)
+
+
+def _git_commit():
+    """The current git commit of the repo, if any."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -0,0 +1,49 @@
+"""
+Writes one or more stores, merged in start-time order, as a chunked
+store, for digest --chunks and versus --chunks to read a chunk at a
+time (see timefly.chunked). Only one of the stores is loaded at once.
+"""
+
+from absl import app, flags
+
+from .. import chunked, log
+from ..format_utils import indented_list
+
+flags.DEFINE_list(
+    "stores",
+    ["./data/running.pkl"],
+    "comma-separated paths of the stores to merge into the chunked store",
+)
+flags.DEFINE_string(
+    "chunks", "./data/chunks", "directory to write the chunked store to"
+)
+flags.DEFINE_integer(
+    "chunk_size",
+    100000,
+    "maximum number of events per chunk, which bounds the memory used "
+    "by the reports reading them",
+    lower_bound=1,
+)
+
+
+def _main(_argv):
+    log.init()
+    nchunks = chunked.write_chunks(
+        flags.FLAGS.stores, flags.FLAGS.chunks, flags.FLAGS.chunk_size
+    )
+    index = chunked.read_index(flags.FLAGS.chunks)
+    print(
+        indented_list(
+            title="chunked store {}".format(flags.FLAGS.chunks),
+            pairs=[
+                ("stores", len(flags.FLAGS.stores)),
+                ("events", int(index["chunks"].events.sum())),
+                ("chunks", nchunks),
+                ("tags", len(index["tags"])),
+            ],
+        )
+    )
+
+
+if __name__ == "__main__":
+    app.run(_main)
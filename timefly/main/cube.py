@@ -0,0 +1,78 @@
+"""
+Precompute the popular-tag breakdowns of every context above the
+minimum support for a date range, so that digest and drill can look
+them up with --cube instead of recomputing them.
+"""
+
+from absl import app, flags
+import pandas as pd
+
+from .. import log, tag_filter
+from ..cube import build_cube, cube_spec, save_cube, store_fingerprint
+
+flags.DEFINE_string(
+    "running_events",
+    "./data/running.pkl",
+    "path pointing to the existing store of data, " "this need not exist",
+)
+flags.DEFINE_string(
+    "begin",
+    None,
+    "YYYY-MM-DD specification for begin of " + "fetch range (start of day)",
+)
+flags.mark_flag_as_required("begin")
+flags.DEFINE_string(
+    "end",
+    "now",
+    "YYYY-MM-DD specification for begin of " + "fetch range (end of day)",
+)
+flags.DEFINE_string(
+    "filter",
+    None,
+    "Filter down to events matching this tag filter expression, "
+    "e.g. 'work AND NOT meeting' (see timefly.tag_filter)",
+)
+flags.register_validator(
+    "filter",
+    tag_filter.is_valid,
+    message="--filter is not a valid tag filter expression",
+)
+flags.DEFINE_float(
+    "min_support",
+    0.025,
+    "Minimum weighted support (fraction of all hours), inclusive, of the "
+    "contexts to precompute",
+    lower_bound=0,
+    upper_bound=1,
+)
+flags.DEFINE_string(
+    "cube", "./data/cube.pkl", "path in which to save the cube"
+)
+
+
+def _main(_argv):
+    log.init()
+    with log.stage("load"):
+        df = pd.read_pickle(flags.FLAGS.running_events)
+    spec = cube_spec(
+        flags.FLAGS.begin,
+        flags.FLAGS.end,
+        flags.FLAGS.filter,
+        flags.FLAGS.min_support,
+    )
+    with log.stage("mine"):
+        cube = build_cube(
+            df, spec, store_fingerprint(flags.FLAGS.running_events)
+        )
+    print(
+        "mined {} contexts over {} tags".format(
+            len(cube["nodes"]), len(cube["vocab"]) - 1
+        )
+    )
+    log.debug("writing cube to {}", flags.FLAGS.cube)
+    with log.stage("save"):
+        save_cube(cube, flags.FLAGS.cube)
+
+
+if __name__ == "__main__":
+    app.run(_main)
@@ -1,17 +1,18 @@
 """
 Create a textual digest of a single time period.
 """
-import sys
-
 import numpy as np
-import pandas as pd
 from absl import app, flags
 
-from .. import log
+from .. import chunked, log, output, results, tag_filter
+from ..context import ContextTree, iter_breakdowns
+from ..cube import CubeContexts, cube_spec, load_cube
 from ..format_utils import indented_list
-from ..interval import filter_range, find_intervals, hrs_bw
-from ..tags import explode, df_filter
-from ..utils import parse_date, pretty_date, splat
+from ..hierarchy import rollup_codes, summary_leaves
+from ..interval import BUCKET_FREQS, bucket_edges, epoch_ns, split_by_buckets
+from ..store import TimeflyStore
+from ..tags import popular_tag_codes, select_popular
+from ..utils import once, parse_date, pretty_date
 
 flags.DEFINE_string(
     "running_events",
@@ -23,6 +24,7 @@ flags.DEFINE_string(
     None,
     "YYYY-MM-DD specification for begin of " + "fetch range (start of day)",
 )
+flags.mark_flag_as_required("begin")
 flags.DEFINE_string(
     "end",
     "now",
@@ -31,7 +33,13 @@ flags.DEFINE_string(
 flags.DEFINE_string(
     "filter",
     None,
-    "Filter down to events matching this string",
+    "Filter down to events matching this tag filter expression, "
+    "e.g. 'work AND NOT meeting' (see timefly.tag_filter)",
+)
+flags.register_validator(
+    "filter",
+    tag_filter.is_valid,
+    message="--filter is not a valid tag filter expression",
 )
 
 flags.DEFINE_float(
@@ -42,6 +50,44 @@ flags.DEFINE_float(
     lower_bound=0,
     upper_bound=1,
 )
+flags.DEFINE_string(
+    "cube",
+    None,
+    "path to a cube made by timefly.main.cube for the same range and "
+    "filter; if present and up to date, breakdowns are looked up from it",
+)
+flags.DEFINE_enum(
+    "bucket",
+    None,
+    list(BUCKET_FREQS),
+    "If set, instead of the drill-down, print the hours of each top-level "
+    "tag and the uncovered hours in each bucket of this size",
+)
+flags.DEFINE_string(
+    "chunks",
+    None,
+    "If set, read the events a chunk at a time from this chunked store "
+    "(see timefly.main.chunk) instead of loading --running_events, "
+    "keeping memory bounded however large the history",
+)
+flags.DEFINE_string(
+    "tag",
+    None,
+    "If set, also print the hours of the events in range tagged this tag "
+    "(or a descendant), regardless of --filter",
+)
+flags.DEFINE_string(
+    "slot_index",
+    "./data/slots.pkl",
+    "path to the per-tag hours index written by timefly.main.merge, which "
+    "--tag looks hours up in; built in memory if missing or stale",
+)
+flags.register_multi_flags_validator(
+    ["chunks", "bucket", "cube", "tag"],
+    lambda f: f["chunks"] is None
+    or not (f["bucket"] or f["cube"] or f["tag"]),
+    message="--chunks cannot be combined with --bucket, --cube or --tag",
+)
 
 def format_percent(x):
     return '{:3.1%}'.format(x)
@@ -53,21 +99,183 @@ def format_hours(x):
 
 def _main(_argv):
     log.init()
-    df = pd.read_pickle(flags.FLAGS.running_events)
+    if flags.FLAGS.chunks:
+        _main_chunked()
+        return
 
+    from_time = results.parse_time(flags.FLAGS.begin, start_of_day=True)
+    to_time = results.parse_time(flags.FLAGS.end, start_of_day=False)
+    cached = results.CachedOutput(
+        flags.FLAGS.running_events,
+        {
+            "report": "digest",
+            "begin": from_time,
+            "end": to_time,
+            "filter": flags.FLAGS.filter,
+            "min_support": flags.FLAGS.min_support,
+            "bucket": flags.FLAGS.bucket,
+            "cube": flags.FLAGS.cube,
+            "tag": flags.FLAGS.tag,
+            "output": flags.FLAGS.output,
+        },
+    )
+    if cached.replay():
+        return
+    with cached.record():
+        if (
+            flags.FLAGS.cube
+            and not flags.FLAGS.bucket
+            and _main_cube(to_time)
+        ):
+            return
+        _main_store(from_time, to_time)
+
+def _main_store(from_time, to_time):
+    """Prints the digest of the range from the store."""
+    store = TimeflyStore.load(
+        flags.FLAGS.running_events, slot_index=flags.FLAGS.slot_index
+    )
+
+    coverage = store.coverage(from_time, to_time)
+    if output.is_text():
+        print_coverage(
+            from_time, to_time, coverage.uncovered_hours, coverage.range_hours
+        )
+
+    keep_frac = store.kept_fraction(from_time, to_time, flags.FLAGS.filter)
+    df, ef = store.events(from_time, to_time, flags.FLAGS.filter)
+
+    if output.is_text():
+        if flags.FLAGS.filter:
+            print('only keeping {:.2%} of rows matching {}'.format(
+                keep_frac or 0, flags.FLAGS.filter))
+        print(
+            "found {} tags in range".format(len(ef.columns))
+        )
+    else:
+        write_range(
+            from_time,
+            to_time,
+            coverage.uncovered_hours,
+            coverage.range_hours,
+            keep_frac,
+            len(ef.columns),
+        )
+    if flags.FLAGS.tag:
+        print_tag_hours(store, from_time, to_time)
+
+    with log.stage("report"):
+        if flags.FLAGS.bucket:
+            print_buckets(df, ef, coverage.uncovered, from_time, to_time)
+        else:
+            print_context(
+                store.contexts(from_time, to_time, flags.FLAGS.filter),
+                [],
+                1.0,
+            )
+
+def _main_cube(to_time):
+    """
+    Prints the digest out of the cube specified by the flags, for the
+    range ending at to_time, returning False if it is missing or stale.
+    """
+    spec = cube_spec(
+        flags.FLAGS.begin,
+        flags.FLAGS.end,
+        flags.FLAGS.filter,
+        flags.FLAGS.min_support,
+    )
+    with log.stage("load cube"):
+        cube = load_cube(
+            flags.FLAGS.cube, flags.FLAGS.running_events, spec, to_time
+        )
+    if cube is None:
+        log.debug("cube {} missing or stale, ignoring", flags.FLAGS.cube)
+        return False
+    log.debug("using cube {}", flags.FLAGS.cube)
+
+    header = cube["header"]
+    if output.is_text():
+        print_coverage(
+            header["from_time"],
+            header["to_time"],
+            header["uncovered_hrs"],
+            header["range_hrs"],
+        )
+        if header["keep_frac"] is not None:
+            print('only keeping {:.2%} of rows matching {}'.format(
+                header["keep_frac"], spec["filter"]))
+        print(
+            "found {} tags in range".format(header["ntags"])
+        )
+    else:
+        write_range(
+            header["from_time"],
+            header["to_time"],
+            header["uncovered_hrs"],
+            header["range_hrs"],
+            header["keep_frac"],
+            header["ntags"],
+        )
+
+    @once
+    def _store():
+        return TimeflyStore.load(
+            flags.FLAGS.running_events, slot_index=flags.FLAGS.slot_index
+        )
+
+    if flags.FLAGS.tag:
+        print_tag_hours(_store(), header["from_time"], header["to_time"])
+
+    def _fallback():
+        return _store().contexts(
+            header["from_time"], header["to_time"], spec["filter"]
+        )
+
+    with log.stage("report"):
+        print_context(CubeContexts(cube, _fallback), [], 1.0)
+    return True
+
+def _main_chunked():
+    """
+    Prints the digest from the chunked store --chunks, in one pass over
+    the chunks of the range (see chunked.digest).
+    """
     from_time = parse_date(flags.FLAGS.begin, start_of_day=True)
     to_time = parse_date(flags.FLAGS.end, start_of_day=False)
+    result = chunked.digest(
+        flags.FLAGS.chunks, from_time, to_time, flags.FLAGS.filter
+    )
 
-    df = filter_range(df, from_time, to_time)
-
+    if output.is_text():
+        print_coverage(
+            from_time, to_time, result.uncovered_hours, result.range_hours
+        )
+        if flags.FLAGS.filter:
+            print('only keeping {:.2%} of rows matching {}'.format(
+                result.kept_fraction or 0, flags.FLAGS.filter))
+        print(
+            "found {} tags in range".format(len(result.ef.columns))
+        )
+    else:
+        write_range(
+            from_time,
+            to_time,
+            result.uncovered_hours,
+            result.range_hours,
+            result.kept_fraction,
+            len(result.ef.columns),
+        )
+
+    with log.stage("report"):
+        print_context(ContextTree(result.df, result.ef), [], 1.0)
+
+def print_coverage(from_time, to_time, uncovered_hrs, range_hrs):
     print(
         "events in range {} - {}".format(
         pretty_date(from_time),
         pretty_date(to_time),
     ))
-    uncovered, _ = find_intervals(df, from_time, to_time)
-    uncovered_hrs = sum(map(splat(hrs_bw), uncovered))
-    range_hrs = hrs_bw(from_time, to_time)
 
     ndigits = len(str(int(range_hrs)))
     global HOURS_WIDTH
@@ -80,95 +288,203 @@ def _main(_argv):
           format_percent(uncovered_hrs / range_hrs),
           "total)")
 
-    ef = explode(df)
-
-
-    df, ef = df_filter(df, ef, flags.FLAGS.filter)
-
-    print(
-        "found {} tags in range".format(len(ef.columns))
+# the fields of all records written by digest for --output jsonl/csv
+RECORD_FIELDS = [
+    "type",
+    "begin",
+    "end",
+    "uncovered_hours",
+    "range_hours",
+    "kept_fraction",
+    "tags",
+    "context",
+    "tag",
+    "fraction",
+    "total_fraction",
+    "bucket",
+    "hours",
+]
+
+WRITER = None
+
+def write_record(record):
+    global WRITER
+    if WRITER is None:
+        WRITER = output.RecordWriter(RECORD_FIELDS)
+    WRITER.write(record)
+
+def write_range(from_time, to_time, uncovered_hrs, range_hrs, keep_frac,
+                ntags):
+    write_record({
+        "type": "range",
+        "begin": from_time.isoformat(),
+        "end": to_time.isoformat(),
+        "uncovered_hours": uncovered_hrs,
+        "range_hours": range_hrs,
+        "kept_fraction": keep_frac,
+        "tags": ntags,
+    })
+
+def print_tag_hours(store, from_time, to_time):
+    """
+    Prints the hours tagged --tag in the range, from the slot index of
+    the store (see TimeflyStore.tag_hours).
+    """
+    hours = store.tag_hours(flags.FLAGS.tag, from_time, to_time)
+    if output.is_text():
+        print(format_hours(hours), "hours tagged", flags.FLAGS.tag)
+    else:
+        write_record({
+            "type": "tag",
+            "tag": flags.FLAGS.tag,
+            "hours": hours,
+        })
+
+def print_buckets(df, ef, uncovered, from_time, to_time):
+    """
+    Prints a table with a row per bucket of the range, with the
+    uncovered hours and the hours by most popular tag (for the top-level
+    tags of the digest) in that bucket.
+
+    Events and uncovered intervals are split across bucket boundaries,
+    so every bucket is tallied in a single pass over the events.
+    """
+    edges = bucket_edges(from_time, to_time, flags.FLAGS.bucket)
+    edges_ns = epoch_ns(edges)
+    nbuckets = len(edges) - 1
+
+    # hierarchical tags are tallied under their root ancestor
+    names, codes = rollup_codes(*popular_tag_codes(ef), summary_leaves(df))
+    totals = np.bincount(
+        codes, weights=df.duration_hours.values, minlength=len(names)
     )
+    min_support = flags.FLAGS.min_support
+    top, _ = select_popular(
+        np.arange(len(names)),
+        totals,
+        min_support,
+        int(np.ceil(1 / min_support)) if min_support else len(names),
+    )
+    # top-level tags get their own column, the rest go into "other"
+    ncols = len(top) + 1
+    column_of = np.full(len(names), len(top))
+    column_of[top] = np.arange(len(top))
 
-    print_context(df, ef, [], 1.0)
-
-def print_context(df, ef, context, frac):
-
-    cdf, cef = get_context_df(df, ef, context)
-    if cdf is None and cef is None:
-        # base case
+    rows, buckets, hours = split_by_buckets(
+        epoch_ns(df.start), epoch_ns(df.end), edges_ns
+    )
+    table = np.bincount(
+        buckets * ncols + column_of[codes[rows]],
+        weights=hours,
+        minlength=nbuckets * ncols,
+    ).reshape(nbuckets, ncols)
+
+    _, ubuckets, uhours = split_by_buckets(
+        epoch_ns([start for start, _ in uncovered]),
+        epoch_ns([end for _, end in uncovered]),
+        edges_ns,
+    )
+    unc = np.bincount(ubuckets, weights=uhours, minlength=nbuckets)
+
+    tags = list(names[top]) + ["other"]
+    labels = [
+        edges[i].astimezone().strftime("%Y-%m-%d") for i in range(nbuckets)
+    ]
+
+    if not output.is_text():
+        for label, bucket_unc, bucket_hours in zip(labels, unc, table):
+            write_record({
+                "type": "bucket",
+                "bucket": label,
+                "uncovered_hours": bucket_unc,
+            })
+            for tag, tag_hours in zip(tags, bucket_hours):
+                write_record({
+                    "type": "bucket",
+                    "bucket": label,
+                    "tag": tag,
+                    "hours": tag_hours,
+                })
         return
 
-    min_support = flags.FLAGS.min_support / frac
-    max_values = int(np.ceil(1 / min_support))
-    ranked_tags, percentages = rank_by_popular_tag(
-        cdf, cef, min_support, max_values
+    header = ["bucket", "uncovered"] + tags
+    widths = [10] + [max(len(h), HOURS_WIDTH) for h in header[1:]]
+    fmt = " ".join(
+        "{:<" + str(widths[0]) + "s}"
+        if i == 0 else "{:>" + str(w) + "s}"
+        for i, w in enumerate(widths))
+    print(fmt.format(*header))
+    for label, bucket_unc, bucket_hours in zip(labels, unc, table):
+        print(fmt.format(
+            label,
+            format_hours(bucket_unc),
+            *map(format_hours, bucket_hours)))
+
+def print_context(contexts, context, frac):
+    """
+    Prints the popular-tag breakdown of the given context, looked up
+    in contexts (a context.ContextTree or cube.CubeContexts), recursing
+    into sufficiently large sub-contexts.
+
+    Each breakdown is printed (or, for --output jsonl/csv, written as
+    one record per tag) as soon as it is computed.
+    """
+    breakdowns = iter_breakdowns(
+        contexts, context, frac, flags.FLAGS.min_support
     )
-
-    ranked_tags_print = list(ranked_tags)
-    percentages_print = list(percentages)
-
-    if ranked_tags_print == ["<unk>"]:
+    if output.is_text():
+        print_tree(breakdowns)
         return
-
-
-    if len(percentages):
-        ranked_tags_print.append("other")
-        percentages_print.append(1 - percentages.sum())
-
-    percentages_print = [
-        '{:.1%}'.format(p)
-        for p in percentages_print]
-
-    lines = indented_list(
-        pairs=zip(percentages_print, ranked_tags_print),
-        join=False,
-        sep=' ',
-        indentation_level=len(context))
-
-    for line, percent, tag in zip(lines, percentages, ranked_tags):
-        print(line)
-        if percent >= flags.FLAGS.min_support:
-            print_context(df, ef, context + [tag], frac * percent)
-
-    if len(percentages):
-        print(lines[-1])
-
-def get_context_df(df, ef, context):
-    if any(c not in ef.columns for c in context):
-        # one of the tags was a description; short circuit
-        return None, None
-    is_in_context = ef[context].prod(axis=1).astype(bool)
-    df = df.loc[is_in_context]
-    ef = ef.loc[is_in_context]
-    ef = ef.drop(columns=context)
-    sef = ef.sum(axis=0)
-    ef.drop(columns=sef[sef == 0].index, inplace=True)
-    return df, ef
-
-def rank_by_popular_tag(df, ef, min_support, max_values):
-    # this could be done all-sparse, but pandas flips to dense
-    # frequently and this needs a delicate second pass for that first
-    supports = ef.mean(axis=0)
-    cols = list(ef.columns)
-    cols.sort(key=lambda x: supports.at[x], reverse=True)
-    ef = ef.loc[:, cols]
-    ef = ef.replace(False, np.nan)
-    ef = ef * np.arange(1, len(cols) + 1, dtype=int)
-    ef = ef.min(axis=1)
-    ef = ef.fillna(0).astype(int)
-    ef = ef.replace(list(range(len(cols) + 1)), ["<unk>"] + cols)
-
-    # count hrs
-    hrs_by_tag = df.duration_hours.groupby(ef).sum()
-
-    percent_by_tag = hrs_by_tag / hrs_by_tag.sum()
-    percent_by_tag = percent_by_tag[percent_by_tag >= min_support]
-    percent_by_tag.sort_values(ascending=False, inplace=True)
-    percent_by_tag = percent_by_tag.iloc[:max_values]
-
-    return percent_by_tag.index, percent_by_tag.values
-
+    for context, frac, ranked_tags, percentages in breakdowns:
+        tags = list(ranked_tags) + ["other"]
+        percentages = list(percentages) + [1 - sum(percentages)]
+        for tag, percent in zip(tags, percentages):
+            write_record({
+                "type": "context",
+                "context": context,
+                "tag": tag,
+                "fraction": percent,
+                "total_fraction": frac * percent,
+            })
+
+def print_tree(breakdowns):
+    """
+    Prints the breakdowns generated by iter_breakdowns as an indented
+    tree, each line as soon as all the lines before it are known.
+    """
+    # stack of (context, lines of that context's breakdown not yet
+    # printed), from the root down to the latest breakdown
+    stack = []
+    for context, _, ranked_tags, percentages in breakdowns:
+        while stack and stack[-1][0] != context[:len(stack[-1][0])]:
+            _, lines = stack.pop()
+            for _, line in lines:
+                print(line)
+        if stack:
+            _, lines = stack[-1]
+            while lines:
+                tag, line = lines.pop(0)
+                print(line)
+                if tag == context[-1]:
+                    break
+
+        ranked_tags_print = list(ranked_tags) + ["other"]
+        percentages_print = list(percentages) + [1 - percentages.sum()]
+        percentages_print = [
+            '{:.1%}'.format(p)
+            for p in percentages_print]
+
+        lines = indented_list(
+            pairs=zip(percentages_print, ranked_tags_print),
+            join=False,
+            sep=' ',
+            indentation_level=len(context))
+        stack.append((context, list(zip(ranked_tags_print, lines))))
+
+    while stack:
+        _, lines = stack.pop()
+        for _, line in lines:
+            print(line)
 
 if __name__ == "__main__":
-    flags.mark_flag_as_required("begin")
     app.run(_main)
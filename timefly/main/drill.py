@@ -4,15 +4,14 @@ a specified date range.
 """
 import sys
 
-import numpy as np
-import pandas as pd
 from absl import app, flags
 
 from .. import log
+from ..context import Prefetcher, select_breakdown
+from ..cube import CubeContexts, cube_spec, load_cube
 from ..format_utils import indented_list
-from ..interval import filter_range, find_intervals, hrs_bw
-from ..tags import explode
-from ..utils import parse_date, pretty_date, splat
+from ..store import TimeflyStore
+from ..utils import once, parse_date, pretty_date, splat
 
 flags.DEFINE_string(
     "running_events",
@@ -40,65 +39,109 @@ flags.DEFINE_float(
 )
 
 
+flags.DEFINE_string(
+    "cube",
+    None,
+    "path to a cube made by timefly.main.cube for the same range; "
+    "if present and up to date, breakdowns are looked up from it",
+)
+flags.DEFINE_integer(
+    "cache_size",
+    256,
+    "maximum number of computed contexts kept in memory while drilling",
+    lower_bound=1,
+)
+
+
 def _main(_argv):
     log.init()
-    df = pd.read_pickle(flags.FLAGS.running_events)
+
+    # loaded once, whether first asked for by a fallback on the
+    # prefetching thread or by a command on this one
+    @once
+    def _store():
+        return TimeflyStore.load(
+            flags.FLAGS.running_events, tree_size=flags.FLAGS.cache_size
+        )
+
+    if flags.FLAGS.cube:
+        spec = cube_spec(
+            flags.FLAGS.begin, flags.FLAGS.end, None, flags.FLAGS.min_support
+        )
+        with log.stage("load cube"):
+            cube = load_cube(
+                flags.FLAGS.cube,
+                flags.FLAGS.running_events,
+                spec,
+                parse_date(flags.FLAGS.end, start_of_day=False),
+            )
+        if cube is not None:
+            log.debug("using cube {}", flags.FLAGS.cube)
+            header = cube["header"]
+
+            def _fallback():
+                return _store().contexts(
+                    header["from_time"], header["to_time"]
+                )
+
+            contexts = CubeContexts(cube, _fallback)
+            context_loop(
+                contexts,
+                flags.FLAGS.min_support,
+                max_values=9,
+                load_store=_store,
+            )
+            return
+        log.debug("cube {} missing or stale, ignoring", flags.FLAGS.cube)
 
     from_time = parse_date(flags.FLAGS.begin, start_of_day=True)
     to_time = parse_date(flags.FLAGS.end, start_of_day=False)
 
-    df = filter_range(df, from_time, to_time)
-
     log.debug(
         "analyzing events in range {} - {}",
         pretty_date(from_time),
         pretty_date(to_time),
     )
-    uncovered, _ = find_intervals(df, from_time, to_time)
-    uncovered_hrs = sum(map(splat(hrs_bw), uncovered))
-    range_hrs = hrs_bw(from_time, to_time)
+    store = _store()
+    contexts = store.contexts(from_time, to_time)
+    _, ef = contexts.get([])
+    coverage = store.coverage(from_time, to_time)
     log.debug(
         "{:.1f} hours in range {:.1f} uncovered ({:.1%} total)",
-        uncovered_hrs,
-        range_hrs,
-        uncovered_hrs / range_hrs,
+        coverage.uncovered_hours,
+        coverage.range_hours,
+        coverage.uncovered_hours / coverage.range_hours,
     )
-
-    ef = explode(df)
     log.debug(
         "found {} tags under current support count = {}", len(ef.columns), None
     )
 
-    context_loop(df, ef, flags.FLAGS.min_support, max_values=9)
-
-
-def get_context_df(df, ef, context):
-    is_in_context = ef[context].prod(axis=1).astype(bool)
-    df = df.loc[is_in_context]
-    ef = ef.loc[is_in_context]
-    ef = ef.drop(columns=context)
-    sef = ef.sum(axis=0)
-    ef.drop(columns=sef[sef == 0].index, inplace=True)
-    return df, ef
+    context_loop(
+        contexts, flags.FLAGS.min_support, max_values=9, load_store=_store
+    )
 
 
-def get_context_info(df, ef, cdf, cef):
-    tot_hrs = df.duration_hours.sum()
-    ctx_hrs = cdf.duration_hours.sum()
+def get_context_info(root, summary):
+    """
+    Given the ContextSummary of the root context and of the current
+    one, returns indented_list pairs describing the current context.
+    """
+    tot_hrs = root.hours
+    ctx_hrs = summary.hours
     ctx_hrs = (
         "ctx hrs",
         "{:.1f} ({:.1%} of total)".format(ctx_hrs, ctx_hrs / tot_hrs),
     )
 
-    tot_events = len(df)
-    ctx_events = len(cdf)
+    tot_events = root.events
+    ctx_events = summary.events
     ctx_events = (
         "ctx event count",
         "{:d} ({:.1%} of total)".format(ctx_events, ctx_events / tot_events),
     )
 
-    tot_tags = len(ef.columns)
-    ctx_tags = len(cef.columns)
+    tot_tags = root.ntags
+    ctx_tags = summary.ntags
     ctx_tags = (
         "ctx tag count",
         "{:d} ({:.1%} of total)".format(ctx_tags, ctx_tags / tot_tags),
@@ -107,47 +150,37 @@ def get_context_info(df, ef, cdf, cef):
     return [ctx_hrs, ctx_events, ctx_tags]
 
 
-def rank_by_popular_tag(df, ef, min_support, max_values):
-    # this could be done all-sparse, but pandas flips to dense
-    # frequently and this needs a delicate second pass for that first
-    supports = ef.mean(axis=0)
-    cols = list(ef.columns)
-    cols.sort(key=lambda x: supports.at[x], reverse=True)
-    ef = ef.loc[:, cols]
-    ef = ef.replace(False, np.nan)
-    ef = ef * np.arange(1, len(cols) + 1, dtype=int)
-    ef = ef.min(axis=1)
-    ef = ef.fillna(0).astype(int)
-    ef = ef.replace(list(range(len(cols) + 1)), ["<unk>"] + cols)
-
-    # count hrs
-    hrs_by_tag = df.duration_hours.groupby(ef).sum()
-
-    percent_by_tag = hrs_by_tag / hrs_by_tag.sum()
-    percent_by_tag = percent_by_tag[percent_by_tag >= min_support]
-    percent_by_tag.sort_values(ascending=False, inplace=True)
-    percent_by_tag = percent_by_tag.iloc[:max_values]
+def context_loop(contexts, min_support_show, max_values, load_store=None):
+    """
+    Given a source of context summaries (a context.ContextTree over
+    an event dataframe, as in ingest.py, along with its sparse binary tag
+    dataframe, or a cube.CubeContexts), run a "drill loop", which prints
+    out the tag context and some stats, but then enables the user to
+    drill down into the data.
 
-    return percent_by_tag.index, percent_by_tag.values
+    While waiting for input, the contexts reachable from the current one
+    are computed in the background, so drilling into them is instant.
 
+    The "related <tag>" command lists the tags sharing the most hours
+    with tag among the events of the current context (see cooccur), as
+    memoized by contexts (or stored in the cube).
 
-def context_loop(df, ef, min_support_show, max_values):
-    """
-    Given an event dataframe (as in ingest.py)
-    along with its sparse binary tag dataframe ef (columns are tag indicators),
-    run a "drill loop", which prints out the tag context
-    and some stats, but then enables the user to drill down into the data.
+    If load_store, a zero-argument callable returning a
+    store.TimeflyStore, is given, the "range" command switches to the
+    contexts of another date range of that store.
     """
+    prefetcher = Prefetcher()
+    root = contexts.summary([])
     context = []
     while True:
         print()
-        cdf, cef = get_context_df(df, ef, context)
-        pairs = get_context_info(df, ef, cdf, cef)
+        summary = contexts.summary(context)
+        pairs = get_context_info(root, summary)
         print(indented_list(title="context {}".format(context), pairs=pairs))
         ranked_tags = []
-        if not cdf.empty:
-            ranked_tags, percentages = rank_by_popular_tag(
-                cdf, cef, min_support_show, max_values
+        if summary.events:
+            ranked_tags, percentages = select_breakdown(
+                summary, context, min_support_show, max_values, contexts.leaves
             )
             tagnames = map(splat("{} - {}".format), enumerate(ranked_tags, 1))
 
@@ -167,10 +200,36 @@ def context_loop(df, ef, min_support_show, max_values):
                     indentation_level=1,
                 )
             )
+            prefetcher.prefetch(
+                contexts, (context + [tag] for tag in ranked_tags)
+            )
 
-        result = drill_get_next(1, len(ranked_tags))
+        result = drill_get_next(1, len(ranked_tags), load_store is not None)
         if result == "q":
             return
+        if isinstance(result, tuple) and result[0] == "related":
+            with log.stage("cooccurrence"):
+                matrix = contexts.cooccurrence(context)
+            if matrix is None:
+                print("---> no events to relate in this context")
+                continue
+            print_related(matrix, result[1], context, max_values)
+            continue
+        if isinstance(result, tuple):
+            _, from_time, to_time = result
+            range_contexts = load_store().contexts(from_time, to_time)
+            if not range_contexts.summary([]).events:
+                print("---> no events in that range")
+                continue
+            print(
+                "switching to range {} - {}".format(
+                    pretty_date(from_time), pretty_date(to_time)
+                )
+            )
+            contexts = range_contexts
+            root = contexts.summary([])
+            context = []
+            continue
         if result == "top":
             context = []
             continue
@@ -178,15 +237,52 @@ def context_loop(df, ef, min_support_show, max_values):
             context.pop()
             continue
         assert isinstance(result, int), result
-        if ranked_tags[result - 1] not in ef.columns:
+        if contexts.summary(context + [ranked_tags[result - 1]]) is None:
             print("---> cannot break this down further")
             continue
         context.append(ranked_tags[result - 1])
 
 
-def drill_get_next(lo, hi):
+def print_related(matrix, tag, context, max_values):
+    """
+    Prints the (at most max_values) tags sharing the most hours with tag
+    in the cooccur.Cooccurrence matrix of the events of context, other
+    than the tags of the context itself.
+    """
+    if tag not in matrix:
+        print("---> no events tagged {} in this context".format(tag))
+        return
+    tags, hours = matrix.related(tag)
+    keep = ~tags.isin(context)
+    tags, hours = tags[keep][:max_values], hours[keep][:max_values]
+    total = matrix.tag_hours(tag)
+    print(
+        indented_list(
+            title="tags co-occurring with {} ({:.1f} hrs)".format(tag, total),
+            pairs=zip(
+                tags,
+                (
+                    "{:.1f} hrs ({:.1%})".format(shared, shared / total)
+                    for shared in hours
+                ),
+            ),
+            indentation_level=1,
+        )
+    )
+
+
+def drill_get_next(lo, hi, allow_range=False):
+    """
+    Prompts until the user picks a tag number between lo and hi or one of
+    the commands, returning the number or command. The command
+    "related <tag>" is returned as the pair ("related", tag). If
+    allow_range, the command "range YYYY-MM-DD YYYY-MM-DD" is also
+    accepted, returned as the triple ("range", start of its first day,
+    end of its last).
+    """
+    commands = "up/top/related/range/q" if allow_range else "up/top/related/q"
     while True:
-        print("drill [{}..{}/up/top/q]? ".format(lo, hi), end="")
+        print("drill [{}..{}/{}]? ".format(lo, hi, commands), end="")
         sys.stdout.flush()
         try:
             selection = input()
@@ -194,6 +290,23 @@ def drill_get_next(lo, hi):
             selection = "q"
         if selection in ["up", "top", "q"]:
             return selection
+        words = selection.split()
+        if words and words[0] == "related":
+            if len(words) == 1:
+                print("usage: related TAG")
+                continue
+            return "related", " ".join(words[1:])
+        if allow_range and words and words[0] == "range":
+            try:
+                begin, end = words[1:]
+                return (
+                    "range",
+                    parse_date(begin, start_of_day=True),
+                    parse_date(end, start_of_day=False),
+                )
+            except ValueError:
+                print("usage: range YYYY-MM-DD YYYY-MM-DD")
+                continue
         try:
             selection = int(selection)
             if selection >= lo and selection <= hi:
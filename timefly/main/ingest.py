@@ -7,6 +7,10 @@ dates (ranges are expanded to include overlapping events).
 Saves extracted features as a pandas dataframe in the specified
 destination. Prints diagnostic information about the quality
 of the data.
+
+With --recurring, recurring events are saved once per series, as their
+rule and exceptions, rather than as one row per instance (see
+timefly/recurrence.py).
 """
 
 import heapq
@@ -24,13 +28,11 @@ import dateutil.parser as parser
 import numpy as np
 import pandas as pd
 from absl import app, flags
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import client, file, tools
 
-from .. import log
+from .. import log, recurrence
 from ..format_utils import indented_list
 from ..interval import find_intervals, hrs_bw
+from ..schema import compact, memory_report
 from ..tags import explode
 from ..utils import compose, parse_date, pretty_date, splat
 
@@ -51,6 +53,12 @@ flags.DEFINE_string(
 flags.DEFINE_string(
     "credentials", "~/credentials.json", "gcal API credentials"
 )
+flags.DEFINE_bool(
+    "recurring",
+    False,
+    "store each recurring event once, as its recurrence rule, "
+    "instead of one event per instance",
+)
 
 
 # Modifying this scope would require regenerating the gcal creds
@@ -65,6 +73,11 @@ def init_gcal_service():
     if GCAL_SERVICE:
         return
 
+    # these are slow to import, and only needed once we fetch
+    from googleapiclient.discovery import build
+    from httplib2 import Http
+    from oauth2client import client, file, tools
+
     logging.getLogger("googleapiclient").setLevel(logging.WARNING)
 
     tokenfile = "/tmp/token.json"
@@ -132,6 +145,38 @@ def _add_event(event, events, skipped):
     return start, end
 
 
+def _add_series(event, events, exdates, default_tz, to_time):
+    """
+    Adds the recurrence columns of the event just saved by _add_event
+    to the events lists: those of a series if it recurs (see
+    recurrence.py), in the time zone default_tz unless it has its own,
+    or else empty ones.
+    """
+    if "recurrence" not in event:
+        events["recurrence"].append(None)
+        events["tz"].append(None)
+        events["exdates"].append(None)
+        events["recurrence_end"].append(pd.NaT)
+        return
+    tz = event["start"].get("timeZone") or default_tz
+    rule, excluded = recurrence.parse_recurrence(event["recurrence"], tz)
+    events["recurrence"].append(rule)
+    events["tz"].append(tz)
+    events["exdates"].append(frozenset(excluded | exdates[event["id"]]))
+    events["recurrence_end"].append(to_time.astimezone(timezone.utc))
+
+
+def _add_cancelled(event, exdates):
+    """
+    Records the original start of the cancelled instance event as an
+    exception of its series in exdates, a dict of sets of ns starts.
+    """
+    original = event.get("originalStartTime", {}).get("dateTime")
+    if original:
+        start = pd.Timestamp(parser.parse(original)).tz_convert("UTC")
+        exdates[event["recurringEventId"]].add(start.value)
+
+
 def extract_tags(summary):
     # https://stackoverflow.com/questions/2852484
     return frozenset(re.findall(r"\[([^]]*)\]", summary))
@@ -164,24 +209,39 @@ def _main(_argv):
     page_tok = None
     earliest, latest = None, None
     skipped_ids = set()
+    # without singleEvents, recurring events come as their series,
+    # cancelled instances (the exceptions of their series), and the
+    # modified instances, which are single events
+    recurring = flags.FLAGS.recurring
+    added, exdates = [], defaultdict(set)
+    if recurring:
+        list_args = {"singleEvents": False, "showDeleted": True}
+    else:
+        list_args = {"singleEvents": True, "orderBy": "startTime"}
     while True:
-        events_result = (
-            GCAL_SERVICE.events()
-            .list(
-                calendarId="primary",
-                timeMin=from_time.isoformat(),
-                timeMax=to_time.isoformat(),
-                pageToken=page_tok,
-                maxResults=2000,
-                singleEvents=True,
-                orderBy="startTime",
+        with log.stage("fetch"):
+            events_result = (
+                GCAL_SERVICE.events()
+                .list(
+                    calendarId="primary",
+                    timeMin=from_time.isoformat(),
+                    timeMax=to_time.isoformat(),
+                    pageToken=page_tok,
+                    maxResults=2000,
+                    **list_args,
+                )
+                .execute()
             )
-            .execute()
-        )
         more_events = events_result.get("items", [])
         page_tok = events_result.get("nextPageToken")
         for event in more_events:
+            if event.get("status") == "cancelled":
+                if recurring and "recurringEventId" in event:
+                    _add_cancelled(event, exdates)
+                continue
             start_time, end_time = _add_event(event, events, skipped_ids)
+            if recurring and start_time:
+                added.append((event, events_result.get("timeZone") or "UTC"))
             earliest = (
                 min(earliest, start_time) if earliest and start_time
                 else start_time or earliest)
@@ -203,6 +263,11 @@ def _main(_argv):
         pretty_date(to_time),
     )
 
+    # the recurrence columns are filled in last, once the cancelled
+    # instances of every series are known
+    for event, default_tz in added:
+        _add_series(event, events, exdates, default_tz, to_time)
+
     df = pd.DataFrame(events)
     df.start = pd.to_datetime(df.start)
     df.end = pd.to_datetime(df.end)
@@ -213,11 +278,22 @@ def _main(_argv):
     log.debug("missing end time   {:.1%}", df.end.isna().mean())
 
     df = df.dropna(subset=["start", "end"])
+    loose_df, df = df, compact(df)
+    # diagnostics are of the instances, while the series are saved
+    stored_df = df
+    if recurring:
+        nseries = recurrence.is_series(df).sum()
+        df = recurrence.materialize(df, from_time, to_time)
+        log.debug(
+            "expanded {:5d} recurring events into {:5d} instances",
+            nseries,
+            len(df) - len(stored_df) + nseries,
+        )
 
     from_time = from_time
     to_time = to_time
     range_hrs = hrs_bw(from_time, to_time)
-    tot_hrs = df.duration_hours.sum()
+    tot_hrs = df.duration_hours.values.astype(float).sum()
 
     print("DIAGNOSTICS")
     print()
@@ -319,6 +395,9 @@ def _main(_argv):
         )
     )
 
+    print()
+    print(memory_report(loose_df, stored_df))
+
     log.debug(
         "writing loaded data to {}{}",
         flags.FLAGS.dst,
@@ -326,7 +405,7 @@ def _main(_argv):
         if os.path.exists(flags.FLAGS.dst)
         else "",
     )
-    df.to_pickle(flags.FLAGS.dst)
+    stored_df.to_pickle(flags.FLAGS.dst)
 
 
 if __name__ == "__main__":
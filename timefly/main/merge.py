@@ -8,7 +8,11 @@ import os
 import pandas as pd
 from absl import app, flags
 
-from .. import log
+from .. import log, results
+from ..cube import refresh_cube, store_fingerprint
+from ..schema import memory_report
+from ..slots import refresh_slot_index
+from ..store import merge_events
 
 flags.DEFINE_string(
     "new_events", "./data/new.pkl", "path pointing to the new rows to add"
@@ -18,26 +22,86 @@ flags.DEFINE_string(
     "./data/running.pkl",
     "path pointing to the existing store of data, " "this need not exist",
 )
+flags.DEFINE_string(
+    "cube",
+    "./data/cube.pkl",
+    "path to a cube made by timefly.main.cube, refreshed if it exists",
+)
+flags.DEFINE_string(
+    "slot_index",
+    "./data/slots.pkl",
+    "path to the per-tag hours index of the store (see timefly/slots.py), "
+    "updated with the merged events, empty to skip it",
+)
+flags.DEFINE_integer(
+    "slot_minutes",
+    15,
+    "resolution of the slot index, in minutes",
+    lower_bound=1,
+)
 
 
 def _main(_argv):
     log.init()
 
-    new = pd.read_pickle(flags.FLAGS.new_events)
-    if os.path.exists(flags.FLAGS.running_events):
-        running = pd.read_pickle(flags.FLAGS.running_events)
-    else:
-        running = new
+    with log.stage("load"):
+        new = pd.read_pickle(flags.FLAGS.new_events)
+        if os.path.exists(flags.FLAGS.running_events):
+            running = pd.read_pickle(flags.FLAGS.running_events)
+        else:
+            running = new
 
     print("ingested {:5d} events in running store".format(len(running)))
     print("ingested {:5d} events in new store".format(len(new)))
 
-    newnew = new.index.difference(running.index)
-    new_running = pd.concat([running, new.loc[newnew]])
+    new_running, changed = merge_events(running, new)
 
     print("unioned  {:5d} events in updated store".format(len(new_running)))
+    print(memory_report(running, new_running))
+
+    previous_fingerprint = None
+    if os.path.exists(flags.FLAGS.running_events):
+        previous_fingerprint = store_fingerprint(flags.FLAGS.running_events)
+    with log.stage("save"):
+        new_running.to_pickle(flags.FLAGS.running_events)
+    results.invalidate(flags.FLAGS.running_events)
+
+    with log.stage("refresh cube"):
+        recomputed = refresh_cube(
+            flags.FLAGS.cube,
+            flags.FLAGS.running_events,
+            new_running,
+            changed,
+            running,
+            previous_fingerprint,
+        )
+    if recomputed is not None:
+        print(
+            "updated  {:5d} contexts in cube {}".format(
+                recomputed, flags.FLAGS.cube
+            )
+        )
 
-    new_running.to_pickle(flags.FLAGS.running_events)
+    if flags.FLAGS.slot_index:
+        with log.stage("refresh slot index"):
+            index = refresh_slot_index(
+                flags.FLAGS.slot_index,
+                flags.FLAGS.running_events,
+                new_running,
+                changed,
+                running,
+                previous_fingerprint,
+                flags.FLAGS.slot_minutes,
+            )
+        sparse = sum(slots is not None for slots, _ in index["tags"].values())
+        print(
+            "indexed  {:5d} tags ({} sparse) over {} slots in {}".format(
+                len(index["tags"]),
+                sparse,
+                index["nslots"],
+                flags.FLAGS.slot_index,
+            )
+        )
 
 
 if __name__ == "__main__":
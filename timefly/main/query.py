@@ -0,0 +1,379 @@
+"""
+Thin client for timefly.main.serve: asks the server for a report and
+prints it, without importing pandas or loading the store.
+
+    python -m timefly.main.query digest --begin 2019-01-01 --filter sisu
+    python -m timefly.main.query context --begin 2019-01-01 --tags work
+    python -m timefly.main.query versus --periods month --begin 2019-01-01
+
+digest and versus take the same flags as the corresponding mainfiles;
+context prints a single drill-down step into the context given by
+--tags.
+"""
+
+import argparse
+import json
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+from ..format_utils import indented_list
+from ..records import RecordWriter
+from ..utils import pretty_date
+
+# kept in sync with server.DEFAULT_PORT and server.RECORD_FIELDS, which
+# aren't imported since the server module pulls in pandas
+DEFAULT_SERVER = "http://localhost:8642"
+RECORD_FIELDS = [
+    "type",
+    "range",
+    "pair",
+    "begin",
+    "end",
+    "events",
+    "hours",
+    "uncovered_hours",
+    "range_hours",
+    "kept_fraction",
+    "tags",
+    "context",
+    "tag",
+    "fraction",
+    "total_fraction",
+    "change",
+    "prev_hours",
+    "next_hours",
+    "message",
+]
+
+QUERIES = ["digest", "context", "versus"]
+
+# flags forwarded to the server as query parameters, when set
+_PARAMS = [
+    "begin",
+    "end",
+    "filter",
+    "min_support",
+    "start1",
+    "end1",
+    "start2",
+    "end2",
+    "periods",
+]
+
+
+def _parser(prog):
+    """
+    The argument parser of the client, which takes the same flags as
+    the absl mainfiles, but uses argparse: importing absl.app alone
+    takes about as long as the rest of the client's startup.
+    """
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("query", choices=QUERIES)
+    parser.add_argument(
+        "--server", default=DEFAULT_SERVER, help="URL of timefly.main.serve"
+    )
+    parser.add_argument(
+        "--begin",
+        help="YYYY-MM-DD specification for begin of "
+        + "fetch range (start of day)",
+    )
+    parser.add_argument(
+        "--end",
+        help="YYYY-MM-DD specification for begin of "
+        + "fetch range (end of day)",
+    )
+    parser.add_argument(
+        "--filter",
+        help="Filter down to events matching this tag filter expression, "
+        "e.g. 'work AND NOT meeting' (see timefly.tag_filter)",
+    )
+    parser.add_argument(
+        "--min_support",
+        type=_fraction,
+        help="Minimum support, inclusive, necessary for a category to be "
+        "included (server default if unset)",
+    )
+    parser.add_argument(
+        "--tags",
+        type=lambda value: [tag for tag in value.split(",") if tag],
+        default=[],
+        help="for context, the comma-separated tags to drill down into",
+    )
+    parser.add_argument("--start1", help="for versus, begin of first range")
+    parser.add_argument("--end1", help="for versus, end of first range")
+    parser.add_argument("--start2", help="for versus, begin of second range")
+    parser.add_argument("--end2", help="for versus, end of second range")
+    parser.add_argument(
+        "--periods",
+        help="for versus, compare consecutive periods of this size",
+    )
+    parser.add_argument(
+        "--output",
+        choices=["text", "jsonl", "csv"],
+        default="text",
+        help="report output format; jsonl and csv stream one record per line",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        default=True,
+        help="whether to log the request to stderr (the default)",
+    )
+    parser.add_argument("--noverbose", action="store_false", dest="verbose")
+    return parser
+
+
+def _fraction(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError("must be between 0 and 1")
+    return value
+
+
+def main(argv=None):
+    """
+    Runs the client on the command line argv (sys.argv by default),
+    whose first element is the program name.
+    """
+    argv = sys.argv if argv is None else argv
+    args = _parser(argv[0]).parse_args(argv[1:])
+    params = [
+        (name, getattr(args, name))
+        for name in _PARAMS
+        if getattr(args, name) is not None
+    ]
+    params += [("tag", tag) for tag in args.tags]
+    server = urlsplit(args.server)
+    path = "{}/{}?{}".format(
+        server.path.rstrip("/"), args.query, urlencode(params)
+    )
+    if args.verbose:
+        print("querying {}{}".format(args.server, path), file=sys.stderr)
+    # http.client rather than urllib.request, which is slower to import,
+    # and only once the flags are parsed, so --help is instant
+    from http.client import HTTPConnection
+
+    connection = HTTPConnection(server.hostname, server.port)
+    connection.request("GET", path)
+    response = connection.getresponse()
+    if response.status != 200:
+        print(
+            "query failed: {} {}".format(response.status, response.reason),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    records = _records(response)
+    if args.output != "text":
+        writer = RecordWriter(RECORD_FIELDS, fmt=args.output)
+        for record in records:
+            writer.write(record)
+    elif args.query == "digest":
+        print_digest(records, args.filter)
+    elif args.query == "context":
+        print_context(records)
+    else:
+        print_versus(records, args.periods)
+
+
+def _records(response):
+    """
+    Generates the records of the response, exiting with an error if the
+    server reports that the query failed while streaming them.
+    """
+    for line in response:
+        record = json.loads(line)
+        if record["type"] == "error":
+            sys.stdout.flush()
+            print(
+                "query failed: {}".format(record["message"]), file=sys.stderr
+            )
+            sys.exit(1)
+        yield record
+
+
+def _date(isoformat):
+    return pretty_date(datetime.fromisoformat(isoformat))
+
+
+def print_coverage(uncovered_hrs, range_hrs):
+    width = len(str(int(range_hrs))) + 2
+    print(
+        "{:{w}.1f} hours of {:{w}.1f} uncovered ( {:3.1%} total)".format(
+            uncovered_hrs, range_hrs, uncovered_hrs / range_hrs, w=width
+        )
+    )
+
+
+def print_digest(records, tag_filter=None):
+    """
+    Prints digest records as timefly.main.digest would, for the events
+    matching tag_filter.
+    """
+    breakdowns = OrderedDict()
+    for record in records:
+        if record["type"] == "range":
+            print(
+                "events in range {} - {}".format(
+                    _date(record["begin"]), _date(record["end"])
+                )
+            )
+            print_coverage(record["uncovered_hours"], record["range_hours"])
+            if record["kept_fraction"] is not None:
+                print(
+                    "only keeping {:.2%} of rows matching {}".format(
+                        record["kept_fraction"], tag_filter
+                    )
+                )
+            print("found {} tags in range".format(record["tags"]))
+        else:
+            breakdown = breakdowns.setdefault(tuple(record["context"]), [])
+            breakdown.append((record["tag"], record["fraction"]))
+    _print_breakdown(breakdowns, ())
+
+
+def _print_breakdown(breakdowns, context):
+    breakdown = breakdowns.get(context, [])
+    pairs = [("{:.1%}".format(fraction), tag) for tag, fraction in breakdown]
+    lines = indented_list(
+        pairs=pairs,
+        join=False,
+        sep=" ",
+        indentation_level=len(context),
+    )
+    for (tag, _), line in zip(breakdown, lines):
+        print(line)
+        _print_breakdown(breakdowns, context + (tag,))
+
+
+def print_context(records):
+    """Prints context records as a step of timefly.main.drill would."""
+    pairs = []
+    tagnames = []
+    percentages = []
+    for record in records:
+        if record["type"] == "root":
+            root = record
+        elif record["type"] == "summary":
+            for key, name, fmt in [
+                ("hours", "ctx hrs", "{:.1f}"),
+                ("events", "ctx event count", "{:d}"),
+                ("tags", "ctx tag count", "{:d}"),
+            ]:
+                value = record[key]
+                share = value / root[key] if root[key] else 0
+                pairs.append(
+                    (name, (fmt + " ({:.1%} of total)").format(value, share))
+                )
+            print(
+                indented_list(
+                    title="context {}".format(record["context"]), pairs=pairs
+                )
+            )
+        else:
+            tagnames.append("{} - {}".format(len(tagnames) + 1, record["tag"]))
+            percentages.append("{:.1%}".format(record["fraction"]))
+    if tagnames:
+        print(
+            indented_list(
+                title="popular-tag breakdown of context",
+                pairs=zip(tagnames, percentages),
+                indentation_level=1,
+            )
+        )
+
+
+def print_versus(records, periods=None):
+    """
+    Prints versus records as timefly.main.versus would, comparing
+    consecutive periods if periods is set.
+    """
+    ranges = []
+    pair = None
+    for record in records:
+        if record["type"] == "filter":
+            print(
+                "only keeping {:.2%} of rows matching {}".format(
+                    record["kept_fraction"], record["tag"]
+                )
+            )
+        elif record["type"] == "range":
+            ranges.append(record)
+            if not periods:
+                print(
+                    "{} events in range {} - {}".format(
+                        record["events"],
+                        _date(record["begin"]),
+                        _date(record["end"]),
+                    )
+                )
+        elif record["type"] == "coverage":
+            print_coverage(record["uncovered_hours"], record["range_hours"])
+            print("from prev to next, units are hours")
+            print(
+                "range 1 event hrs {:.0f} range 2 event hrs {:.0f}".format(
+                    ranges[0]["hours"], ranges[1]["hours"]
+                )
+            )
+        else:
+            if record.get("pair", pair) != pair:
+                if pair is None:
+                    print(
+                        "comparing {} periods in range {} - {}, "
+                        "units are hours".format(
+                            len(ranges),
+                            _date(ranges[0]["begin"]),
+                            _date(ranges[-1]["end"]),
+                        )
+                    )
+                pair = record["pair"]
+                prev, next_ = ranges[pair - 2], ranges[pair - 1]
+                print()
+                print(
+                    "{} - {} vs {} - {}".format(
+                        prev["begin"][:10],
+                        prev["end"][:10],
+                        next_["begin"][:10],
+                        next_["end"][:10],
+                    )
+                )
+                print(
+                    "range 1 event hrs {:.0f} range 2 event hrs {:.0f}".format(
+                        prev["hours"], next_["hours"]
+                    )
+                )
+            print_delta(record)
+
+
+def print_delta(delta):
+    if delta["type"] == "delta":
+        print(
+            "{:+6.1%}".format(delta["change"]),
+            delta["tag"],
+            "from",
+            "{:4.1f} to {:4.1f}".format(
+                delta["prev_hours"], delta["next_hours"]
+            ),
+        )
+    elif delta["type"] == "empty":
+        empty = [
+            name
+            for name, hours in [
+                ("range 1", delta["prev_hours"]),
+                ("range 2", delta["next_hours"]),
+            ]
+            if not hours
+        ]
+        print("no events in {}, nothing to compare".format(" or ".join(empty)))
+    else:
+        print("{:+6.1%}".format(delta["change"]), "other changes")
+
+
+if __name__ == "__main__":
+    main(["timefly query"] + sys.argv[1:])
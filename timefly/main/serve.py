@@ -0,0 +1,29 @@
+"""
+Run a resident query server over the store, so that reports asked for
+with timefly.main.query don't each reload it. The store is re-read
+whenever the file changes (e.g., after a merge).
+"""
+
+from absl import app, flags
+
+from .. import log
+from ..server import DEFAULT_PORT, serve
+
+flags.DEFINE_string(
+    "running_events",
+    "./data/running.pkl",
+    "path pointing to the existing store of data",
+)
+flags.DEFINE_string(
+    "host", "localhost", "address to listen on, only local by default"
+)
+flags.DEFINE_integer("port", DEFAULT_PORT, "port to listen on")
+
+
+def _main(_argv):
+    log.init()
+    serve(flags.FLAGS.running_events, flags.FLAGS.host, flags.FLAGS.port)
+
+
+if __name__ == "__main__":
+    app.run(_main)
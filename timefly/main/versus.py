@@ -1,24 +1,27 @@
 """
 Compare two periods of time for changes in what you've done.
-"""
-import sys
 
-from datetime import timedelta
-import numpy as np
-import pandas as pd
+With --periods, instead compares each of a sequence of consecutive
+periods (e.g., every month in a year) against the previous one.
+"""
 from absl import app, flags
 
-from .. import log
-from ..format_utils import indented_list
-from ..interval import filter_range, find_intervals, hrs_bw
-from ..tags import explode, df_filter
-from ..utils import parse_date, pretty_date, splat
+from .. import chunked, log, output, results, tag_filter
+from ..interval import BUCKET_FREQS, filter_range
+from ..store import TimeflyStore
+from ..utils import pretty_date
 
 
 flags.DEFINE_string(
     "filter",
     None,
-    "Filter down to events matching this string",
+    "Filter down to events matching this tag filter expression, "
+    "e.g. 'work AND NOT meeting' (see timefly.tag_filter)",
+)
+flags.register_validator(
+    "filter",
+    tag_filter.is_valid,
+    message="--filter is not a valid tag filter expression",
 )
 flags.DEFINE_string(
     "running_events",
@@ -53,134 +56,355 @@ flags.DEFINE_float(
     lower_bound=0,
     upper_bound=1,
 )
-flags.mark_flag_as_required("start1")
-flags.mark_flag_as_required("end1")
-flags.mark_flag_as_required("start2")
-flags.mark_flag_as_required("end2")
+flags.DEFINE_enum(
+    "periods",
+    None,
+    list(BUCKET_FREQS),
+    "If set, compare each period of this size between --begin and --end "
+    "with the previous one, instead of the two ranges",
+)
+flags.DEFINE_string(
+    "begin",
+    None,
+    "YYYY-MM-DD specification for begin of the --periods range"
+)
+flags.DEFINE_string(
+    "end",
+    "now",
+    "YYYY-MM-DD specification for end of the --periods range"
+)
+flags.DEFINE_integer(
+    "jobs",
+    0,
+    "number of processes comparing --periods in parallel, 0 for all cores",
+    lower_bound=0,
+)
+flags.DEFINE_string(
+    "chunks",
+    None,
+    "If set, read the events a chunk at a time from this chunked store "
+    "(see timefly.main.chunk) instead of loading --running_events, "
+    "keeping memory bounded however large the history",
+)
+flags.DEFINE_string(
+    "tag",
+    None,
+    "If set, also print the hours of the events in each range tagged this "
+    "tag (or a descendant), regardless of --filter",
+)
+flags.DEFINE_string(
+    "slot_index",
+    "./data/slots.pkl",
+    "path to the per-tag hours index written by timefly.main.merge, which "
+    "--tag looks hours up in; built in memory if missing or stale",
+)
+flags.register_multi_flags_validator(
+    ["chunks", "tag"],
+    lambda f: f["chunks"] is None or f["tag"] is None,
+    message="--chunks cannot be combined with --tag",
+)
+flags.register_multi_flags_validator(
+    ["chunks", "periods"],
+    lambda f: f["chunks"] is None or f["periods"] is None,
+    message="--chunks cannot be combined with --periods",
+)
+flags.register_multi_flags_validator(
+    ["periods", "start1", "end1", "start2", "end2"],
+    lambda f: f["periods"] is not None
+    or all(f[k] for k in ["start1", "end1", "start2", "end2"]),
+    message="--start1, --end1, --start2, --end2 are required "
+    "unless --periods is set",
+)
+flags.register_multi_flags_validator(
+    ["periods", "begin"],
+    lambda f: f["periods"] is None or f["begin"] is not None,
+    message="--begin is required with --periods",
+)
 
 def format_percent(x):
     return '{:3.1%}'.format(x)
 
-HOURS_WIDTH = 5
-
-def format_hours(x):
-    return ('{:' + str(HOURS_WIDTH) + '.1f}').format(x)
+def format_hours(x, width=5):
+    return ('{:' + str(width) + '.1f}').format(x)
 
 
 def _main(_argv):
-    df = pd.read_pickle(flags.FLAGS.running_events)
-    start1, end1, start2, end2 = (
-        parse_date(x, start_of_day=False) for x in
-        (flags.FLAGS.start1, flags.FLAGS.end1, flags.FLAGS.start2, flags.FLAGS.end2))
-    df = filter_range(df, start1, end2)
-
-    ef = explode(df)
-
-    df, ef = df_filter(df, ef, flags.FLAGS.filter, keep=False)
-
-    prev_df = filter_range(df, start1, end1)
-    next_df = filter_range(df, start2, end2)
-
-    print(
-        "{} events in range {} - {}".format(
-            len(prev_df),
-        pretty_date(start1),
-        pretty_date(end1),
-    ))
-    print(
-        "{} events in range {} - {}".format(
-            len(next_df),
-        pretty_date(start2),
-        pretty_date(end2),
-    ))
-    uncovered, _ = find_intervals(df, start1, end1)
-    uncovered += find_intervals(df, start2, end2)[0]
-    uncovered_hrs = sum(map(splat(hrs_bw), uncovered))
-    range_hrs = hrs_bw(start1, end1) + hrs_bw(start2, end2)
-
-    ndigits = len(str(int(range_hrs)))
-    global HOURS_WIDTH
-    HOURS_WIDTH = ndigits + 2 # decimal
-
-    print(format_hours(uncovered_hrs),
-          "hours of",
-          format_hours(range_hrs),
-          "uncovered (",
-          format_percent(uncovered_hrs / range_hrs),
-          "total)")
-
-    nef = explode(next_df)
-    pef = explode(prev_df)
-
-    for c in nef.columns:
-        if c not in pef.columns:
-            pef[c] = np.zeros(len(pef), dtype=bool)
-
-
-    for c in pef.columns:
-        if c not in nef.columns:
-            nef[c] = np.zeros(len(nef), dtype=bool)
-
-    print('from prev to next, units are hours')
-
-    ptot = prev_df.duration_hours.sum()
-    ntot = next_df.duration_hours.sum()
-
-    print('range 1 event hrs {:.0f} range 2 event hrs {:.0f}'.format(
-        ptot, ntot))
-
-    # Yes, this can be made much more efficient by caching 'x'
-    # and then incrementally updating it instead of removing rows
-    # associated with tags and restarting
-    #
-    # but completion > speed
-
-    tot = 0 # here all incremental changes are mutex
-    # (note how we're excerpting rows and keeping ptot, ntot the same)
-
-    while True:
-
-        jdf = pd.concat([prev_df, next_df])
-
-        s = jdf.apply(lambda x: pd.Series(list(x["tags"]) + [x["summary"]]),axis=1).stack().reset_index(level=1, drop=True)
-        s.name='tag'
-        singles = jdf.drop('tags', axis=1).join(s)
-
-        sprev = singles[singles.index.isin(prev_df.index)]
-        snext = singles[singles.index.isin(next_df.index)]
-
-        gbp = sprev[["tag", "duration_hours"]].groupby('tag').sum() / ptot
-        gbn = snext[["tag", "duration_hours"]].groupby('tag').sum() / ntot
-
-        x = gbn.combine(-gbp, lambda x, y: x + y, fill_value=0)
-        x = x[x.index != '']
-
-        x = x.reset_index()
-        x["abs"] = np.abs(x["duration_hours"])
-
-        if not len(x):
-            break
-
-        tag, hrs = x.sort_values('abs', ascending=False).iloc[0][["tag", "duration_hours"]]
-        tot += hrs
-        ptag = pef[tag]
-        ntag = nef[tag]
-
-        tag_prev_tot = prev_df[ptag].duration_hours.sum()
-        tag_next_tot = next_df[ntag].duration_hours.sum()
-
-        if abs(hrs) < flags.FLAGS.min_support:
-            break
-
-        print('{:+6.1%}'.format(hrs), tag, 'from', '{:4.1f} to {:4.1f}'.format(
-            tag_prev_tot, tag_next_tot))
-
-        prev_df = prev_df[~ptag]
-        next_df = next_df[~ntag]
-        pef = pef[~ptag]
-        nef = nef[~ntag]
+    log.init()
+    if flags.FLAGS.periods:
+        times = [
+            results.parse_time(flags.FLAGS.begin, start_of_day=True),
+            results.parse_time(flags.FLAGS.end, start_of_day=False),
+        ]
+    else:
+        times = [
+            results.parse_time(x, start_of_day=False) for x in
+            (flags.FLAGS.start1, flags.FLAGS.end1,
+             flags.FLAGS.start2, flags.FLAGS.end2)]
+    if flags.FLAGS.chunks:
+        _main_ranges(*times)
+        return
+
+    cached = results.CachedOutput(
+        flags.FLAGS.running_events,
+        {
+            "report": "versus",
+            "times": times,
+            "periods": flags.FLAGS.periods,
+            "filter": flags.FLAGS.filter,
+            "min_support": flags.FLAGS.min_support,
+            "tag": flags.FLAGS.tag,
+            "output": flags.FLAGS.output,
+        },
+    )
+    if cached.replay():
+        return
+    with cached.record():
+        if flags.FLAGS.periods:
+            _main_periods(*times)
+        else:
+            _main_ranges(*times)
+
+def _main_ranges(start1, end1, start2, end2):
+    """Compares the two ranges."""
+    if flags.FLAGS.chunks:
+        result = chunked.versus(
+            flags.FLAGS.chunks,
+            start1,
+            end1,
+            start2,
+            end2,
+            flags.FLAGS.filter,
+            flags.FLAGS.min_support,
+        )
+        if flags.FLAGS.filter and output.is_text():
+            print('only keeping {:.2%} of rows matching {}'.format(
+                result.kept_fraction or 0, flags.FLAGS.filter))
+        (pevents, nevents), (ptot, ntot) = result.events, result.hours
+        uncovered_hrs = result.uncovered_hours
+        range_hrs = result.range_hours
+        deltas = result.deltas
+        tag_hrs = None
+    else:
+        store = TimeflyStore.load(
+            flags.FLAGS.running_events, slot_index=flags.FLAGS.slot_index
+        )
+        print_filter(store, start1, end2)
+        df, _ = store.events(start1, end2, flags.FLAGS.filter)
+
+        prev_df = filter_range(df, start1, end1)
+        next_df = filter_range(df, start2, end2)
+        pevents, nevents = len(prev_df), len(next_df)
+
+        coverage = [
+            store.coverage(start1, end1, flags.FLAGS.filter),
+            store.coverage(start2, end2, flags.FLAGS.filter),
+        ]
+        uncovered_hrs = sum(c.uncovered_hours for c in coverage)
+        range_hrs = sum(c.range_hours for c in coverage)
+
+        ptot = prev_df.duration_hours.values.astype(float).sum()
+        ntot = next_df.duration_hours.values.astype(float).sum()
+
+        deltas = store.compare(
+            start1,
+            end1,
+            start2,
+            end2,
+            flags.FLAGS.filter,
+            flags.FLAGS.min_support,
+        )
+        tag_hrs = None
+        if flags.FLAGS.tag:
+            tag_hrs = [
+                store.tag_hours(flags.FLAGS.tag, start1, end1),
+                store.tag_hours(flags.FLAGS.tag, start2, end2),
+            ]
+
+    if output.is_text():
+        print(
+            "{} events in range {} - {}".format(
+                pevents,
+            pretty_date(start1),
+            pretty_date(end1),
+        ))
+        print(
+            "{} events in range {} - {}".format(
+                nevents,
+            pretty_date(start2),
+            pretty_date(end2),
+        ))
+
+        ndigits = len(str(int(range_hrs)))
+        width = ndigits + 2 # decimal
+
+        print(format_hours(uncovered_hrs, width),
+              "hours of",
+              format_hours(range_hrs, width),
+              "uncovered (",
+              format_percent(uncovered_hrs / range_hrs),
+              "total)")
+
+        print('from prev to next, units are hours')
+
+        print('range 1 event hrs {:.0f} range 2 event hrs {:.0f}'.format(
+            ptot, ntot))
+        if tag_hrs:
+            print_tag_hours(*tag_hrs)
+    else:
+        writer = output.RecordWriter(RECORD_FIELDS)
+        for i, (begin, end, events, hrs) in enumerate(
+                [(start1, end1, pevents, ptot),
+                 (start2, end2, nevents, ntot)], 1):
+            writer.write({
+                "type": "range",
+                "range": i,
+                "begin": begin.isoformat(),
+                "end": end.isoformat(),
+                "events": events,
+                "hours": hrs,
+            })
+        writer.write({
+            "type": "coverage",
+            "uncovered_hours": uncovered_hrs,
+            "range_hours": range_hrs,
+        })
+        for i, hrs in enumerate(tag_hrs or [], 1):
+            writer.write({
+                "type": "tag",
+                "range": i,
+                "tag": flags.FLAGS.tag,
+                "hours": hrs,
+            })
+
+    with log.stage("compare"):
+        for delta in deltas:
+            if not output.is_text():
+                writer.write(delta)
+            else:
+                print_delta(delta)
+
+def _main_periods(from_time, to_time):
+    """
+    Compares consecutive --periods of the range, loading and exploding
+    the store once for all of them.
+    """
+    store = TimeflyStore.load(
+        flags.FLAGS.running_events, slot_index=flags.FLAGS.slot_index
+    )
+
+    print_filter(store, from_time, to_time)
+    df, _ = store.events(from_time, to_time, flags.FLAGS.filter)
+
+    # like filter_range, every event overlapping a period is in it
+    edges, period_rows = store.periods(
+        from_time, to_time, flags.FLAGS.periods, flags.FLAGS.filter
+    )
+    weights = df.duration_hours.values.astype(float)
+    tag_hrs = None
+    if flags.FLAGS.tag:
+        tag_hrs = [
+            store.tag_hours(flags.FLAGS.tag, edges[i], edges[i + 1])
+            for i in range(len(period_rows))
+        ]
+    labels = [edge.astimezone().strftime("%Y-%m-%d") for edge in edges]
+
+    if output.is_text():
+        print(
+            "comparing {} periods in range {} - {}, units are hours".format(
+                len(period_rows),
+                pretty_date(from_time),
+                pretty_date(to_time),
+            ))
+    else:
+        writer = output.RecordWriter(RECORD_FIELDS)
+        for i, period in enumerate(period_rows):
+            writer.write({
+                "type": "range",
+                "range": i + 1,
+                "begin": edges[i].isoformat(),
+                "end": edges[i + 1].isoformat(),
+                "events": len(period),
+                "hours": weights[period].sum(),
+            })
+            if tag_hrs:
+                writer.write({
+                    "type": "tag",
+                    "range": i + 1,
+                    "tag": flags.FLAGS.tag,
+                    "hours": tag_hrs[i],
+                })
+
+    pairs = store.compare_periods(
+        from_time,
+        to_time,
+        flags.FLAGS.periods,
+        flags.FLAGS.filter,
+        flags.FLAGS.min_support,
+        jobs=flags.FLAGS.jobs or None,
+    )
+    with log.stage("compare"):
+        for k, deltas in pairs:
+            if output.is_text():
+                print()
+                print('{} - {} vs {} - {}'.format(
+                    labels[k - 1], labels[k], labels[k], labels[k + 1]))
+                print('range 1 event hrs {:.0f} '
+                      'range 2 event hrs {:.0f}'.format(
+                    weights[period_rows[k - 1]].sum(),
+                    weights[period_rows[k]].sum()))
+                if tag_hrs:
+                    print_tag_hours(tag_hrs[k - 1], tag_hrs[k])
+            for delta in deltas:
+                if not output.is_text():
+                    writer.write(dict(delta, pair=k + 1))
+                else:
+                    print_delta(delta)
+
+def print_filter(store, from_time, to_time):
+    """
+    Prints the fraction of events in range kept by --filter, if set,
+    as tags.df_filter would.
+    """
+    if flags.FLAGS.filter and output.is_text():
+        keep_frac = store.kept_fraction(from_time, to_time, flags.FLAGS.filter)
+        print('only keeping {:.2%} of rows matching {}'.format(
+            keep_frac or 0, flags.FLAGS.filter))
+
+def print_tag_hours(prev_hrs, next_hrs):
+    print('range 1 {0} hrs {1:.1f} range 2 {0} hrs {2:.1f}'.format(
+        flags.FLAGS.tag, prev_hrs, next_hrs))
+
+def print_delta(delta):
+    if delta["type"] == "delta":
+        print('{:+6.1%}'.format(delta["change"]), delta["tag"], 'from',
+              '{:4.1f} to {:4.1f}'.format(
+                  delta["prev_hours"], delta["next_hours"]))
+    elif delta["type"] == "empty":
+        empty = [name for name, hrs in
+                 [('range 1', delta["prev_hours"]),
+                  ('range 2', delta["next_hours"])] if not hrs]
+        print('no events in {}, nothing to compare'.format(
+            ' or '.join(empty)))
+    else:
+        print('{:+6.1%}'.format(delta["change"]), 'other changes')
+
+# the fields of all records written by versus for --output jsonl/csv
+RECORD_FIELDS = [
+    "type",
+    "range",
+    "pair",
+    "begin",
+    "end",
+    "events",
+    "hours",
+    "uncovered_hours",
+    "range_hours",
+    "tag",
+    "change",
+    "prev_hours",
+    "next_hours",
+]
 
-    print('{:+6.1%}'.format(hrs), 'other changes')
 
 if __name__ == "__main__":
     app.run(_main)
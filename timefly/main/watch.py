@@ -0,0 +1,157 @@
+"""
+Keeps the store up to date in the background: every --interval seconds,
+merges the shards dropped into --drop_dir (fetching the last
+--fetch_days of events from Google calendar into it first, if set), and
+updates the cube, slot index and daily aggregates (see timefly/watch.py).
+
+Shards are event dataframes as written by ingest, e.g.
+
+    timefly ingest --begin 2019-09-01 --dst ./data/drop/.sep.pkl
+    mv ./data/drop/.sep.pkl ./data/drop/sep.pkl
+
+With --show, prints the latest aggregates, as of the last sync, and
+exits, without loading the store.
+"""
+
+import os
+import time
+
+from absl import app, flags
+
+from .. import log
+from ..aggregates import load_aggregates
+from ..cube import store_fingerprint
+from ..format_utils import indented_list
+from ..utils import pretty_date
+from ..watch import DropDirSource, FetchSource, Watcher
+
+flags.DEFINE_string(
+    "running_events",
+    "./data/running.pkl",
+    "path pointing to the store to keep up to date, this need not exist",
+)
+flags.DEFINE_string(
+    "drop_dir", "./data/drop", "directory to take new shards (*.pkl) from"
+)
+flags.DEFINE_string(
+    "aggregates",
+    "./data/aggregates.pkl",
+    "path to write the daily aggregates of the store to",
+)
+flags.DEFINE_string(
+    "cube",
+    "./data/cube.pkl",
+    "path to a cube made by timefly.main.cube, refreshed if it exists",
+)
+flags.DEFINE_string(
+    "slot_index",
+    "./data/slots.pkl",
+    "path to write the per-tag hours index of the store to, empty to skip",
+)
+flags.DEFINE_integer(
+    "slot_minutes",
+    15,
+    "resolution of the slot index, in minutes",
+    lower_bound=1,
+)
+flags.DEFINE_float("interval", 300, "seconds between syncs", lower_bound=0)
+flags.DEFINE_bool("once", False, "sync once and exit")
+flags.DEFINE_integer(
+    "fetch_days",
+    0,
+    "if positive, fetch the events of this many past days from "
+    "Google calendar before each sync",
+    lower_bound=0,
+)
+flags.DEFINE_bool("recurring", False, "fetch with ingest --recurring")
+flags.DEFINE_list(
+    "windows",
+    ["1", "7", "30"],
+    "comma-separated numbers of past days to keep the latest totals of",
+)
+flags.DEFINE_bool("show", False, "print the latest aggregates and exit")
+
+
+def _main(_argv):
+    log.init()
+    if flags.FLAGS.show:
+        _show()
+        return
+
+    if flags.FLAGS.fetch_days:
+        ingest_flags = ["--recurring"] if flags.FLAGS.recurring else []
+        source = FetchSource(
+            flags.FLAGS.drop_dir, flags.FLAGS.fetch_days, ingest_flags
+        )
+    else:
+        source = DropDirSource(flags.FLAGS.drop_dir)
+    watcher = Watcher(
+        source,
+        flags.FLAGS.running_events,
+        flags.FLAGS.aggregates,
+        flags.FLAGS.cube,
+        flags.FLAGS.slot_index,
+        flags.FLAGS.slot_minutes,
+        [int(days) for days in flags.FLAGS.windows],
+    )
+    while True:
+        changed = watcher.sync()
+        if changed:
+            print(
+                "merged {:5d} events into {}".format(
+                    changed, flags.FLAGS.running_events
+                )
+            )
+        if flags.FLAGS.once:
+            break
+        time.sleep(flags.FLAGS.interval)
+
+
+def _show():
+    aggregates = load_aggregates(flags.FLAGS.aggregates)
+    if aggregates is None:
+        raise app.UsageError(
+            "no aggregates in {}, run watch first".format(
+                flags.FLAGS.aggregates
+            )
+        )
+    running_events = flags.FLAGS.running_events
+    if not os.path.exists(running_events) or aggregates[
+        "fingerprint"
+    ] != store_fingerprint(running_events):
+        log.debug("{} changed since the last sync", running_events)
+    for report in aggregates["latest"]:
+        print(
+            indented_list(
+                title="last {} days, {} - {}".format(
+                    report["days"],
+                    pretty_date(report["begin"]),
+                    pretty_date(report["end"]),
+                ),
+                pairs=[
+                    ("events", report["events"]),
+                    ("hours", "{:.1f}".format(report["hours"])),
+                    (
+                        "uncovered hrs",
+                        "{:.1f} ({:.1%})".format(
+                            report["uncovered_hours"],
+                            report["uncovered_hours"] / report["range_hours"],
+                        ),
+                    ),
+                ],
+            )
+        )
+        print(
+            indented_list(
+                title="top tags by hours",
+                indentation_level=1,
+                pairs=[
+                    (tag, "{:6.1f}".format(hours))
+                    for tag, hours in report["tags"]
+                ],
+            )
+        )
+
+
+if __name__ == "__main__":
+    app.run(_main)
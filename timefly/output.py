@@ -0,0 +1,36 @@
+"""
+Machine-readable report output.
+
+Reports which support the --output flag compute their results as
+a stream of flat dict records. In the "jsonl" and "csv" formats,
+each record is written (and flushed) as one line as soon as it
+is computed, so downstream tools can consume reports incrementally.
+The "text" format is the usual human-readable printout, produced by
+each report itself.
+"""
+
+from absl import flags
+
+from . import records
+
+flags.DEFINE_enum(
+    "output",
+    "text",
+    ["text", "jsonl", "csv"],
+    "report output format; jsonl and csv stream one record per line",
+)
+
+
+def is_text():
+    """Whether the report should print its usual human-readable text."""
+    return flags.FLAGS.output == "text"
+
+
+class RecordWriter(records.RecordWriter):
+    """
+    A records.RecordWriter whose format fmt, "jsonl" or "csv", defaults
+    to the one given by --output.
+    """
+
+    def __init__(self, fieldnames, out=None, fmt=None):
+        super().__init__(fieldnames, out, fmt or flags.FLAGS.output)
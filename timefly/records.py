@@ -0,0 +1,58 @@
+"""
+Writing report records (flat dicts) as jsonl or csv lines.
+
+Unlike output, which adds the --output flag, this doesn't import absl,
+so the thin client (timefly.main.query) can use it too.
+"""
+
+import json
+import sys
+
+
+class RecordWriter:
+    """
+    Writes dict records to out in the format fmt, "jsonl" or "csv".
+
+    For csv, fieldnames gives the columns; the header is written with the
+    first record, missing fields are left empty, and list-valued fields
+    are JSON-encoded. For jsonl, records are written as-is.
+    """
+
+    def __init__(self, fieldnames, out=None, fmt="jsonl"):
+        self._format = fmt
+        assert self._format in ["jsonl", "csv"], self._format
+        self._out = out or sys.stdout
+        self._csv = None
+        self._wrote_header = False
+        if self._format == "csv":
+            import csv  # only imported when needed, for a faster startup
+
+            self._csv = csv.DictWriter(
+                self._out,
+                fieldnames,
+                restval="",
+                extrasaction="ignore",
+                lineterminator="\n",
+            )
+
+    def write(self, record):
+        """Writes a single record and flushes the output."""
+        if self._csv is None:
+            self._out.write(json.dumps(record, default=_jsonable) + "\n")
+        else:
+            if not self._wrote_header:
+                self._csv.writeheader()
+                self._wrote_header = True
+            row = {
+                key: json.dumps(value) if isinstance(value, list) else value
+                for key, value in record.items()
+            }
+            self._csv.writerow(row)
+        self._out.flush()
+
+
+def _jsonable(value):
+    """json.dumps fallback for numpy scalars."""
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(repr(value))
@@ -0,0 +1,302 @@
+"""
+Recurring events stored once per series, as a rule plus exceptions,
+rather than as one row per instance (see ingest --recurring).
+
+A series row has the event id, start, end, summary and tags of the
+series' first instance, and the following columns, which are None (or
+NaT) on all other rows:
+
+    recurrence      the RRULE (and any RDATE) lines of the series
+    tz              the IANA time zone in which the instances recur
+    exdates         frozenset of the starts (ns since the UTC epoch) of
+                    the instances cancelled or excluded by an EXDATE
+    recurrence_end  the end of the range the series was ingested for,
+                    past which no instances are generated (just as gcal
+                    only lists the instances in the range fetched)
+
+Modified instances are ordinary rows, whose event ids are those of the
+instances they replace (the series id, an underscore, and the original
+start in UTC), so generated instances with the id of an existing row
+are dropped.
+
+Instances are generated lazily, only for the range a query touches (see
+expand, and store.TimeflyStore, which adds them as ranges are queried).
+Daily and weekly rules, the bulk of recurring meetings, are expanded
+with vectorized date arithmetic in local wall-clock time, followed by a
+single conversion of all instances to UTC, so instances keep their
+local time across DST changes; other rules are expanded by dateutil.
+The instance rows are then gathered from the series rows in one take.
+"""
+
+import dateutil.parser as parser
+import numpy as np
+import pandas as pd
+from dateutil import rrule
+from dateutil import tz as dateutil_tz
+
+SERIES_COLUMNS = ["recurrence", "tz", "exdates", "recurrence_end"]
+
+_DAY_NS = 24 * 3600 * 10 ** 9
+# the epoch, 1970-01-01, was a Thursday
+_EPOCH_WEEKDAY = 3
+_WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+_SIMPLE_PARTS = {"FREQ", "INTERVAL", "COUNT", "UNTIL", "BYDAY", "WKST"}
+
+
+def is_series(df):
+    """Returns the boolean array of the series rows of df."""
+    if "recurrence" not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    return df.recurrence.notna().values
+
+
+def parse_recurrence(lines, tz):
+    """
+    Given the recurrence lines of a gcal event recurring in the time
+    zone tz, returns its rule (the RRULE and RDATE lines) as a string,
+    and the set of the starts excluded by its EXDATE lines, in ns since
+    the UTC epoch. All-day exclusions are ignored.
+    """
+    rules, exdates = [], set()
+    for line in lines:
+        name, _, values = line.partition(":")
+        params = dict(
+            param.split("=", 1) for param in name.split(";")[1:]
+        )
+        if not name.startswith("EXDATE"):
+            rules.append(line)
+        elif params.get("VALUE") != "DATE":
+            zone = params.get("TZID", tz)
+            for value in values.split(","):
+                exdates.add(_timestamp(value, zone).value)
+    return "\n".join(rules), exdates
+
+
+def _timestamp(value, tz):
+    """Parses an iCalendar date-time, floating ones in the zone tz."""
+    time = pd.Timestamp(parser.isoparse(value))
+    if time.tzinfo is None:
+        time = time.tz_localize(tz)
+    return time.tz_convert("UTC")
+
+
+def occurrences(recurrence, start, tz, lo, hi):
+    """
+    Returns the sorted int64 array of the starts (ns since the UTC epoch)
+    from lo (inclusive) to hi (exclusive) of the instances of a series
+    with the given rule, whose first instance starts at the timestamp
+    start, recurring in the time zone tz.
+    """
+    parts = _simple_rule(recurrence)
+    if parts is None:
+        return _rrule_occurrences(recurrence, start, tz, lo, hi)
+
+    local = start.tz_convert(tz).tz_localize(None).value
+    day0, time_of_day = divmod(local, _DAY_NS)
+    interval = int(parts.get("INTERVAL", 1))
+    if parts["FREQ"] == "DAILY":
+        # the n-th instance is on day first + n * period
+        first, period, offsets = day0, interval, np.array([0])
+    else:
+        # the instances of the n-th week are on days first + n * period
+        # + offsets, where first starts the week of the first instance
+        wkst = _WEEKDAYS.index(parts.get("WKST", "MO"))
+        weekday = (day0 + _EPOCH_WEEKDAY) % 7
+        first = day0 - (weekday - wkst) % 7
+        period = 7 * interval
+        days = parts.get("BYDAY", _WEEKDAYS[weekday]).split(",")
+        offsets = np.array(
+            sorted({(_WEEKDAYS.index(day) - wkst) % 7 for day in days})
+        )
+    # instances of the first week before the first instance don't count
+    skipped = int((first + offsets < day0).sum())
+
+    # a day either side of the range covers any UTC offset
+    lo_day, hi_day = lo // _DAY_NS - 1, hi // _DAY_NS + 2
+    n_lo = max((lo_day - first) // period, 0)
+    n_hi = (hi_day - first) // period + 1
+    if "COUNT" in parts:
+        n_hi = min(n_hi, (int(parts["COUNT"]) + skipped) // len(offsets) + 1)
+    n = np.arange(n_lo, max(n_hi, n_lo))[:, None]
+    days = (first + period * n + offsets).ravel()
+    index = (n * len(offsets) + np.arange(len(offsets)) - skipped).ravel()
+    keep = days >= day0
+    if "COUNT" in parts:
+        keep &= index < int(parts["COUNT"])
+    local = (days[keep] * _DAY_NS + time_of_day).astype("datetime64[ns]")
+    # as RFC 5545 has it, an ambiguous local time is the first one, and
+    # one skipped by a DST gap has the offset before the gap (an hour)
+    starts = (
+        pd.DatetimeIndex(local)
+        .tz_localize(
+            tz,
+            ambiguous=np.ones(len(local), dtype=bool),
+            nonexistent=pd.Timedelta(hours=1),
+        )
+        .tz_convert("UTC")
+        .asi8
+    )
+    keep = (starts >= lo) & (starts < hi)
+    if "UNTIL" in parts:
+        keep &= starts <= _until(parts["UNTIL"], tz)
+    return starts[keep]
+
+
+def _simple_rule(recurrence):
+    """
+    Returns the dict of the parts of recurrence if it is a single daily
+    or weekly RRULE which occurrences can expand by itself, else None.
+    """
+    if "\n" in recurrence or not recurrence.startswith("RRULE:"):
+        return None
+    parts = dict(
+        part.split("=", 1) for part in recurrence[len("RRULE:") :].split(";")
+    )
+    if set(parts) - _SIMPLE_PARTS:
+        return None
+    if parts["FREQ"] == "WEEKLY":
+        days = parts.get("BYDAY", "MO").split(",")
+        if all(day in _WEEKDAYS for day in days):
+            return parts
+    elif parts["FREQ"] == "DAILY" and "BYDAY" not in parts:
+        return parts
+    return None
+
+
+def _until(value, tz):
+    """The last possible start (ns) of an instance, given UNTIL."""
+    if len(value) == 8:
+        # a date: instances may start until the end of that day
+        return _timestamp(value, tz).value + _DAY_NS - 1
+    return _timestamp(value, tz).value
+
+
+def _rrule_occurrences(recurrence, start, tz, lo, hi):
+    zone = dateutil_tz.gettz(tz)
+    dtstart = start.tz_convert(tz).to_pydatetime().replace(tzinfo=zone)
+    rules = rrule.rrulestr(recurrence, dtstart=dtstart, forceset=True)
+    # datetimes only have microseconds, and instances whole seconds
+    found = rules.between(
+        pd.Timestamp(lo, tz="UTC").ceil("us").to_pydatetime(),
+        pd.Timestamp(hi, tz="UTC").floor("us").to_pydatetime(),
+        inc=True,
+    )
+    starts = np.array([pd.Timestamp(time).value for time in found], np.int64)
+    return starts[starts < hi]
+
+
+def expand(series, existing, from_time=None, to_time=None):
+    """
+    Returns the rows of the instances of the series rows of the df
+    series which intersect the range from_time to to_time (as with
+    interval.filter_range), or all instances if the range isn't given,
+    except for those whose ids are in the index existing.
+
+    Instance rows have the columns of their series row, except for
+    their start and end, and the SERIES_COLUMNS, which are cleared.
+    """
+    from_ns = None if from_time is None else pd.Timestamp(from_time).value
+    to_ns = None if to_time is None else pd.Timestamp(to_time).value
+    starts = series.start.values.astype("datetime64[ns]").astype(np.int64)
+    durations = series.end.values.astype("datetime64[ns]").astype(np.int64)
+    durations = durations - starts
+    ends = series.recurrence_end.values.astype("datetime64[ns]")
+
+    positions, instance_starts = [], []
+    for i, row in enumerate(series.itertuples()):
+        lo = starts[i]
+        if from_ns is not None:
+            # starting after from_time - duration, so ending after it
+            lo = max(lo, from_ns - durations[i] + 1)
+        hi = ends[i].astype(np.int64)
+        if to_ns is not None:
+            hi = min(hi, to_ns)
+        if lo >= hi:
+            continue
+        found = occurrences(row.recurrence, row.start, row.tz, lo, hi)
+        if row.exdates:
+            found = found[~np.isin(found, list(row.exdates))]
+        positions.append(np.full(len(found), i))
+        instance_starts.append(found)
+    if not positions:
+        return series.iloc[:0]
+    positions = np.concatenate(positions)
+    instance_starts = np.concatenate(instance_starts)
+
+    instances = series.take(positions)
+    start_index = pd.DatetimeIndex(instance_starts.astype("datetime64[ns]"))
+    instances["start"] = start_index.tz_localize("UTC")
+    end_index = start_index + pd.to_timedelta(durations[positions])
+    instances["end"] = end_index.tz_localize("UTC")
+    for col in SERIES_COLUMNS:
+        instances[col] = pd.NaT if col == "recurrence_end" else None
+    ids = pd.Index(series.index.values[positions]).astype(str)
+    instances.index = ids + "_" + start_index.strftime("%Y%m%dT%H%M%SZ")
+    instances.index.name = series.index.name
+    return instances[~instances.index.isin(existing)]
+
+
+def materialize(df, from_time=None, to_time=None):
+    """
+    Returns df with its series rows replaced by their instances which
+    intersect the range (or all of them, without a range), or df itself
+    if it has no series rows.
+    """
+    series = is_series(df)
+    if not series.any():
+        return df
+    singles = df[~series]
+    instances = expand(df[series], singles.index, from_time, to_time)
+    return pd.concat([singles, instances])
+
+
+def update_series(running, new):
+    """
+    Returns the store running with each series row which the store new
+    also has replaced by new's, whose rule and exceptions are the most
+    recent, keeping the later recurrence_end and the exdates of both.
+    """
+    both = new.index[is_series(new)].intersection(
+        running.index[is_series(running)]
+    )
+    if not len(both):
+        return running
+    old, updated = running.loc[both], new.loc[both].copy()
+    updated["recurrence_end"] = pd.concat(
+        [old.recurrence_end, updated.recurrence_end], axis=1
+    ).max(axis=1)
+    updated["exdates"] = [a | b for a, b in zip(old.exdates, updated.exdates)]
+    return pd.concat([running.drop(both), updated])
+
+
+def touched_range(df, ids):
+    """
+    Returns the first start and the last end of the events of
+    materialize(df) which the rows ids of df may give rise to: those
+    rows, the instances of those which are series (up to their
+    recurrence_end), and the instances generated in place of those which
+    are modified instances. Returns None if there are no such events.
+    """
+    rows = df.loc[df.index.intersection(ids)]
+    starts, ends = [rows.start], [rows.end]
+    series = is_series(rows)
+    if series.any():
+        ends.append(rows.recurrence_end[series])
+    # a modified instance has the id of the instance it replaces, the
+    # series id and the original start
+    parts = pd.Index(ids).astype(str).str.rsplit("_", n=1)
+    parents = pd.Index(parts.str[0])
+    original = pd.to_datetime(
+        parts.str[1], format="%Y%m%dT%H%M%SZ", errors="coerce", utc=True
+    )
+    all_series = df[is_series(df)]
+    replaced = parents.isin(all_series.index) & original.notna()
+    if replaced.any():
+        parent_rows = all_series.loc[parents[replaced]]
+        original = pd.Series(original[replaced])
+        starts.append(original)
+        ends.append(original + (parent_rows.end - parent_rows.start).values)
+    starts = pd.concat(starts)
+    if not len(starts):
+        return None
+    return starts.min(), pd.concat(ends).max()
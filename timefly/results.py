@@ -0,0 +1,252 @@
+"""
+An on-disk cache of report output, for the digest and versus runs that
+are repeated, unchanged, many times between ingests.
+
+A report's output is keyed by the content hash of the store (see
+store_version) and its query parameters, normalized: dates are keyed by
+the times they resolve to, and an end of "now" is rounded down to a
+multiple of --snap_minutes, so that runs a few minutes apart ask the
+same question. The first run tees its output into the cache as it is
+printed, and later runs replay it without loading the store.
+
+The cache is off unless --results_cache names its directory, so plain
+reports write nothing. Entries live in a directory per store and
+version. Since the version is part of the key, a new store never hits
+the entries of an old one, and merge (or watch) removes those as soon
+as it writes the new version (see invalidate). The cache is bounded to
+--results_cache_mb, evicting the least recently used entries first.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timezone
+
+from absl import flags
+
+from . import log
+from .utils import parse_date
+
+flags.DEFINE_string(
+    "results_cache",
+    "",
+    "directory of the report output cache (e.g. ./data/results), "
+    "which is disabled unless set",
+)
+flags.DEFINE_integer(
+    "results_cache_mb",
+    64,
+    "maximum size of the report output cache, in MB",
+    lower_bound=0,
+)
+flags.DEFINE_integer(
+    "snap_minutes",
+    15,
+    'with the cache, an end of "now" is rounded down to a multiple of '
+    "this many minutes (0 to not round), so that repeated runs hit it",
+    lower_bound=0,
+)
+
+RESULTS_VERSION = 1
+
+# written next to the store by store_version
+_VERSION_SUFFIX = ".version"
+
+
+def enabled():
+    """Whether the report output cache is enabled by --results_cache."""
+    return bool(flags.FLAGS.results_cache)
+
+
+def parse_time(datestr, start_of_day):
+    """
+    Parses datestr as utils.parse_date does, rounding "now" down to a
+    multiple of --snap_minutes if the cache is enabled.
+    """
+    time = parse_date(datestr, start_of_day)
+    if datestr == "now" and enabled() and flags.FLAGS.snap_minutes:
+        snap = flags.FLAGS.snap_minutes * 60
+        seconds = int(time.timestamp()) // snap * snap
+        time = datetime.fromtimestamp(seconds, timezone.utc)
+    return time
+
+
+def store_version(path, record=False):
+    """
+    Returns the content hash of the store file at path, as a hex string.
+
+    The hash is remembered in a file next to the store along with the
+    store's size and modification time, so it is only recomputed when
+    the store changes. Only writers of the store record it there, by
+    passing record (merge and watch do, see invalidate); reports just
+    hash the store if the file is missing or stale.
+    """
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    version_path = path + _VERSION_SUFFIX
+    try:
+        with open(version_path) as f:
+            saved = json.load(f)
+        if saved["stamp"] == stamp:
+            return saved["sha1"]
+    except (OSError, ValueError, KeyError):
+        pass
+    with log.stage("hash store"):
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+    if not record:
+        return sha1.hexdigest()
+    try:
+        with open(version_path, "w") as f:
+            json.dump({"stamp": stamp, "sha1": sha1.hexdigest()}, f)
+    except OSError:
+        log.debug("cannot write {}, hashing the store each time", version_path)
+    return sha1.hexdigest()
+
+
+def _store_dir(path):
+    """The cache directory of the entries of the store at path."""
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(flags.FLAGS.results_cache, name[:16])
+
+
+def invalidate(path):
+    """
+    Records the new version of the store at path, removing the cached
+    output of all its other versions, if the cache is enabled.
+    """
+    if not enabled():
+        return
+    version = store_version(path, record=True)
+    store_dir = _store_dir(path)
+    if not os.path.isdir(store_dir):
+        return
+    for name in os.listdir(store_dir):
+        if name != version:
+            shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+            log.debug("dropped cached reports of {} version {}", path, name)
+
+
+class CachedOutput:
+    """
+    The cached output of the report with the dict params (of JSON
+    values; datetimes are keyed by their ISO format) over the store at
+    path.
+
+    replay() writes the cached output, if any, to stdout, returning
+    whether it did. Otherwise, the report runs within record(), which
+    saves everything it prints if it completes. Without the cache,
+    replay() returns False and record() does nothing.
+    """
+
+    def __init__(self, path, params):
+        self._path = None
+        if not enabled() or not os.path.exists(path):
+            return
+        # reports print times in the local time zone
+        local_tz = datetime.now(timezone.utc).astimezone().tzname()
+        params = dict(
+            params, local_tz=local_tz, results_version=RESULTS_VERSION
+        )
+        key = json.dumps(params, sort_keys=True, default=_jsonable)
+        self._path = os.path.join(
+            _store_dir(path),
+            store_version(path),
+            hashlib.sha1(key.encode()).hexdigest() + ".out",
+        )
+
+    def replay(self):
+        if self._path is None or not os.path.exists(self._path):
+            return False
+        with open(self._path) as f:
+            text = f.read()
+        # the access time may not be kept, so recency is the mtime
+        os.utime(self._path)
+        log.debug("replaying cached report {}", self._path)
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return True
+
+    def record(self):
+        return _Recording(self._path)
+
+
+class _Recording:
+    """Tees stdout into the cache entry at path, unless path is None."""
+
+    def __init__(self, path):
+        self._path = path
+        self._stdout = None
+        self._buffer = io.StringIO()
+
+    def __enter__(self):
+        if self._path is not None:
+            self._stdout = sys.stdout
+            sys.stdout = _Tee(self._stdout, self._buffer)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._path is None:
+            return
+        sys.stdout = self._stdout
+        if exc_type is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp = self._path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self._buffer.getvalue())
+            os.replace(tmp, self._path)
+            log.debug("cached report {}", self._path)
+            _evict(flags.FLAGS.results_cache_mb * 2 ** 20)
+
+
+class _Tee:
+    """A text stream writing to all of streams."""
+
+    def __init__(self, *streams):
+        self._streams = streams
+
+    def write(self, text):
+        for stream in self._streams:
+            stream.write(text)
+        return len(text)
+
+    def flush(self):
+        for stream in self._streams:
+            stream.flush()
+
+    def __getattr__(self, name):
+        # isatty, encoding, fileno and the like are those of the stream
+        # teed from
+        return getattr(self._streams[0], name)
+
+
+def _evict(max_bytes):
+    """
+    Removes the least recently used entries of the cache until it is at
+    most max_bytes.
+    """
+    entries = []
+    for root, _, files in os.walk(flags.FLAGS.results_cache):
+        for name in files:
+            if name.endswith(".out"):
+                st = os.stat(os.path.join(root, name))
+                entries.append((st.st_mtime_ns, st.st_size, root, name))
+    total = sum(size for _, size, _, _ in entries)
+    for _, size, root, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(root, name))
+        total -= size
+        log.debug("evicted cached report {}", name)
+
+
+def _jsonable(value):
+    """json.dumps fallback for the datetimes of report parameters."""
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat()
+    raise TypeError(repr(value))
@@ -0,0 +1,93 @@
+"""
+Compact in-memory schema for the event dataframe produced by ingest.
+
+Columns are converted as follows:
+
+    start, end      datetime64[ns, UTC] (an int64 epoch count per event,
+                    rather than boxed tz-aware python objects)
+    duration_hours  float32
+    summary,        categorical, since most summaries repeat (missing
+    raw_summary     ones stay missing, rather than becoming "nan")
+    tags            object column of interned frozensets: every row with
+                    the same tag set shares a single frozenset, whose
+                    strings are themselves interned
+
+compact() is idempotent, so it can be used both at ingest time and to
+migrate older stores when they are merged.
+"""
+
+import sys
+
+import pandas as pd
+
+from . import log
+from .format_utils import indented_list
+
+_CATEGORICAL_COLUMNS = ["summary", "raw_summary"]
+
+
+@log.stage("compact")
+def compact(df):
+    """
+    Returns a copy of the event dataframe df in the compact schema.
+    Columns not mentioned in the module docstring are left untouched.
+    """
+    df = df.copy()
+    for col in ["start", "end"]:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], utc=True)
+    if "duration_hours" in df.columns:
+        df["duration_hours"] = df["duration_hours"].astype("float32")
+    for col in _CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    if "tags" in df.columns:
+        df["tags"] = intern_tags(df["tags"])
+    return df
+
+
+def intern_tags(tags):
+    """
+    Given a series of iterables of tags, returns an object series
+    of frozensets in which equal tag sets are the same object.
+    """
+    cache = {}
+
+    def _intern(tagset):
+        tagset = frozenset(tagset)
+        if tagset not in cache:
+            cache[tagset] = frozenset(sys.intern(tag) for tag in tagset)
+        return cache[tagset]
+
+    return pd.Series(
+        [_intern(tagset) for tagset in tags],
+        index=tags.index,
+        name=tags.name,
+        dtype=object,
+    )
+
+
+def bytes_per_event(df):
+    """
+    Returns a series with the (deep) number of bytes per event
+    used by each column of df, plus a "total" entry.
+    """
+    usage = df.memory_usage(deep=True, index=True) / max(len(df), 1)
+    usage["total"] = usage.sum()
+    return usage
+
+
+def memory_report(before, after, title="per-event memory footprint"):
+    """
+    Returns an indented_list string comparing bytes_per_event between
+    the before and after dataframes, one line per column.
+    """
+    before = bytes_per_event(before)
+    after = bytes_per_event(after)
+    pairs = []
+    for col in after.index:
+        old = before.get(col, 0)
+        pairs.append(
+            (str(col), "{:8.1f} B -> {:8.1f} B".format(old, after[col]))
+        )
+    return indented_list(title=title, pairs=pairs)
@@ -0,0 +1,343 @@
+"""
+A resident query server over the event store.
+
+Each report mainfile pays for interpreter startup, importing pandas,
+reading the whole store and exploding its tags before it can answer a
+single question. The server (see timefly.main.serve) does all of that
+once, keeps a store.TimeflyStore in memory, and answers queries over
+localhost HTTP, re-reading the store only when the file changes.
+
+Queries are GET requests to /digest, /context or /versus, with the
+parameters of the corresponding report as URL query parameters. The
+response is the report's records (as written by --output jsonl), one
+JSON object per line, streamed as they are computed. The thin client
+timefly.main.query issues these requests and prints the results.
+
+Malformed queries are answered with a 400 before any record. A query
+failing after its first record ends with an "error" record carrying the
+message instead.
+"""
+
+import io
+import itertools
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from . import log, output
+from .context import select_breakdown
+from .hierarchy import summary_leaves
+from .interval import BUCKET_FREQS, filter_range
+from .store import TimeflyStore
+from .tag_filter import compile_filter, evaluate
+from .utils import parse_date
+
+DEFAULT_PORT = 8642
+
+# the fields of all records served, for clients writing csv
+RECORD_FIELDS = [
+    "type",
+    "range",
+    "pair",
+    "begin",
+    "end",
+    "events",
+    "hours",
+    "uncovered_hours",
+    "range_hours",
+    "kept_fraction",
+    "tags",
+    "context",
+    "tag",
+    "fraction",
+    "total_fraction",
+    "change",
+    "prev_hours",
+    "next_hours",
+    "message",
+]
+
+
+class QueryError(ValueError):
+    """A malformed query, reported back to the client."""
+
+
+def _param(params, name, default=QueryError, convert=str):
+    """
+    Returns the last value of the parameter name in the parse_qs dict
+    params, converted, or default if it's absent (raising QueryError if
+    no default is given).
+    """
+    if name not in params:
+        if default is QueryError:
+            raise QueryError("missing parameter {}".format(name))
+        return default
+    try:
+        return convert(params[name][-1])
+    except ValueError as e:
+        raise QueryError("bad parameter {}: {}".format(name, e))
+
+
+def _date(params, name, start_of_day, default=QueryError):
+    """Like _param, parsing a date (and its default) with parse_date."""
+    value = _param(params, name, default)
+    try:
+        return parse_date(value, start_of_day)
+    except ValueError as e:
+        raise QueryError("bad parameter {}: {}".format(name, e))
+
+
+def digest_records(store, params):
+    """
+    Generates the records of the digest (without --bucket) for the
+    parameters begin, end, filter and min_support.
+    """
+    from_time = _date(params, "begin", start_of_day=True)
+    to_time = _date(params, "end", start_of_day=False, default="now")
+    tag_filter = _param(params, "filter", None)
+    min_support = _param(params, "min_support", 0.025, float)
+
+    _check_filter(store, from_time, to_time, tag_filter)
+    coverage = store.coverage(from_time, to_time)
+    _, ef = store.contexts(from_time, to_time, tag_filter).get([])
+
+    yield {
+        "type": "range",
+        "begin": from_time.isoformat(),
+        "end": to_time.isoformat(),
+        "uncovered_hours": coverage.uncovered_hours,
+        "range_hours": coverage.range_hours,
+        "kept_fraction": store.kept_fraction(from_time, to_time, tag_filter),
+        "tags": len(ef.columns),
+    }
+    breakdowns = store.breakdown(from_time, to_time, tag_filter, min_support)
+    for context, frac, ranked_tags, percentages in breakdowns:
+        tags = list(ranked_tags) + ["other"]
+        percentages = list(percentages) + [1 - sum(percentages)]
+        for tag, percent in zip(tags, percentages):
+            yield {
+                "type": "context",
+                "context": context,
+                "tag": tag,
+                "fraction": percent,
+                "total_fraction": frac * percent,
+            }
+
+
+def context_records(store, params):
+    """
+    Generates the records of a single drill step: the summary of the
+    context given by the repeated tag parameter (a "summary" record, and
+    a "root" one for the whole range) followed by a "context" record for
+    each tag of its breakdown, as drill would show for the parameters
+    begin, end, filter and min_support.
+    """
+    from_time = _date(params, "begin", start_of_day=True)
+    to_time = _date(params, "end", start_of_day=False, default="now")
+    tag_filter = _param(params, "filter", None)
+    min_support = _param(params, "min_support", 0.025, float)
+    max_values = _param(params, "max_values", 9, int)
+    context = params.get("tag", [])
+
+    _check_filter(store, from_time, to_time, tag_filter)
+    contexts = store.contexts(from_time, to_time, tag_filter)
+    # both are summarized before the first record, so that a bad context
+    # is reported as such rather than after the response has started
+    summaries = [("root", []), ("summary", context)]
+    for i, (kind, ctx) in enumerate(summaries):
+        summary = contexts.summary(ctx)
+        if summary is None:
+            raise QueryError("cannot break down {}".format(ctx))
+        summaries[i] = (kind, ctx, summary)
+    for kind, ctx, summary in summaries:
+        yield {
+            "type": kind,
+            "context": ctx,
+            "hours": summary.hours,
+            "events": summary.events,
+            "tags": summary.ntags,
+        }
+    if not summary.events:
+        return
+    ranked_tags, percentages = select_breakdown(
+        summary, context, min_support, max_values, contexts.leaves
+    )
+    for tag, percent in zip(ranked_tags, percentages):
+        yield {
+            "type": "context",
+            "context": context,
+            "tag": tag,
+            "fraction": percent,
+        }
+
+
+def versus_records(store, params):
+    """
+    Generates the records of versus, for the parameters start1, end1,
+    start2, end2, or periods, begin and end, along with filter and
+    min_support.
+    """
+    if "periods" in params:
+        yield from _periods_records(store, params)
+        return
+    start1, end1, start2, end2 = (
+        _date(params, name, start_of_day=False)
+        for name in ["start1", "end1", "start2", "end2"]
+    )
+    tag_filter = _param(params, "filter", None)
+    min_support = _param(params, "min_support", 0.025, float)
+
+    yield from _filter_records(store, start1, end2, tag_filter)
+    df, _ = store.events(start1, end2, tag_filter)
+    prev_df = filter_range(df, start1, end1)
+    next_df = filter_range(df, start2, end2)
+    coverage = [
+        store.coverage(start1, end1, tag_filter),
+        store.coverage(start2, end2, tag_filter),
+    ]
+
+    ranges = [(start1, end1, prev_df), (start2, end2, next_df)]
+    for i, (begin, end, range_df) in enumerate(ranges, 1):
+        yield {
+            "type": "range",
+            "range": i,
+            "begin": begin.isoformat(),
+            "end": end.isoformat(),
+            "events": len(range_df),
+            "hours": range_df.duration_hours.values.astype(float).sum(),
+        }
+    yield {
+        "type": "coverage",
+        "uncovered_hours": sum(c.uncovered_hours for c in coverage),
+        "range_hours": sum(c.range_hours for c in coverage),
+    }
+    yield from store.compare(
+        start1, end1, start2, end2, tag_filter, min_support
+    )
+
+
+def _periods_records(store, params):
+    periods = _param(params, "periods")
+    if periods not in BUCKET_FREQS:
+        raise QueryError("periods must be one of {}".format(BUCKET_FREQS))
+    from_time = _date(params, "begin", start_of_day=True)
+    to_time = _date(params, "end", start_of_day=False, default="now")
+    tag_filter = _param(params, "filter", None)
+    min_support = _param(params, "min_support", 0.025, float)
+
+    yield from _filter_records(store, from_time, to_time, tag_filter)
+    df, _ = store.events(from_time, to_time, tag_filter)
+    edges, period_rows = store.periods(
+        from_time, to_time, periods, tag_filter
+    )
+    weights = df.duration_hours.values.astype(float)
+    for i, period in enumerate(period_rows):
+        yield {
+            "type": "range",
+            "range": i + 1,
+            "begin": edges[i].isoformat(),
+            "end": edges[i + 1].isoformat(),
+            "events": len(period),
+            "hours": weights[period].sum(),
+        }
+    pairs = store.compare_periods(
+        from_time, to_time, periods, tag_filter, min_support, jobs=1
+    )
+    for k, deltas in pairs:
+        for delta in deltas:
+            yield dict(delta, pair=k + 1)
+
+
+def _check_filter(store, from_time, to_time, tag_filter):
+    """
+    Raises QueryError unless tag_filter is unset or a filter expression
+    matching some event.
+    """
+    if not tag_filter:
+        return
+    df, ef = store.events(from_time, to_time)
+    try:
+        node = compile_filter(tag_filter, ef.columns)
+    except ValueError as e:
+        raise QueryError("bad parameter filter: {}".format(e))
+    if not evaluate(node, ef, summary_leaves(df)).any():
+        raise QueryError("no events match {}".format(tag_filter))
+
+
+def _filter_records(store, from_time, to_time, tag_filter):
+    """Generates the "filter" record of versus, if tag_filter is set."""
+    _check_filter(store, from_time, to_time, tag_filter)
+    if tag_filter:
+        yield {
+            "type": "filter",
+            "tag": tag_filter,
+            "kept_fraction": store.kept_fraction(
+                from_time, to_time, tag_filter
+            ),
+        }
+
+
+QUERIES = {
+    "digest": digest_records,
+    "context": context_records,
+    "versus": versus_records,
+}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answers GET requests for QUERIES against the server's store."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = QUERIES.get(url.path.strip("/"))
+        if query is None:
+            self.send_error(404, "unknown query {}".format(url.path))
+            return
+        try:
+            self.server.store.refresh()
+            records = query(self.server.store, parse_qs(url.query))
+            # malformed queries are found before the first record
+            first = list(itertools.islice(records, 1))
+        except QueryError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        out = io.TextIOWrapper(self.wfile, encoding="utf-8")
+        writer = output.RecordWriter(RECORD_FIELDS, out, fmt="jsonl")
+        try:
+            with log.stage(url.path.strip("/")):
+                for record in itertools.chain(first, records):
+                    writer.write(record)
+        except BrokenPipeError:
+            log.debug("client hung up on {}", self.path)
+        except Exception as e:  # pylint: disable=broad-except
+            # the status is already sent, so the error is the last record
+            log.debug("query {} failed: {!r}", self.path, e)
+            try:
+                writer.write({"type": "error", "message": str(e)})
+            except BrokenPipeError:
+                pass
+        finally:
+            out.detach()
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        log.debug("{} {}", self.address_string(), format % args)
+
+
+def serve(path, host="localhost", port=DEFAULT_PORT):
+    """
+    Loads the store at path and answers queries on host:port until
+    interrupted.
+    """
+    server = HTTPServer((host, port), QueryHandler)
+    server.store = TimeflyStore.load(path)
+    log.debug("serving {} on http://{}:{}", path, host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
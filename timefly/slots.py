@@ -0,0 +1,377 @@
+"""
+A prefix-sum index of the hours spent on each tag, answering "hours
+tagged X between A and B" without filtering, exploding or grouping.
+
+Time is divided into fixed slots (15 minutes by default) from an origin,
+and every event is split across the slots it overlaps. For every tag
+(including summaries and the ancestors of hierarchical tags, so that
+an event tagged work/coding counts once towards work), the index holds
+the cumulative tagged hours up to the end of each slot. The hours of a
+tag between two slot boundaries are then the difference of two lookups;
+the partial slots at either end of a range are corrected exactly from
+the few events overlapping them (or prorated, without the events).
+
+Rare tags only touch a few slots, so a tag's cumulative sums are kept
+sparsely, at just the slots where they change, whenever that's smaller
+than a dense array of every slot (and then looked up by binary search).
+
+merge builds the index next to the store; like a cube, it remembers
+which version of the store it was computed from (see load_slot_index),
+and as events are merged in, only the slots and tags they touch are
+recomputed (see update_slot_index).
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .cube import store_fingerprint
+from .hierarchy import event_tags
+from .interval import RangeSlicer, epoch_ns, filter_range, split_by_buckets
+from .recurrence import materialize, touched_range
+
+SLOT_INDEX_VERSION = 2
+
+
+def build_slot_index(df, slot_minutes=15, fingerprint=None):
+    """
+    Computes the slot index (a plain dict, see SlotIndex) of the events
+    df, with slots of slot_minutes. fingerprint identifies the store
+    file, see cube.store_fingerprint.
+    """
+    slot_ns = slot_minutes * 60 * 10 ** 9
+    starts, ends = epoch_ns(df.start), epoch_ns(df.end)
+    origin, nslots = 0, 1
+    if len(df):
+        origin = int(starts.min()) // slot_ns * slot_ns
+        nslots = max(-(-(int(ends.max()) - origin) // slot_ns), 1)
+    index = {
+        tag: _cumulative_sums(tag_slots, sums, nslots)
+        for tag, (tag_slots, sums) in _slot_sums(
+            df, origin, slot_ns, nslots
+        ).items()
+    }
+    return {
+        "version": SLOT_INDEX_VERSION,
+        "fingerprint": fingerprint,
+        "origin": origin,
+        "slot_ns": slot_ns,
+        "nslots": nslots,
+        "tags": index,
+    }
+
+
+def _slot_sums(df, origin, slot_ns, nslots):
+    """
+    Returns a dict from each tag of the events df (see
+    hierarchy.event_tags) to the sorted int array of the slots, of the
+    nslots slot_ns long ones from origin, in which events tagged so
+    fall, and the float array of their tagged hours in each of those
+    slots.
+    """
+    edges = origin + np.arange(nslots + 1, dtype=np.int64) * slot_ns
+    rows, slots, hours = split_by_buckets(
+        epoch_ns(df.start), epoch_ns(df.end), edges
+    )
+
+    # the tag codes of each event, as a ragged array: those of event i
+    # are codes[offsets[i]:offsets[i] + counts[i]]; tag sets are
+    # interned, so each distinct (tags, summary) pair is expanded once
+    names = {}
+    expanded = {}
+    codes = []
+    offsets = np.empty(len(df), dtype=np.int64)
+    counts = np.empty(len(df), dtype=np.int64)
+    for i, key in enumerate(zip(df.tags, df.summary)):
+        if key not in expanded:
+            expanded[key] = [
+                names.setdefault(tag, len(names))
+                for tag in sorted(event_tags(*key))
+            ]
+        offsets[i] = len(codes)
+        counts[i] = len(expanded[key])
+        codes.extend(expanded[key])
+    codes = np.array(codes, dtype=np.int64)
+
+    # one (tag, slot, hours) piece per tag of each event's slot piece
+    repeats = counts[rows]
+    within = np.arange(repeats.sum()) - np.repeat(
+        np.cumsum(repeats) - repeats, repeats
+    )
+    piece_tags = codes[np.repeat(offsets[rows], repeats) + within]
+    keys = piece_tags * nslots + np.repeat(slots, repeats)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=np.repeat(hours, repeats))
+    key_tags, key_slots = keys // nslots, keys % nslots
+
+    bounds = np.searchsorted(key_tags, np.arange(len(names) + 1))
+    tag_sums = {}
+    for tag, code in names.items():
+        lo, hi = bounds[code], bounds[code + 1]
+        tag_sums[tag] = key_slots[lo:hi], sums[lo:hi]
+    return tag_sums
+
+
+def _cumulative_sums(tag_slots, sums, nslots):
+    """
+    Returns the index entry of a tag with the hours sums in the sorted
+    slots tag_slots: the pair of those slots and their cumulative sums,
+    or of None and the cumulative sums of every slot, if that's smaller.
+    """
+    tag_slots = tag_slots.astype(np.int32)
+    cum = np.cumsum(sums)
+    if tag_slots.nbytes + cum.nbytes < nslots * cum.itemsize:
+        return tag_slots, cum
+    dense = np.zeros(nslots)
+    dense[tag_slots] = sums
+    return None, np.cumsum(dense)
+
+
+def update_slot_index(index, previous, df, changed, fingerprint=None):
+    """
+    Returns the slot index dict index of the events of the store
+    previous brought up to date with the store df, in which the events
+    of the index changed were added or changed (see store.merge_events).
+    fingerprint identifies the store file of df.
+
+    Only the events intersecting the span touched by the changes are
+    split into slots, and only the tags they carry are recomputed; the
+    index grows by the slots new events reach past either of its ends.
+    """
+    spans = [touched_range(previous, changed), touched_range(df, changed)]
+    spans = [span for span in spans if span is not None]
+    if not spans:
+        return dict(index, fingerprint=fingerprint)
+    lo = min(span[0] for span in spans)
+    hi = max(span[1] for span in spans)
+    old = filter_range(materialize(previous, lo, hi), lo, hi)
+    new = filter_range(materialize(df, lo, hi), lo, hi)
+
+    origin, slot_ns = index["origin"], index["slot_ns"]
+    nslots = index["nslots"]
+    if len(new) and not index["tags"]:
+        # an index without events has no origin yet
+        return build_slot_index(
+            materialize(df), slot_ns // (60 * 10 ** 9), fingerprint
+        )
+    # slots are added at either end for new events falling past them
+    shift = 0
+    if len(new):
+        first = int(epoch_ns(new.start).min())
+        shift = max(-(-(origin - first) // slot_ns), 0)
+        origin -= shift * slot_ns
+        reach = -(-(int(epoch_ns(new.end).max()) - origin) // slot_ns)
+        nslots = max(nslots + shift, reach)
+
+    added = _slot_sums(new, origin, slot_ns, nslots)
+    removed = _slot_sums(old, origin, slot_ns, nslots)
+    tags = {}
+    for tag in set(index["tags"]) | set(added):
+        entry = index["tags"].get(tag)
+        if entry is not None:
+            entry = _resize(entry, shift, nslots)
+        if tag not in added and tag not in removed:
+            tags[tag] = entry
+            continue
+        pieces = [added.get(tag), _negate(removed.get(tag))]
+        if entry is not None:
+            pieces.append(_slot_hours(*entry))
+        pieces = [piece for piece in pieces if piece is not None]
+        tag_slots, inverse = np.unique(
+            np.concatenate([piece[0] for piece in pieces]),
+            return_inverse=True,
+        )
+        sums = np.bincount(
+            inverse, weights=np.concatenate([piece[1] for piece in pieces])
+        )
+        # removed events cancel out up to rounding
+        kept = np.abs(sums) > 1e-9
+        if kept.any():
+            tags[tag] = _cumulative_sums(tag_slots[kept], sums[kept], nslots)
+    return dict(
+        index, fingerprint=fingerprint, origin=origin, nslots=nslots, tags=tags
+    )
+
+
+def _resize(entry, shift, nslots):
+    """
+    Returns the index entry moved by shift slots added at the start, and
+    grown to nslots slots.
+    """
+    tag_slots, cum = entry
+    if tag_slots is not None:
+        return tag_slots + shift, cum
+    return None, np.concatenate(
+        [np.zeros(shift), cum, np.full(nslots - shift - len(cum), cum[-1])]
+    )
+
+
+def _negate(piece):
+    return None if piece is None else (piece[0], -piece[1])
+
+
+def _slot_hours(tag_slots, cum):
+    """
+    The inverse of _cumulative_sums: the slots in which an index entry
+    has hours, and the hours in each.
+    """
+    sums = np.diff(cum, prepend=0.0)
+    if tag_slots is None:
+        tag_slots = np.flatnonzero(sums)
+        sums = sums[tag_slots]
+    return tag_slots.astype(np.int64), sums
+
+
+def refresh_slot_index(
+    path,
+    running_events,
+    df,
+    changed,
+    previous=None,
+    previous_fingerprint=None,
+    slot_minutes=15,
+):
+    """
+    Brings the slot index at path up to date after the store at
+    running_events was rewritten with the events df, in which the events
+    of the index changed were added or changed.
+
+    previous is the store before the changes, and previous_fingerprint
+    the store_fingerprint of its file: if given, and the index was built
+    with slots of slot_minutes from that version of the store, it is
+    updated (see update_slot_index); otherwise, it is built anew.
+    Returns the index.
+    """
+    fingerprint = store_fingerprint(running_events)
+    index = load_slot_index(path)
+    if (
+        index is None
+        or previous is None
+        or index["fingerprint"] != previous_fingerprint
+        or index["slot_ns"] != slot_minutes * 60 * 10 ** 9
+    ):
+        index = build_slot_index(materialize(df), slot_minutes, fingerprint)
+    else:
+        index = update_slot_index(index, previous, df, changed, fingerprint)
+    save_slot_index(index, path)
+    return index
+
+
+def save_slot_index(index, path):
+    """
+    Writes the slot index dict to path, atomically, so that readers
+    never see a partly written file.
+    """
+    tmp = path + ".tmp"
+    pd.to_pickle(index, tmp)
+    os.replace(tmp, path)
+
+
+def load_slot_index(path, running_events=None):
+    """
+    Loads the slot index dict at path, returning None if it does not
+    exist, or if running_events is specified and the index was built
+    from a different version of that store.
+    """
+    if not os.path.exists(path):
+        return None
+    index = pd.read_pickle(path)
+    if index.get("version") != SLOT_INDEX_VERSION:
+        return None
+    if running_events is not None:
+        if not os.path.exists(running_events):
+            return None
+        if index["fingerprint"] != store_fingerprint(running_events):
+            return None
+    return index
+
+
+class SlotIndex:
+    """
+    Answers tag-hours queries out of a slot index dict.
+
+    If the events df the index was built from are given, the partial
+    slots at the ends of a range are corrected exactly from the events
+    overlapping them; otherwise each partial slot's hours are prorated.
+    """
+
+    def __init__(self, index, df=None):
+        self._origin = index["origin"]
+        self._slot_ns = index["slot_ns"]
+        self._nslots = index["nslots"]
+        self._tags = index["tags"]
+        self._slicer = None
+        if df is not None:
+            self._slicer = RangeSlicer(df)
+            self._starts = epoch_ns(df.start)
+            self._ends = epoch_ns(df.end)
+            # the tag sets of events, interned by (tags, summary)
+            expanded = {}
+            self._event_tags = []
+            for key in zip(df.tags, df.summary):
+                if key not in expanded:
+                    expanded[key] = event_tags(*key)
+                self._event_tags.append(expanded[key])
+
+    def __contains__(self, tag):
+        return tag in self._tags
+
+    def _cumulative(self, tag, slot):
+        """The hours tagged tag in all slots before slot."""
+        slots, cum = self._tags[tag]
+        slot = min(slot, self._nslots)
+        if slots is None:
+            return cum[slot - 1] if slot > 0 else 0.0
+        i = np.searchsorted(slots, slot, side="left")
+        return cum[i - 1] if i > 0 else 0.0
+
+    def hours(self, tag, from_time, to_time):
+        """
+        Returns the hours of the events tagged tag (or a descendant of
+        tag) which fall between from_time and to_time.
+        """
+        if tag not in self._tags:
+            return 0.0
+        lo, hi = pd.Timestamp(from_time).value, pd.Timestamp(to_time).value
+        end = self._origin + self._nslots * self._slot_ns
+        lo, hi = max(lo, self._origin), min(hi, end)
+        if lo >= hi:
+            return 0.0
+        # the whole slots first_full up to (excluding) last_full
+        first_full = -(-(lo - self._origin) // self._slot_ns)
+        last_full = (hi - self._origin) // self._slot_ns
+        if first_full >= last_full:
+            return self._partial(tag, lo, hi)
+        full = self._cumulative(tag, last_full) - self._cumulative(
+            tag, first_full
+        )
+        first_edge = self._origin + first_full * self._slot_ns
+        last_edge = self._origin + last_full * self._slot_ns
+        return (
+            full
+            + self._partial(tag, lo, first_edge)
+            + self._partial(tag, last_edge, hi)
+        )
+
+    def _partial(self, tag, lo, hi):
+        """
+        The hours tagged tag between lo and hi, within a slot, from the
+        few events overlapping that slot (see interval.RangeSlicer).
+        """
+        if lo >= hi:
+            return 0.0
+        if self._slicer is None:
+            slot = (lo - self._origin) // self._slot_ns
+            slot_hours = self._cumulative(tag, slot + 1) - self._cumulative(
+                tag, slot
+            )
+            return slot_hours * (hi - lo) / self._slot_ns
+        rows = [
+            row
+            for row in self._slicer.rows_ns(lo, hi)
+            if tag in self._event_tags[row]
+        ]
+        starts = np.maximum(self._starts[rows], lo)
+        ends = np.minimum(self._ends[rows], hi)
+        return float((ends - starts).sum() / 3.6e12)
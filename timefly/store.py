@@ -0,0 +1,369 @@
+"""
+A loaded event store, and the queries the reports make of it.
+
+TimeflyStore reads the store once and owns a sorted index of event
+times and the exploded tag matrix, which is built up as ranges are
+queried (see context.RangeContexts). Everything digest, drill and
+versus compute is available as a method, and recent results are cached,
+so notebooks and batch jobs can run many queries without repeating
+the setup:
+
+    store = TimeflyStore.load("./data/running.pkl")
+    store.coverage("2019-01-01", "2019-03-31").uncovered_hours
+    store.breakdown("2019-01-01", "2019-03-31", tag_filter="sisu")
+
+Dates are YYYY-MM-DD strings (or "now") as accepted by utils.parse_date,
+or datetimes, which are used as-is.
+
+Recurring events stored as series (see recurrence) are expanded into
+their instances as queries reach the ranges they fall in.
+"""
+
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import log
+from .compare import greedy_deltas, rolling_deltas
+from .context import ContextTree, RangeContexts, iter_breakdowns
+from .cube import store_fingerprint
+from .interval import (
+    bucket_edges,
+    epoch_ns,
+    filter_range,
+    find_intervals,
+    hrs_bw,
+    split_by_buckets,
+)
+from .recurrence import expand, is_series, update_series
+from .schema import compact
+from .slots import SlotIndex, build_slot_index, load_slot_index
+from .tags import df_filter
+from .utils import parse_date, splat
+
+Coverage = namedtuple(
+    "Coverage", ["uncovered", "overlaps", "uncovered_hours", "range_hours"]
+)
+Coverage.__doc__ = """
+The uncovered and overlapping intervals of a range, as returned by
+interval.find_intervals, and the total uncovered and range hours.
+"""
+
+
+class TimeflyStore:
+    """
+    Queries over the event dataframe df, as written by merge, which was
+    read from path (if any).
+
+    The results of the last cache_size queries are kept; tree_size is
+    passed on to each context.ContextTree as its maxsize. tag_hours
+    uses the slot index at slot_index (as written by merge) if it's
+    up to date with the store, or else builds one in memory.
+    """
+
+    def __init__(
+        self, df, path=None, cache_size=32, tree_size=None, slot_index=None
+    ):
+        self.path = path
+        self._cache_size = cache_size
+        self._tree_size = tree_size
+        self._slot_index_path = slot_index
+        self._fingerprint = path and store_fingerprint(path)
+        self._reset(df)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Reads the store at path."""
+        with log.stage("load"):
+            df = pd.read_pickle(path)
+        return cls(df, path, **kwargs)
+
+    def refresh(self):
+        """
+        Re-reads the store if its file changed since it was read,
+        returning whether it did.
+        """
+        if self.path is None:
+            return False
+        fingerprint = store_fingerprint(self.path)
+        if fingerprint == self._fingerprint:
+            return False
+        log.debug("store {} changed, reloading", self.path)
+        with log.stage("load"):
+            df = pd.read_pickle(self.path)
+        self._fingerprint = fingerprint
+        self._reset(df)
+        return True
+
+    def _reset(self, df):
+        series = is_series(df)
+        self._series = df[series]
+        # the range (in ns) whose instances are in df
+        self._expanded = None
+        if series.any():
+            df = df[~series]
+        self.df = df
+        self._ranges = RangeContexts(df)
+        self._cache = OrderedDict()
+        self._slots = None
+
+    def _expand(self, from_time, to_time):
+        """
+        Adds the instances of the series which intersect the range to
+        df, for those parts of it that weren't expanded yet.
+        """
+        if not len(self._series):
+            return
+        lo, hi = epoch_ns([from_time, to_time])
+        if self._expanded is None:
+            parts = [(lo, hi)]
+        else:
+            # keep the expanded range contiguous, filling any gap
+            done_lo, done_hi = self._expanded
+            parts = [(lo, done_lo), (done_hi, hi)]
+            lo, hi = min(lo, done_lo), max(hi, done_hi)
+        parts = [(a, b) for a, b in parts if a < b]
+        if not parts:
+            return
+        with log.stage("expand recurrences"):
+            instances = pd.concat(
+                [
+                    expand(
+                        self._series,
+                        self.df.index,
+                        pd.Timestamp(a, tz="UTC"),
+                        pd.Timestamp(b, tz="UTC"),
+                    )
+                    for a, b in parts
+                ]
+            )
+            # instances straddling the expanded range are in both parts
+            instances = instances[~instances.index.duplicated()]
+        self._expanded = lo, hi
+        log.debug("expanded {} recurring event instances", len(instances))
+        if len(instances):
+            self.df = pd.concat([self.df, instances])
+            self._ranges.extend(instances)
+
+    def _cached(self, key, compute):
+        """Returns the cached result for key, computing it if needed."""
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = compute()
+        self._cache[key] = value
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    @staticmethod
+    def range(begin, end="now"):
+        """
+        Returns the datetimes from the start of the day begin to the end
+        of the day end.
+        """
+        return _time(begin, True), _time(end, False)
+
+    def events(self, begin, end="now", tag_filter=None):
+        """
+        Returns the df, ef pair of the events intersecting the range (as
+        with filter_range and explode), only keeping those tagged
+        tag_filter, if given, as with tags.df_filter.
+        """
+        from_time, to_time = self.range(begin, end)
+
+        def _events():
+            self._expand(from_time, to_time)
+            df, ef = self._ranges.contexts(from_time, to_time).get([])
+            return df_filter(df, ef, tag_filter, quiet=True)
+
+        key = ("events", from_time, to_time, tag_filter)
+        return self._cached(key, _events)
+
+    def kept_fraction(self, begin, end="now", tag_filter=None):
+        """
+        Returns the fraction of the events in range tagged tag_filter, or
+        None if it isn't set.
+        """
+        if not tag_filter:
+            return None
+        df, _ = self.events(begin, end)
+        if not len(df):
+            return None
+        return len(self.events(begin, end, tag_filter)[0]) / len(df)
+
+    def coverage(self, begin, end="now", tag_filter=None):
+        """
+        Returns the Coverage of the range by its events, only counting
+        those tagged tag_filter, if given.
+        """
+        from_time, to_time = self.range(begin, end)
+
+        def _coverage():
+            df, _ = self.events(from_time, to_time, tag_filter)
+            uncovered, overlaps = find_intervals(df, from_time, to_time)
+            return Coverage(
+                uncovered,
+                overlaps,
+                sum(map(splat(hrs_bw), uncovered)),
+                hrs_bw(from_time, to_time),
+            )
+
+        key = ("coverage", from_time, to_time, tag_filter)
+        return self._cached(key, _coverage)
+
+    def contexts(self, begin, end="now", tag_filter=None):
+        """
+        Returns the (shared) context.ContextTree over the events of
+        the range, filtered to tag_filter.
+        """
+        from_time, to_time = self.range(begin, end)
+
+        def _contexts():
+            df, ef = self.events(from_time, to_time, tag_filter)
+            return ContextTree(df, ef, self._tree_size)
+
+        key = ("contexts", from_time, to_time, tag_filter)
+        return self._cached(key, _contexts)
+
+    def cooccurrence(self, begin, end="now", tag_filter=None, context=()):
+        """
+        Returns the cooccur.Cooccurrence of the tags of the events of
+        the range, filtered to tag_filter, in the context (a list of
+        tags, see contexts), or None if the context is not narrowable.
+        It's memoized by the ContextTree of the range.
+        """
+        return self.contexts(begin, end, tag_filter).cooccurrence(context)
+
+    def breakdown(self, begin, end="now", tag_filter=None, min_support=0.025):
+        """
+        Returns the list of digest breakdowns of the range, as generated
+        by context.iter_breakdowns.
+        """
+        contexts = self.contexts(begin, end, tag_filter)
+        return list(iter_breakdowns(contexts, [], 1.0, min_support))
+
+    def summary(self, context, begin, end="now", tag_filter=None):
+        """
+        Returns the context.ContextSummary of the list of tags context
+        in the range, or None if it isn't narrowable.
+        """
+        return self.contexts(begin, end, tag_filter).summary(context)
+
+    def compare(
+        self, start1, end1, start2, end2, tag_filter=None, min_support=0.025
+    ):
+        """
+        Generates the records of compare.greedy_deltas from the range
+        start1 - end1 to the range start2 - end2, among the events of
+        the whole span, filtered to tag_filter, as versus does.
+        """
+        start1, start2 = _time(start1, True), _time(start2, True)
+        end1, end2 = _time(end1, False), _time(end2, False)
+        df, ef = self.events(start1, end2, tag_filter)
+        prev_df = filter_range(df, start1, end1)
+        next_df = filter_range(df, start2, end2)
+        return greedy_deltas(
+            ef.columns.values,
+            ef.loc[prev_df.index].values,
+            prev_df.duration_hours.values,
+            ef.loc[next_df.index].values,
+            next_df.duration_hours.values,
+            min_support,
+        )
+
+    def periods(self, begin, end, bucket, tag_filter=None):
+        """
+        Splits the range into buckets of the given size (see
+        interval.BUCKET_FREQS), returning the list of bucket edges and
+        the list of int arrays of the rows of events(begin, end,
+        tag_filter) which intersect each bucket.
+        """
+        from_time, to_time = self.range(begin, end)
+
+        def _periods():
+            df, _ = self.events(from_time, to_time, tag_filter)
+            edges = bucket_edges(from_time, to_time, bucket)
+            rows, buckets, _ = split_by_buckets(
+                epoch_ns(df.start), epoch_ns(df.end), epoch_ns(edges)
+            )
+            order = buckets.argsort(kind="stable")
+            period_rows = np.split(
+                rows[order],
+                np.searchsorted(buckets[order], np.arange(1, len(edges) - 1)),
+            )
+            return edges, period_rows
+
+        key = ("periods", from_time, to_time, bucket, tag_filter)
+        return self._cached(key, _periods)
+
+    def compare_periods(
+        self,
+        begin,
+        end,
+        bucket,
+        tag_filter=None,
+        min_support=0.025,
+        jobs=None,
+    ):
+        """
+        Generates the (k, records) comparisons of each bucket of the range
+        to the previous one, as compare.rolling_deltas does.
+        """
+        df, ef = self.events(begin, end, tag_filter)
+        _, period_rows = self.periods(begin, end, bucket, tag_filter)
+        return rolling_deltas(
+            ef.columns.values,
+            ef.values,
+            df.duration_hours.values.astype(float),
+            period_rows,
+            min_support,
+            jobs=jobs,
+        )
+
+    def tag_hours(self, tag, begin, end="now"):
+        """
+        Returns the hours of the events tagged tag (or any descendant)
+        which fall within the range, counting only the part of events
+        straddling its ends, from the slot index (see slots).
+        """
+        if self._slots is None:
+            if len(self._series):
+                # the index covers every instance of every series
+                self._expand(
+                    self._series.start.min(),
+                    self._series.recurrence_end.max(),
+                )
+            index = None
+            if self._slot_index_path:
+                index = load_slot_index(self._slot_index_path, self.path)
+            if index is None:
+                with log.stage("build slot index"):
+                    index = build_slot_index(self.df)
+            self._slots = SlotIndex(index, self.df)
+        return self._slots.hours(tag, *self.range(begin, end))
+
+
+def merge_events(running, new):
+    """
+    Returns the union of the store running with the newly ingested
+    events new, in the compact schema, along with the index of the
+    events which it adds or changes: those new to the store, and the
+    series in new, whose rule and exceptions replace those of running
+    (see recurrence.update_series).
+    """
+    running = update_series(running, new)
+    added = new.index.difference(running.index)
+    # categoricals with differing categories concat to objects, so
+    # (re-)apply the compact schema to the union; this also migrates
+    # stores written before the schema existed
+    merged = compact(pd.concat([running, new.loc[added]]))
+    return merged, added.union(new.index[is_series(new)])
+
+
+def _time(value, start_of_day):
+    """Parses value with parse_date, unless it's already a datetime."""
+    if isinstance(value, str):
+        return parse_date(value, start_of_day)
+    return value
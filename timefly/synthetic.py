@@ -0,0 +1,111 @@
+"""
+Deterministic synthetic calendars, shaped like the stores ingest
+writes, for benchmarking the pipeline without a Google calendar.
+
+Events tile the calendar at a fixed rate per day, each lasting a
+random part of its slot (leaving uncovered gaps), with some running
+over into the next slot (overlaps). Tags and summaries are drawn from
+Zipfian distributions, so a few are very popular and most are rare,
+as in a real calendar.
+"""
+
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from .schema import compact
+
+# number of tags per event, drawn uniformly from this list
+_TAGS_PER_EVENT = [0, 1, 1, 2, 3]
+
+
+def zipf_probabilities(n, exponent):
+    """Probabilities of ranks 1..n under a Zipf law with exponent."""
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def synthetic_calendar(
+    nevents=None,
+    years=1,
+    events_per_day=12,
+    ntags=50,
+    zipf=1.1,
+    overlap=0.05,
+    seed=0,
+    begin="2019-01-01",
+):
+    """
+    Returns an event dataframe (in the schema.compact schema) spanning
+    the given number of years from begin, a YYYY-MM-DD date (UTC).
+
+    If nevents is given, it overrides events_per_day. ntags is the
+    number of distinct tags (half as many distinct summaries are used),
+    zipf the exponent of their popularity distribution, and overlap the
+    fraction of events running over into the next one.
+
+    The same arguments always produce the same calendar.
+    """
+    rng = np.random.default_rng(seed)
+    days = 365 * years
+    if nevents is None:
+        nevents = int(events_per_day * days)
+    origin = datetime.strptime(begin, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    origin_ns = pd.Timestamp(origin).value
+
+    slot_ns = days * 24 * 3600 * 10 ** 9 // max(nevents, 1)
+    starts = origin_ns + np.arange(nevents, dtype=np.int64) * slot_ns
+    durations = (slot_ns * rng.uniform(0.5, 1.0, nevents)).astype(np.int64)
+    overlapping = rng.random(nevents) < overlap
+    durations[overlapping] += (
+        slot_ns * rng.uniform(0.1, 0.5, overlapping.sum())
+    ).astype(np.int64)
+    # whole seconds, like calendar events
+    starts -= starts % 10 ** 9
+    durations -= durations % 10 ** 9
+    ends = starts + durations
+
+    tag_names = ["tag{}".format(i) for i in range(ntags)]
+    ntags_each = rng.choice(_TAGS_PER_EVENT, nevents)
+    tag_ids = rng.choice(
+        ntags, ntags_each.sum(), p=zipf_probabilities(ntags, zipf)
+    )
+    tag_bounds = np.cumsum(ntags_each)[:-1]
+    tagsets = [
+        frozenset(tag_names[i] for i in ids)
+        for ids in np.split(tag_ids, tag_bounds)
+    ]
+
+    nsummaries = max(ntags // 2, 1)
+    summary_names = np.array(
+        [""] + ["summary {}".format(i) for i in range(1, nsummaries)]
+    )
+    summaries = summary_names[
+        rng.choice(
+            nsummaries, nevents, p=zipf_probabilities(nsummaries, zipf)
+        )
+    ].tolist()
+
+    event_ids = ["synthetic{}".format(i) for i in range(nevents)]
+    raw_summaries = [
+        " ".join(["[{}]".format(tag) for tag in sorted(tags)] + [summary])
+        .strip()
+        for tags, summary in zip(tagsets, summaries)
+    ]
+    df = pd.DataFrame(
+        {
+            "raw_json": [
+                {"id": event_id, "summary": raw}
+                for event_id, raw in zip(event_ids, raw_summaries)
+            ],
+            "start": pd.to_datetime(starts, utc=True),
+            "end": pd.to_datetime(ends, utc=True),
+            "duration_hours": durations / (3600 * 10 ** 9),
+            "raw_summary": raw_summaries,
+            "summary": summaries,
+            "tags": tagsets,
+        },
+        index=pd.Index(event_ids, name="event_id"),
+    )
+    return compact(df)
@@ -0,0 +1,170 @@
+"""
+Boolean tag filter expressions, as accepted by the --filter flags.
+
+A filter is a tag, or tags combined with AND, OR, NOT and parentheses:
+
+    sisu
+    work AND NOT meeting
+    (health OR exercise) AND NOT "deep work"
+
+Consecutive bare words form a single tag, so deep work AND fun is the
+same as "deep work" AND fun. Tags containing parentheses or quotes must
+be double-quoted (with backslash escapes); so may tags containing a
+keyword, though a well-formed filter which is exactly the name of a tag
+always means just that tag.
+
+Filters are evaluated as vectorized boolean operations on the columns
+of an exploded tag matrix (see tags.explode), one per tag mentioned;
+tags absent from the matrix match no events. A tag matches the events
+carrying it or any of its descendants, so work matches work/coding.
+"""
+
+import re
+
+import numpy as np
+
+from .hierarchy import subtree_columns
+
+_KEYWORDS = {"AND", "OR", "NOT"}
+
+_TOKEN = re.compile(r'\s*(?:([()])|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+def _tokenize(expr):
+    """
+    Returns the list of (kind, value) tokens of expr, where kind is one
+    of "(", ")", "tag" or a keyword, merging runs of bare words.
+    """
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = _TOKEN.match(expr, pos)
+        if match is None:
+            raise ValueError(
+                "unterminated quote in filter {!r}".format(expr)
+            )
+        paren, quoted, word = match.groups()
+        pos = match.end()
+        if paren:
+            tokens.append((paren, paren))
+        elif quoted is not None:
+            tokens.append(("tag", re.sub(r"\\(.)", r"\1", quoted)))
+        elif word in _KEYWORDS:
+            tokens.append((word, word))
+        elif tokens and tokens[-1][0] == "word":
+            tokens[-1] = ("word", tokens[-1][1] + " " + word)
+        else:
+            tokens.append(("word", word))
+    return [("tag" if kind == "word" else kind, v) for kind, v in tokens]
+
+
+def parse(expr):
+    """
+    Parses the filter expression expr into a tree of tuples:
+    ("tag", name), ("not", node), ("and", [nodes]) or ("or", [nodes]).
+
+    Raises ValueError if expr is malformed.
+    """
+    tokens = _tokenize(expr)
+    if not tokens:
+        raise ValueError("empty filter")
+    node, pos = _parse_or(tokens, 0, expr)
+    if pos != len(tokens):
+        raise ValueError(
+            "unexpected {!r} in filter {!r}".format(tokens[pos][1], expr)
+        )
+    return node
+
+
+def _parse_or(tokens, pos, expr):
+    nodes = []
+    while True:
+        node, pos = _parse_and(tokens, pos, expr)
+        nodes.append(node)
+        if pos < len(tokens) and tokens[pos][0] == "OR":
+            pos += 1
+        else:
+            break
+    return (nodes[0] if len(nodes) == 1 else ("or", nodes)), pos
+
+
+def _parse_and(tokens, pos, expr):
+    nodes = []
+    while True:
+        node, pos = _parse_not(tokens, pos, expr)
+        nodes.append(node)
+        if pos < len(tokens) and tokens[pos][0] == "AND":
+            pos += 1
+        else:
+            break
+    return (nodes[0] if len(nodes) == 1 else ("and", nodes)), pos
+
+
+def _parse_not(tokens, pos, expr):
+    if pos == len(tokens):
+        raise ValueError("filter {!r} ends unexpectedly".format(expr))
+    kind, value = tokens[pos]
+    if kind == "NOT":
+        node, pos = _parse_not(tokens, pos + 1, expr)
+        return ("not", node), pos
+    if kind == "tag":
+        return ("tag", value), pos + 1
+    if kind == "(":
+        node, pos = _parse_or(tokens, pos + 1, expr)
+        if pos == len(tokens) or tokens[pos][0] != ")":
+            raise ValueError("unbalanced ( in filter {!r}".format(expr))
+        return node, pos + 1
+    raise ValueError("unexpected {!r} in filter {!r}".format(value, expr))
+
+
+def compile_filter(expr, columns):
+    """
+    Returns the parse tree of the filter expr, treating it as a single
+    tag if it's exactly one of the columns (of an exploded tag matrix).
+    """
+    if expr in columns:
+        return ("tag", expr)
+    return parse(expr)
+
+
+def is_valid(expr):
+    """Whether expr is None or a well-formed filter, for flag validators."""
+    if expr is None:
+        return True
+    try:
+        parse(expr)
+    except ValueError:
+        return False
+    return True
+
+
+def tags_of(node):
+    """Returns the set of tags mentioned in the parse tree node."""
+    kind, value = node
+    if kind == "tag":
+        return {value}
+    if kind == "not":
+        return tags_of(value)
+    return set().union(*map(tags_of, value))
+
+
+def evaluate(node, ef, leaves=frozenset()):
+    """
+    Returns the boolean array of the rows of the exploded tag matrix ef
+    matched by the parse tree node, where a tag matches the rows
+    carrying it or any of its descendants (see hierarchy, and
+    hierarchy.summary_leaves for leaves).
+    """
+    kind, value = node
+    if kind == "tag":
+        columns = subtree_columns(ef.columns, value, leaves)
+        if not columns:
+            return np.zeros(len(ef), dtype=bool)
+        if columns == [value]:
+            return ef[value].values.astype(bool, copy=False)
+        return ef[columns].values.any(axis=1)
+    if kind == "not":
+        return ~evaluate(value, ef, leaves)
+    combine = np.logical_and if kind == "and" else np.logical_or
+    return combine.reduce([evaluate(child, ef, leaves) for child in value])
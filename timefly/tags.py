@@ -2,9 +2,14 @@
 Handling for the tags from calendar events.
 """
 
+import numpy as np
 import pandas as pd
 
+from . import log, tag_filter
+from .hierarchy import summary_leaves
 
+
+@log.stage("explode")
 def explode(df, min_support_count=None):
     """
     Given a dataframe with a tags column that contains an iterable of tags,
@@ -21,39 +26,134 @@ def explode(df, min_support_count=None):
     # do one tag at a time and explicitly construct the sparse vector.
     # probably need to switch from pandas to a dict.
 
-    # just treat the summary as a tag itself too
+    # just treat the summary as a tag itself too, unless it's missing
 
     df = df.copy()
     df["tags"] = df[["tags", "summary"]].apply(
-        lambda x: {y for y in x.tags.union(frozenset([x.summary])) if y},
+        lambda x: {y for y in x.tags.union(frozenset([x.summary]))
+                   if isinstance(y, str) and y},
         axis=1)
 
     exploded = df.tags.apply(lambda x: pd.Series({tag: True for tag in x}))
-    exploded = exploded.fillna(False)
+    exploded = exploded.fillna(False).astype(bool)
     return exploded
 
-def df_filter(df, ef, tag=None, keep=True):
+
+def rank_by_popular_tag(df, ef, min_support, max_values):
+    """
+    A popular-tag breakdown does the following:
+    for each item in the context, associate it with a single tag,
+    the most popular tag (by event count) in its own set of tags.
+    Items without any tags are associated with "<unk>".
+
+    Then just break down the overall distribution of most-popular-tags
+    by duration_hours.
+
+    Returns the tags (as an index) and their fractions of all hours,
+    in decreasing order, for at most max_values tags with a fraction of
+    at least min_support.
+    """
+    tags, hours = popular_tag_hours(df, ef)
+    return select_popular(tags, hours, min_support, max_values)
+
+
+def popular_tag_hours(df, ef):
+    """
+    Returns the hours of df broken down by most popular tag (see
+    rank_by_popular_tag) as a pair of the tags (as an index), and
+    a float array of their hours. Only tags which are the most popular
+    one for some event are present.
+
+    If df has an events column, each row stands for that many events
+    with the same tags (see chunked.TagSetTotals), as far as the
+    popularity of tags is concerned.
+    """
+    counts = df["events"].values if "events" in df.columns else None
+    names, codes = popular_tag_codes(ef, counts)
+    hrs = np.bincount(
+        codes, weights=df.duration_hours.values, minlength=len(names)
+    )
+    present = np.bincount(codes, minlength=len(names)) > 0
+    return pd.Index(names[present]), hrs[present]
+
+
+def popular_tag_codes(ef, counts=None):
     """
-    No-op if the filter tag is set to None.format
+    Returns an array of tag names, in decreasing order of support and
+    ending with "<unk>", along with an integer array holding, for each
+    row of ef, the position of its most popular tag in the names.
 
-    Otherwise, only includes the rows associated with the string tag,
-    which must be a column in the exploded dataframe.
+    The support of a tag is the number of rows carrying it or, if
+    given, the total of the int array counts over those rows.
+    """
+    cols = ef.columns
+    mat = ef.values
+    support = mat.sum(axis=0) if counts is None else counts @ mat
+    order = np.argsort(-support, kind="stable")
+    names = np.append(cols.values[order], "<unk>")
+
+    # one boolean gather into support order, so the first set entry
+    # of each row is its most popular tag
+    codes = np.full(len(mat), len(order))
+    if len(order):
+        ordered = mat.take(order, axis=1)
+        first = ordered.argmax(axis=1)
+        tagged = ordered[np.arange(len(first)), first]
+        codes[tagged] = first[tagged]
+        del ordered
+    return names, codes
 
-    if keep is false, removes the column associated with the tag.
+
+def select_popular(tags, hours, min_support, max_values):
+    """
+    Given the output of popular_tag_hours, returns the tags and
+    fractions of hours as described in rank_by_popular_tag.
+    """
+    percent = hours / hours.sum()
+    keep = np.flatnonzero(percent >= min_support)
+    keep = keep[np.argsort(-percent[keep], kind="stable")][:max_values]
+    return tags[keep], percent[keep]
+
+
+@log.stage("df_filter")
+def df_filter(df, ef, tag=None, keep=True, quiet=False):
+    """
+    No-op if the filter tag is set to None.
+
+    Otherwise, only includes the rows matching tag, a tag_filter
+    expression (such as a single tag, which need not be a column of the
+    exploded dataframe, or work AND NOT meeting).
+
+    The tags the filter mentions which are then set on every remaining
+    row (or on none) carry no information, so they are removed, both
+    from the tag sets of df and as columns of ef. (keep is ignored.)
+
+    Prints the fraction of rows kept unless quiet.
 
     Returns the modified df, ef.
     """
     if not tag:
         return df, ef
 
-    chosen = ef[tag]
+    node = tag_filter.compile_filter(tag, ef.columns)
+    chosen = tag_filter.evaluate(node, ef, summary_leaves(df))
     df = df[chosen].copy()
-    def remove_tag(s):
-        s = set(s)
-        s.remove(tag)
-        return frozenset(s)
-    df.loc[:, 'tags'] = df.tags.apply(remove_tag)
-    ef = ef[chosen].drop(columns=tag)
-
-    print('only keeping {:.2%} of rows matching {}'.format(chosen.mean(), tag))
+    ef = ef[chosen]
+    mentioned = ef.columns.intersection(sorted(tag_filter.tags_of(node)))
+    values = ef[mentioned].values
+    constant = mentioned[values.all(axis=0) | ~values.any(axis=0)]
+    ef = ef.drop(columns=constant)
+
+    # tag sets are interned (see schema.compact), so strip each distinct
+    # one once and gather the results back into rows
+    codes, uniques = pd.factorize(df.tags)
+    removed = frozenset(constant)
+    stripped = np.empty(len(uniques), dtype=object)
+    for i, tags in enumerate(uniques):
+        stripped[i] = tags - removed
+    df["tags"] = stripped[codes]
+
+    if not quiet:
+        print('only keeping {:.2%} of rows matching {}'.format(
+            chosen.mean(), tag))
     return df, ef
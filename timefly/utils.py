@@ -2,6 +2,7 @@
 Generic utilities file.
 """
 
+import threading
 from datetime import datetime, timedelta, timezone
 from functools import reduce
 
@@ -21,6 +22,23 @@ def compose(*fs):
     return reduce(compose2, fs)
 
 
+def once(f):
+    """
+    Returns a zero-argument function returning f(), which only calls f
+    the first time, even if called from several threads at once.
+    """
+    lock = threading.Lock()
+    result = []
+
+    def _once():
+        with lock:
+            if not result:
+                result.append(f())
+        return result[0]
+
+    return _once
+
+
 def parse_date(datestr, start_of_day):
     """
     Converts a date YYYY-MM-DD into the datetime associated
@@ -39,7 +57,7 @@ def parse_date(datestr, start_of_day):
     parsed = parsed.astimezone()
     if start_of_day:
         return parsed.astimezone(timezone.utc)
-    parsed += timedelta(hours=23, minutes=59, seconds=99)
+    parsed += timedelta(hours=23, minutes=59, seconds=59)
     return parsed.astimezone(timezone.utc)
 
 
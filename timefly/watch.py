@@ -0,0 +1,249 @@
+"""
+Keeps a store and everything derived from it up to date as new events
+arrive, for timefly.main.watch to run periodically.
+
+New events come from a source, which lists the shard files (event
+dataframes, as written by ingest) ready to be merged. DropDirSource
+takes those dropped into a directory by any other process, and
+FetchSource also pulls the recent events from Google calendar itself
+on every poll, by running ingest into the directory. Anything with the
+same poll and done methods will do, such as a fake source handing out
+fixed shards in tests.
+
+Each sync merges the new shards into the store (see store.merge_events),
+writes it, and then updates what's derived from it: the cube and slot
+index, as merge does (see cube.update_cube and slots.update_slot_index),
+and the daily aggregates (see aggregates), of which only the days
+touched by the new events are recomputed. The store and everything
+derived from it are replaced atomically, so that readers (serve, or
+watch --show) never see a partly written file. A poll failing, say,
+for want of a network connection, is reported and retried at the next
+sync.
+"""
+
+import glob
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from . import log, results
+from .aggregates import (
+    DAY_NS,
+    build_aggregates,
+    latest,
+    load_aggregates,
+    save_aggregates,
+    update_aggregates,
+)
+from .cube import refresh_cube, store_fingerprint
+from .recurrence import touched_range
+from .slots import refresh_slot_index
+from .store import merge_events
+
+MERGED_DIR = "merged"
+
+
+class DropDirSource:
+    """
+    The shard files dropped into directory, as *.pkl files. Writers
+    should write each shard under another name (such as one starting
+    with a dot) and then rename it, so that no shard is read while
+    being written. Merged shards are moved to the merged subdirectory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, MERGED_DIR), exist_ok=True)
+
+    def poll(self):
+        """Returns the sorted list of the paths of the new shards."""
+        return sorted(glob.glob(os.path.join(self.directory, "*.pkl")))
+
+    def done(self, path):
+        """Marks the shard at path as merged."""
+        merged = os.path.join(self.directory, MERGED_DIR)
+        os.replace(path, os.path.join(merged, os.path.basename(path)))
+
+
+class FetchSource(DropDirSource):
+    """
+    A DropDirSource which, before listing the shards, runs ingest to
+    fetch the events of the last days days (to now) into a new shard,
+    passing on the list of extra ingest flags.
+    """
+
+    def __init__(self, directory, days, ingest_flags=()):
+        super().__init__(directory)
+        self.days = days
+        self.ingest_flags = list(ingest_flags)
+
+    def poll(self):
+        now = datetime.now(timezone.utc)
+        name = now.strftime("fetch-%Y%m%dT%H%M%SZ.pkl")
+        tmp = os.path.join(self.directory, "." + name)
+        begin = (now - timedelta(days=self.days)).strftime("%Y-%m-%d")
+        try:
+            with log.stage("fetch"):
+                subprocess.run(
+                    [sys.executable, "-m", "timefly.main.ingest"]
+                    + ["--begin", begin, "--dst", tmp]
+                    + self.ingest_flags,
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                )
+            os.replace(tmp, os.path.join(self.directory, name))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return super().poll()
+
+
+class Watcher:
+    """
+    Merges the shards of source into the store at running_events, and
+    keeps the cube at cube (if it exists), the slot index at slot_index
+    (unless empty, with slots of slot_minutes) and the aggregates at
+    aggregates up to date with it. The latest aggregates are those of
+    the given windows (see aggregates.latest).
+    """
+
+    def __init__(
+        self,
+        source,
+        running_events,
+        aggregates,
+        cube=None,
+        slot_index=None,
+        slot_minutes=15,
+        windows=(1, 7, 30),
+    ):
+        self.source = source
+        self.running_events = running_events
+        self.aggregates_path = aggregates
+        self.cube = cube
+        self.slot_index = slot_index
+        self.slot_minutes = slot_minutes
+        self.windows = windows
+        self.df = None
+        self.aggregates = None
+        if os.path.exists(running_events):
+            with log.stage("load"):
+                self.df = pd.read_pickle(running_events)
+            self.aggregates = load_aggregates(aggregates, running_events)
+            if self.aggregates is None:
+                log.debug("aggregates {} missing or stale", aggregates)
+                with log.stage("build aggregates"):
+                    self.aggregates = build_aggregates(
+                        self.df, store_fingerprint(running_events)
+                    )
+
+    def sync(self, now=None):
+        """
+        Merges any new shards, then brings the latest aggregates up to
+        now (the current time by default). Returns the number of events
+        added or changed.
+        """
+        changed = None
+        previous = self.df
+        previous_fingerprint = None
+        if os.path.exists(self.running_events):
+            previous_fingerprint = store_fingerprint(self.running_events)
+        try:
+            paths = self.source.poll()
+        except (OSError, subprocess.CalledProcessError) as e:
+            # e.g., ingest failing to reach the calendar; the shards are
+            # fetched again on the next sync
+            print("polling for shards failed: {}".format(e), file=sys.stderr)
+            paths = []
+        for path in paths:
+            with log.stage("load shard"):
+                new = pd.read_pickle(path)
+            merged = self._merge(new)
+            changed = merged if changed is None else changed.union(merged)
+            self.source.done(path)
+            log.debug("merged shard {}, {} events changed", path, len(merged))
+        if changed is not None and len(changed):
+            self._save(changed, previous, previous_fingerprint)
+        if self.aggregates is not None:
+            self.aggregates["latest"] = latest(
+                self.aggregates,
+                now or datetime.now(timezone.utc),
+                self.windows,
+            )
+            save_aggregates(self.aggregates, self.aggregates_path)
+        return 0 if changed is None else len(changed)
+
+    def _merge(self, new):
+        """
+        Merges the events new into the store in memory, updating the
+        aggregates of the days they touch. Returns the index of the
+        events added or changed.
+        """
+        if self.df is None:
+            self.df = new.iloc[:0]
+        previous = self.df
+        self.df, changed = merge_events(self.df, new)
+        if not len(changed):
+            return changed
+        if self.aggregates is None:
+            with log.stage("build aggregates"):
+                self.aggregates = build_aggregates(self.df)
+        else:
+            with log.stage("update aggregates"):
+                lo, hi = _touched_days(previous, self.df, changed)
+                update_aggregates(self.aggregates, self.df, lo, hi)
+        return changed
+
+    def _save(self, changed, previous, previous_fingerprint):
+        """
+        Writes the store, and everything derived from it, after the
+        events of the index changed were added or changed in the store
+        previous, whose file had the store_fingerprint
+        previous_fingerprint.
+        """
+        with log.stage("save"):
+            tmp = self.running_events + ".tmp"
+            self.df.to_pickle(tmp)
+            os.replace(tmp, self.running_events)
+        results.invalidate(self.running_events)
+        fingerprint = store_fingerprint(self.running_events)
+        self.aggregates["fingerprint"] = fingerprint
+
+        if self.cube:
+            with log.stage("refresh cube"):
+                refresh_cube(
+                    self.cube,
+                    self.running_events,
+                    self.df,
+                    changed,
+                    previous,
+                    previous_fingerprint,
+                )
+        if self.slot_index:
+            with log.stage("refresh slot index"):
+                refresh_slot_index(
+                    self.slot_index,
+                    self.running_events,
+                    self.df,
+                    changed,
+                    previous,
+                    previous_fingerprint,
+                    self.slot_minutes,
+                )
+
+
+def _touched_days(previous, df, changed):
+    """
+    Returns the first and last (exclusive) UTC day boundaries, in ns,
+    of the days on which the events of the index changed, added or
+    changed in the store previous to give the store df, fall before or
+    after the change (such as the instances of a series' old rule).
+    """
+    spans = [touched_range(previous, changed), touched_range(df, changed)]
+    spans = [span for span in spans if span is not None]
+    lo = min(span[0] for span in spans).value // DAY_NS * DAY_NS
+    hi = -(-max(span[1] for span in spans).value // DAY_NS) * DAY_NS
+    return lo, max(hi, lo + DAY_NS)